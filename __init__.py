@@ -1,6 +1,29 @@
-from .logger import logger
-from .auth import *
-from .database import (
-	Sandbox, DB
-)
-from . import config
\ No newline at end of file
+"""
+Names exported by the package are imported the first time they are
+used, so importing a single submodule (as the cli does) stays cheap.
+"""
+from importlib import import_module
+
+_EXPORTS = {
+	"logger": ".logger",
+	"Sandbox": ".database",
+	"DB": ".database",
+	"add_sandbox": ".auth",
+	"login": ".auth",
+	"is_logged_in": ".auth",
+	"get_host": ".auth",
+	"get_password": ".auth",
+	"get_username": ".auth",
+}
+
+__all__ = ["config", *_EXPORTS]
+
+
+def __getattr__(name: str):
+	if name == "config":
+		return import_module(".config", __name__)
+	if name not in _EXPORTS:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	value = getattr(import_module(_EXPORTS[name], __name__), name)
+	globals()[name] = value
+	return value
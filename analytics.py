@@ -0,0 +1,319 @@
+"""
+This module contains the file usage recorder.
+
+Every read and write of a cache is recorded as an access. Accesses are
+only appended to an in-memory buffer; a background writer rolls them up
+by path, extension, directory and sandbox over `config.ANALYTICS_WINDOW`
+second windows and adds the rollups to the `FileUsage` table in a single
+transaction. Recording an access therefore never touches the disk.
+
+The rollups answer which files, file types and directories are used
+most, which is what prefetching and eviction are tuned with.
+
+CLASSES DECLARED
+================
+
+UsageRecorder:
+	buffers accesses and answers queries over their rollups
+
+OBJECTS DECLARED
+================
+
+recorder:
+	the application wide usage recorder
+"""
+import atexit
+import posixpath
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
+
+from . import config
+from .database import DB, FileUsage
+from .logger import logger
+from .metrics import metrics
+
+if TYPE_CHECKING:
+	from .cache import Cache
+
+KINDS = ("path", "extension", "directory", "sandbox")
+"what rollups are kept by"
+
+ORDERS = ("reads", "writes", "bytes_read", "bytes_written", "last_access")
+"what rollups can be sorted by"
+
+READ = 0
+WRITE = 1
+
+Access = Tuple[float, str, str, int, int]
+"the time, sandbox, path, operation and size of an access"
+
+Rollup = Dict[Tuple[str, str, str, int], List[float]]
+"""reads, writes, bytes read, bytes written and last access by kind,
+sandbox, key and window"""
+
+
+def get_keys(sandbox: str, path: str) -> Tuple[Tuple[str, str], ...]:
+	"""
+	Returns: the kind and key of every rollup an access to `path` counts
+	towards
+	"""
+
+	name = posixpath.basename(path)
+	extension = posixpath.splitext(name)[1].lower()
+	return (
+		("path", path),
+		("extension", extension),
+		("directory", posixpath.dirname(path)),
+		("sandbox", sandbox),
+	)
+
+
+def rollup(accesses: List[Access], window: int) -> Rollup:
+	"""
+	add up accesses by kind, sandbox, key and time window
+	"""
+
+	totals: Rollup = {}
+	for at, sandbox, path, op, size in accesses:
+		start = int(at // window * window)
+		for kind, key in get_keys(sandbox, path):
+			total = totals.get((kind, sandbox, key, start))
+			if total is None:
+				total = totals[(kind, sandbox, key, start)] = [0, 0, 0, 0, 0.0]
+			total[op] += 1
+			total[2 + op] += size
+			if at > total[4]:
+				total[4] = at
+	return totals
+
+
+class UsageRecorder:
+	"""This interface records accesses to caches.
+
+	`read` and `write` append to a buffer without taking a lock; the
+	writer drains the buffer every `flush_interval` seconds, or as soon
+	as `batch_size` accesses are buffered.
+	"""
+
+	def __init__(
+		self,
+		enabled: bool = config.ANALYTICS_ENABLED,
+		window: int = config.ANALYTICS_WINDOW,
+		flush_interval: float = config.ANALYTICS_FLUSH_INTERVAL,
+		batch_size: int = config.ANALYTICS_BATCH_SIZE,
+		retention: float = config.ANALYTICS_RETENTION,
+	):
+		self.enabled = enabled
+		self.window = window
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		self.retention = retention
+		self._buffer: Deque[Access] = deque()
+		self._ready = False
+		self._flush_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._writer: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+
+	def read(self, cache: 'Cache', size: int):
+		"""
+		record that `size` bytes of a cache were read
+		"""
+
+		if self.enabled:
+			self._record(cache, READ, size)
+
+	def write(self, cache: 'Cache', size: int):
+		"""
+		record that `size` bytes were written to a cache
+		"""
+
+		if self.enabled:
+			self._record(cache, WRITE, size)
+
+	def _record(self, cache: 'Cache', op: int, size: int):
+		meta = cache.meta
+		self._buffer.append(
+			(time.time(), meta.sandbox or "", meta.origin, op, size))
+		if len(self._buffer) >= self.batch_size:
+			self._wakeup.set()
+		if self._writer is None:
+			self._start_writer()
+
+	def _ensure_table(self):
+		if not self._ready:
+			DB.create_tables([FileUsage], safe=True)
+			self._ready = True
+
+	def flush(self) -> int:
+		"""
+		add the buffered accesses to the rollups in the database
+
+		Returns: the number of accesses written
+		"""
+
+		from peewee import EXCLUDED, fn
+
+		with self._flush_lock:
+			# accesses recorded while draining are left for the next flush
+			accesses = [
+				self._buffer.popleft() for _ in range(len(self._buffer))]
+			if not accesses:
+				return 0
+			rows = [
+				dict(kind=kind, sandbox=sandbox, key=key, window=start,
+					reads=total[0], writes=total[1], bytes_read=total[2],
+					bytes_written=total[3], last_access=total[4])
+				for (kind, sandbox, key, start), total
+				in rollup(accesses, self.window).items()
+			]
+			try:
+				self._ensure_table()
+				with metrics.timer("analytics.flush"), DB.atomic():
+					for i in range(0, len(rows), 100):
+						FileUsage.insert_many(rows[i:i + 100]).on_conflict(
+							conflict_target=[FileUsage.kind, FileUsage.sandbox,
+								FileUsage.key, FileUsage.window],
+							update={
+								FileUsage.reads: FileUsage.reads + EXCLUDED.reads,
+								FileUsage.writes: FileUsage.writes + EXCLUDED.writes,
+								FileUsage.bytes_read:
+									FileUsage.bytes_read + EXCLUDED.bytes_read,
+								FileUsage.bytes_written:
+									FileUsage.bytes_written + EXCLUDED.bytes_written,
+								FileUsage.last_access: fn.MAX(
+									FileUsage.last_access, EXCLUDED.last_access),
+							},
+						).execute()
+			except Exception:
+				self._buffer.extendleft(reversed(accesses))
+				raise
+		metrics.observe("analytics.batch", len(accesses))
+		logger.debug("wrote %d accesses as %d rollups", len(accesses), len(rows))
+		return len(accesses)
+
+	def prune(self, before: Optional[float] = None) -> int:
+		"""
+		delete rollups of windows that started before `before`. defaults
+		to the retention period ago.
+
+		Returns: the number of rollups deleted
+		"""
+
+		if before is None:
+			before = time.time() - self.retention
+		self._ensure_table()
+		return FileUsage.delete().where(FileUsage.window < before).execute()
+
+	def top(
+		self,
+		kind: str = "path",
+		since: Optional[float] = None,
+		sandbox: Optional[str] = None,
+		order: str = "reads",
+		limit: Optional[int] = 10,
+	) -> List[dict]:
+		"""
+		get the most used paths, extensions, directories or sandboxes.
+		buffered accesses are written first.
+
+		Args:
+			kind: one of KINDS
+			since: only count windows that end after this timestamp
+			sandbox: only count accesses to this sandbox
+			order: one of ORDERS, the busiest come first
+			limit: the number of results. None for all of them
+
+		Returns: the key, sandbox and totals of each result
+		"""
+
+		if kind not in KINDS:
+			raise ValueError(f"unknown kind '{kind}'")
+		if order not in ORDERS:
+			raise ValueError(f"unknown order '{order}'")
+		from peewee import fn
+
+		self.flush()
+		self._ensure_table()
+		totals = [
+			fn.SUM(getattr(FileUsage, name)).alias(name) for name in ORDERS[:4]
+		] + [fn.MAX(FileUsage.last_access).alias("last_access")]
+		query = (FileUsage
+			.select(FileUsage.key, FileUsage.sandbox, *totals)
+			.where(FileUsage.kind == kind)
+			.group_by(FileUsage.sandbox, FileUsage.key)
+			.order_by(fn.SUM(getattr(FileUsage, order)).desc()
+				if order != "last_access"
+				else fn.MAX(FileUsage.last_access).desc())
+			.limit(limit)
+			.dicts())
+		if since is not None:
+			query = query.where(FileUsage.window > since - self.window)
+		if sandbox is not None:
+			query = query.where(FileUsage.sandbox == sandbox)
+		return list(query)
+
+	def history(
+		self,
+		kind: str,
+		key: str,
+		sandbox: Optional[str] = None,
+		since: Optional[float] = None,
+	) -> List[dict]:
+		"""
+		get the usage of a single path, extension, directory or sandbox
+		window by window, oldest first. buffered accesses are written
+		first.
+		"""
+
+		self.flush()
+		self._ensure_table()
+		query = (FileUsage.select()
+			.where((FileUsage.kind == kind) & (FileUsage.key == key))
+			.order_by(FileUsage.window)
+			.dicts())
+		if sandbox is not None:
+			query = query.where(FileUsage.sandbox == sandbox)
+		if since is not None:
+			query = query.where(FileUsage.window > since - self.window)
+		return list(query)
+
+	def _start_writer(self):
+		with self._flush_lock:
+			if self._writer is not None:
+				return
+			self._writer = threading.Thread(
+				target=self._write_loop, name="alexis-usage-writer", daemon=True
+			)
+			self._writer.start()
+
+	def _write_loop(self):
+		pruned = 0.0
+		while not self._stopped.is_set():
+			self._wakeup.wait(self.flush_interval)
+			self._wakeup.clear()
+			try:
+				self.flush()
+				if time.time() - pruned > self.window:
+					pruned = time.time()
+					self.prune()
+			except Exception as err:
+				logger.error("could not write file usage: %s", err)
+
+	def shutdown(self):
+		"""
+		stop the writer and write every buffered access
+		"""
+
+		self._stopped.set()
+		self._wakeup.set()
+		try:
+			self.flush()
+		except Exception as err:
+			logger.error("could not write file usage: %s", err)
+
+
+recorder = UsageRecorder()
+atexit.register(recorder.shutdown)
@@ -16,15 +16,25 @@ activate_sandbox(sandbox):
 deactivate_sandbox():
 	this function deactivates the active sandbox
 
-switch_sandbox(sandbox):
+prewarm_sandbox(sandbox):
+	this function syncs the most recently used files of a sandbox
+
+switch_sandbox(sandbox, prewarm):
 	this function deactivates the active sandbox and activates
 	the sandbox supplied
+
+Every sandbox has a cache namespace of its own, so switching only
+rewrites the active sandbox file. The caches, pooled connection and
+in-memory tier of the sandbox that was active are left alone, and
+switching back to it is just as quick.
 """
+import threading
 from typing import Optional as O
 
-from ..config import ACTIVE_SANDBOX_FILE
-from ..database import DB, Sandbox
+from .. import config
+from ..database import Sandbox
 from ..logger import logger
+from ..registry import registry
 
 
 def get_active_sandbox() -> O[Sandbox]:
@@ -37,27 +47,24 @@ def get_active_sandbox() -> O[Sandbox]:
 
     import os
 
-    if not os.path.exists(ACTIVE_SANDBOX_FILE):
-        logger.debug("active sandbox file %s missing", ACTIVE_SANDBOX_FILE)
+    # the registry only reads the file and the database again when
+    # they changed
+    name = registry.active_name()
+    if name is None:
         return None
-    with open(ACTIVE_SANDBOX_FILE, "r") as sb:
-        name = sb.readline().strip()
-        if not name:
-            logger.debug(
-                "active sandbox file %r is empty, deleting...",
-                ACTIVE_SANDBOX_FILE,
-            )
-            os.remove(ACTIVE_SANDBOX_FILE)
-            return None
-        logger.debug("read name %r from %s")
-    with DB.atomic():
-        query = Sandbox.select().where(Sandbox.name == name)
-        if not query:
-            logger.debug("could not find a sandbox name %r", name)
-            logger.debug("deleting active sandbox file...")
-            os.remove(ACTIVE_SANDBOX_FILE)
-            return None
-        return query.get()
+    if not name:
+        logger.debug(
+            "active sandbox file %r is empty, deleting...",
+            config.ACTIVE_SANDBOX_FILE,
+        )
+        os.remove(config.ACTIVE_SANDBOX_FILE)
+        return None
+    sandbox = registry.get(name)
+    if sandbox is None:
+        logger.debug("could not find a sandbox name %r", name)
+        logger.debug("deleting active sandbox file...")
+        os.remove(config.ACTIVE_SANDBOX_FILE)
+    return sandbox
 
 
 def activate_sandbox(sandbox: Sandbox):
@@ -75,9 +82,12 @@ def activate_sandbox(sandbox: Sandbox):
         if sandbox == active_sandbox:
             logger.info("Sandbox is already active")
             return
-    with open(ACTIVE_SANDBOX_FILE, "w+") as sb:
-        logger.debug("writing %r into %s", sandbox.name, ACTIVE_SANDBOX_FILE)
-        sb.write(sandbox.name)  # type: ignore
+    from ..mapping import write_file
+
+    # replace the file in one step, so no one reads it half written
+    logger.debug(
+        "writing %r into %s", sandbox.name, config.ACTIVE_SANDBOX_FILE)
+    write_file(config.ACTIVE_SANDBOX_FILE, sandbox.name.encode("utf-8"))  # type: ignore
     logger.info("%r is now the active sandbox", sandbox.host)
 
 
@@ -87,7 +97,69 @@ def deactivate_sandbox():
     """
     import os
 
-    if not os.path.exists(ACTIVE_SANDBOX_FILE):
-        logger.debug("active sandbox file %s missing", ACTIVE_SANDBOX_FILE)
+    if not os.path.exists(config.ACTIVE_SANDBOX_FILE):
+        logger.debug(
+            "active sandbox file %s missing", config.ACTIVE_SANDBOX_FILE)
     else:
-        os.remove(ACTIVE_SANDBOX_FILE)
+        os.remove(config.ACTIVE_SANDBOX_FILE)
+
+
+def prewarm_sandbox(
+    sandbox: Sandbox, limit: int = config.PREWARM_FILES
+) -> int:
+    """
+    open a pooled connection to a sandbox and sync its most recently used
+    files, so that they are fresh by the time it is active
+
+    Args:
+            sandbox: an instance of database.Sandbox
+            limit: the number of files to sync
+
+    Returns:
+            The number of files that had to be synced
+    """
+
+    from ..analytics import recorder
+    from ..cache import Cache
+    from ..connection import pool
+    from ..manifest import sync_caches
+    from ..remote import RemoteFile
+
+    pool.get(sandbox)
+    recent = recorder.top(
+        "path", sandbox=sandbox.name, order="last_access", limit=limit)
+    caches = [Cache(RemoteFile(sandbox, row["key"])) for row in recent]
+    return len(sync_caches(caches))
+
+
+def switch_sandbox(
+    sandbox: Sandbox, prewarm: bool = False
+) -> O[threading.Thread]:
+    """
+    make sandbox the active sandbox
+
+    Args:
+            sandbox: an instance of database.Sandbox
+            prewarm: pre-warm the sandbox in the background and only
+            switch to it once that is done, whether or not it worked
+
+    Returns:
+            The thread pre-warming the sandbox, or None if the switch
+            is already done
+    """
+
+    if not prewarm:
+        activate_sandbox(sandbox)
+        return None
+
+    def warm():
+        try:
+            synced = prewarm_sandbox(sandbox)
+            logger.debug("pre-warmed %r, synced %d files", sandbox.name, synced)
+        except Exception as err:
+            logger.warning("could not pre-warm %r: %s", sandbox.name, err)
+        activate_sandbox(sandbox)
+
+    thread = threading.Thread(target=warm, name="alexis-prewarm", daemon=True)
+    thread.start()
+    return thread
@@ -34,26 +34,23 @@ class AuthState(Enum):
     BADHOST = 2
 
 
-def has_internet_connection() -> bool:
+def is_reachable(host: str) -> bool:
     """
-    Test if internet connection is available by pinging a website.
+    Test if a sandbox host can be reached. The connectivity monitor's
+    cached state is used when it is fresh, so this rarely waits.
+
+    Args:
+            host: sandbox hostname
 
     Returns:
-            True if there is network connection, False otherwise.
+            True if the host can be reached, False otherwise.
     """
-    import requests
+    from ..network import monitor
 
-    with console.status("checking internet connection...") as status:
-        try:
-            logger.debug("pinging 8.8.8.8")
-            requests.get("https://8.8.8.8")
-            logger.debug("ping was successful")
-            status.update("internet connection ✔")
-            return True
-        except requests.exceptions.ConnectionError:
-            logger.debug("ping failed")
-            status.update("no internet connection ⚠")
-            return False
+    if (online := monitor.state(host)) is not None:
+        return online
+    with console.status(f"checking if [b cyan]{host}[/] can be reached..."):
+        return monitor.probe(host)
 
 
 def verify_auth(host: str, username: str, password: str) -> AuthState:
@@ -73,18 +70,15 @@ def verify_auth(host: str, username: str, password: str) -> AuthState:
             * `AuthState.BADHOST`: host not known
     """
 
-    from paramiko import AuthenticationException, AutoAddPolicy, SSHClient
+    from paramiko import AuthenticationException
+
+    from ..connection import pool
 
-    client = SSHClient()
-    client.set_missing_host_key_policy(AutoAddPolicy)
     try:
         with console.status(f"authenticating to [b cyan]{host}[/]..."):
-            client.connect(
-                hostname=host,
-                username=username,
-                password=password,
-                look_for_keys=False,
-            )
+            # the connection stays pooled so the next remote operation
+            # on this sandbox doesn't pay for the handshake again
+            pool.connect(host, username, password)
     except AuthenticationException as e:
         return AuthState.FAILURE
     except socket.gaierror as e:
@@ -13,11 +13,12 @@ from rich.prompt import Prompt
 
 from ..database import DB, Sandbox
 from ..logger import logger
+from ..registry import registry
 from .activate import activate_sandbox
 from .common import (
     SSH_HOST_PATTERN,
     AuthState,
-    has_internet_connection,
+    is_reachable,
     verify_auth,
 )
 from .prompts import get_host, get_password, get_username
@@ -42,16 +43,15 @@ def add_sandbox(host: str, username: str, password: str, name: O[str]):
             password: sandbox password
     """
     default = ""
-    sandboxes = Sandbox.select()
-    logger.debug("%d sandboxes found in database", sandboxes.count())
-    if not sandboxes:
-        if sandboxes.where(Sandbox.name == "default"):
+    logger.debug("%d sandboxes found in database", len(registry))
+    if not len(registry):
+        if "default" in registry:
             logger.debug("sandbox with name 'default' was found.")
         else:
             default = "default"
     if not default:
         hostname = SSH_HOST_PATTERN.match(host)["hostname"]  # type: ignore
-        if sandboxes.where(Sandbox.name == host):
+        if host in registry:
             logger.debug("sandbox with name '%s' was found.", host)
             default = ...
         else:
@@ -77,10 +77,7 @@ def is_logged_in(host: str):
 
     Returns: True if sandbox is logged in else False
     """
-    with DB.atomic():
-        if Sandbox.select().where(Sandbox.host == host):
-            return True
-    return False
+    return bool(registry.on_host(host))
 
 
 
@@ -98,10 +95,6 @@ def login(
 
     host_match: re.Match[str]
 
-    if not has_internet_connection():
-        logger.critical("no internet connection!")
-        return False
-
     if host:
         if not validate_host(host):
             return None
@@ -126,6 +119,10 @@ def login(
     if is_logged_in(host):
         logger.warning("sandbox is already logged in ⚠")
         return False
+
+    if not is_reachable(host):
+        logger.critical("%s can't be reached, check your connection!", host)
+        return False
     
     # verify authentication...
     status = verify_auth(host, username, password)
@@ -143,7 +140,7 @@ def login(
     # activate sandbox?
     if activate is None:
         activate = (True
-            if Sandbox.select().count() == 1
+            if len(registry) == 1
             else bool(Prompt.ask(
                 f"set [b cyan]{name}[/] as active sandbox?", default=True
             )))
@@ -1,8 +1,8 @@
 from typing import Any
 from typing import Optional as O
 
-from ..database import DB, Sandbox
 from ..logger import logger
+from ..registry import registry
 from .common import SSH_HOST_PATTERN
 
 
@@ -69,8 +69,7 @@ def validate_name(name: Any) -> bool:
     if not (isinstance(name, str) or name):
         logger.warning("sandbox name cannot be left blank!")
         return False
-    with DB.atomic():
-        if Sandbox.select().where(Sandbox.name == name).exists():
-            logger.warning("sandbox name %s already exists", name)
-            return False
+    if name in registry:
+        logger.warning("sandbox name %s already exists", name)
+        return False
     return True
@@ -0,0 +1,4 @@
+"""
+Benchmarks for alexis. Each module can be run with
+`python -m alexis.benchmarks.<module>`.
+"""
@@ -0,0 +1,374 @@
+"""
+This module contains an in-process stand-in for an ALX sandbox.
+
+`SandboxServer` is a paramiko ssh server that accepts any password,
+serves sftp for files under a temporary directory and runs exec
+commands with the local shell, which is all the sync path needs from a
+sandbox. Traffic between the client and the server goes through a
+simulated link with configurable latency and bandwidth, so transfers
+behave like they would over a real network.
+
+    with SandboxServer(latency=0.02, bandwidth=1 << 20) as server:
+        pool.port = server.port
+        ...
+
+CLASSES DECLARED
+================
+
+Link:
+	a simulated network link between two sockets
+
+SandboxServer:
+	an ssh and sftp server backed by a temporary directory
+"""
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+import paramiko
+
+_host_key: Optional[paramiko.RSAKey] = None
+
+
+def get_host_key() -> paramiko.RSAKey:
+	"""
+	get the server's host key. generating one is slow, so every server
+	shares the same key.
+	"""
+
+	global _host_key
+	if _host_key is None:
+		_host_key = paramiko.RSAKey.generate(2048)
+	return _host_key
+
+
+class Link:
+	"""This interface moves bytes between two sockets in both directions,
+	delivering each chunk `latency` seconds after it was sent and no
+	faster than `bandwidth` bytes per second. A bandwidth of 0 means the
+	link is not limited.
+	"""
+
+	def __init__(
+		self, a: socket.socket, b: socket.socket,
+		latency: float = 0.0, bandwidth: int = 0
+	):
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self._sockets = (a, b)
+		self._threads: List[threading.Thread] = []
+		for src, dst in ((a, b), (b, a)):
+			line: 'queue.Queue[Optional[tuple]]' = queue.Queue()
+			self._threads.append(threading.Thread(
+				target=self._read, args=(src, line), daemon=True))
+			self._threads.append(threading.Thread(
+				target=self._deliver, args=(dst, line), daemon=True))
+		for thread in self._threads:
+			thread.start()
+
+	def _read(self, src: socket.socket, line: 'queue.Queue'):
+		while True:
+			try:
+				chunk = src.recv(65536)
+			except OSError:
+				chunk = b""
+			line.put((time.monotonic() + self.latency, chunk))
+			if not chunk:
+				return
+
+	def _deliver(self, dst: socket.socket, line: 'queue.Queue'):
+		free_at = 0.0
+		while True:
+			due, chunk = line.get()
+			if not chunk:
+				self.close()
+				return
+			now = time.monotonic()
+			if self.bandwidth:
+				# the chunk can't leave before the previous one has
+				free_at = max(free_at, due) + len(chunk) / self.bandwidth
+				due = free_at
+			if due > now:
+				time.sleep(due - now)
+			try:
+				dst.sendall(chunk)
+			except OSError:
+				self.close()
+				return
+
+	def close(self):
+		for sock in self._sockets:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			sock.close()
+
+
+class _Server(paramiko.ServerInterface):
+	def __init__(self, sandbox: 'SandboxServer'):
+		self.sandbox = sandbox
+
+	def check_auth_password(self, username: str, password: str) -> int:
+		if self.sandbox.password is None or password == self.sandbox.password:
+			return paramiko.AUTH_SUCCESSFUL
+		return paramiko.AUTH_FAILED
+
+	def get_allowed_auths(self, username: str) -> str:
+		return "password"
+
+	def check_channel_request(self, kind: str, chanid: int) -> int:
+		if kind == "session":
+			return paramiko.OPEN_SUCCEEDED
+		return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+	def check_channel_exec_request(self, channel, command: bytes) -> bool:
+		threading.Thread(
+			target=self.sandbox._exec, args=(channel, command), daemon=True
+		).start()
+		return True
+
+
+class _Handle(paramiko.SFTPHandle):
+	def stat(self):
+		try:
+			return paramiko.SFTPAttributes.from_stat(
+				os.fstat(self.readfile.fileno()))
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	def chattr(self, attr):
+		return paramiko.SFTP_OK
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+	def __init__(self, server: _Server, *args, **kwargs):
+		super().__init__(server, *args, **kwargs)
+		self.root = server.sandbox.root
+
+	def _local(self, path: str) -> str:
+		path = os.path.realpath(path)
+		if path != self.root and not path.startswith(self.root + os.sep):
+			raise PermissionError(13, "outside the sandbox", path)
+		return path
+
+	def canonicalize(self, path: str) -> str:
+		return os.path.normpath(os.path.join(self.root, path))
+
+	def list_folder(self, path: str):
+		try:
+			path = self._local(path)
+			return [
+				paramiko.SFTPAttributes.from_stat(
+					os.lstat(os.path.join(path, name)), name)
+				for name in os.listdir(path)
+			]
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	def stat(self, path: str):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	lstat = stat
+
+	def open(self, path: str, flags: int, attr):
+		try:
+			path = self._local(path)
+			fd = os.open(path, flags, 0o644)
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		if flags & os.O_WRONLY:
+			mode = "ab" if flags & os.O_APPEND else "wb"
+		elif flags & os.O_RDWR:
+			mode = "a+b" if flags & os.O_APPEND else "r+b"
+		else:
+			mode = "rb"
+		handle = _Handle(flags)
+		handle.filename = path
+		handle.readfile = handle.writefile = os.fdopen(fd, mode)
+		return handle
+
+	def remove(self, path: str):
+		try:
+			os.remove(self._local(path))
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		return paramiko.SFTP_OK
+
+	def rename(self, oldpath: str, newpath: str):
+		try:
+			os.replace(self._local(oldpath), self._local(newpath))
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		return paramiko.SFTP_OK
+
+	posix_rename = rename
+
+	def mkdir(self, path: str, attr):
+		try:
+			os.mkdir(self._local(path))
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		return paramiko.SFTP_OK
+
+	def rmdir(self, path: str):
+		try:
+			os.rmdir(self._local(path))
+		except OSError as err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		return paramiko.SFTP_OK
+
+	def chattr(self, path: str, attr):
+		return paramiko.SFTP_OK
+
+
+class SandboxServer:
+	"""This interface runs a stand-in sandbox on a local port.
+
+	Files live under `root`, a temporary directory that is removed when
+	the server stops. Remote paths are local paths under `root`.
+	"""
+
+	root: str
+	"the directory the sandbox's files live in"
+
+	port: int
+	"the port the server listens on"
+
+	def __init__(
+		self,
+		latency: float = 0.0,
+		bandwidth: int = 0,
+		password: Optional[str] = None,
+		root: Optional[str] = None,
+	):
+		"""
+		Args:
+			latency: one way delay of the simulated link, in seconds
+			bandwidth: bytes per second in each direction, 0 for no limit
+			password: the only password accepted. any password is
+			accepted if it is None
+			root: the directory to serve. a temporary directory is created
+			if it is None
+		"""
+
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.password = password
+		self._owns_root = root is None
+		self.root = os.path.realpath(root or tempfile.mkdtemp(prefix="sandbox-"))
+		self.host = "127.0.0.1"
+		self.connections = 0
+		self._listener: Optional[socket.socket] = None
+		self._transports: List[paramiko.Transport] = []
+		self._stopped = threading.Event()
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def start(self):
+		"""
+		start listening for connections
+		"""
+
+		get_host_key()
+		self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._listener.bind((self.host, 0))
+		self._listener.listen(16)
+		self.port = self._listener.getsockname()[1]
+		threading.Thread(target=self._accept, daemon=True).start()
+
+	def _accept(self):
+		while not self._stopped.is_set():
+			try:
+				client, _ = self._listener.accept()
+			except OSError:
+				return
+			self.connections += 1
+			if self.latency or self.bandwidth:
+				near, far = socket.socketpair()
+				Link(client, far, self.latency, self.bandwidth)
+				client = near
+			transport = paramiko.Transport(client)
+			transport.add_server_key(get_host_key())
+			transport.set_subsystem_handler(
+				"sftp", paramiko.SFTPServer, _SFTPServer)
+			self._transports.append(transport)
+			# channels are never accepted: the transport holds on to them
+			# until the sftp and exec handlers, which hold them while they
+			# are in use, are done with them
+			try:
+				transport.start_server(server=_Server(self))
+			except (paramiko.SSHException, EOFError):
+				continue
+
+	def _exec(self, channel: paramiko.Channel, command: bytes):
+		process = subprocess.Popen(
+			["sh", "-c", command.decode("utf-8", "surrogateescape")],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE, cwd=self.root,
+		)
+
+		# the client only sends input once it has seen the reply to its
+		# exec request, so nothing is sent before the first input arrives
+		# lest the channel is closed before the reply goes out
+		ready = threading.Event()
+
+		def feed():
+			while True:
+				data = channel.recv(65536)
+				ready.set()
+				if not data:
+					break
+				process.stdin.write(data)
+			process.stdin.close()
+
+		def drain_stderr():
+			ready.wait()
+			for data in iter(lambda: process.stderr.read1(65536), b""):
+				channel.sendall_stderr(data)
+
+		helpers = [threading.Thread(target=feed, daemon=True),
+			threading.Thread(target=drain_stderr, daemon=True)]
+		for helper in helpers:
+			helper.start()
+		ready.wait()
+		for data in iter(lambda: process.stdout.read1(65536), b""):
+			channel.sendall(data)
+		helpers[1].join()
+		channel.send_exit_status(process.wait())
+		channel.close()
+
+	def path(self, *parts: str) -> str:
+		"""
+		get the remote path of a file in the sandbox
+		"""
+
+		return os.path.join(self.root, *parts)
+
+	def stop(self):
+		"""
+		close every connection and remove the sandbox's files
+		"""
+
+		self._stopped.set()
+		if self._listener is not None:
+			self._listener.close()
+		for transport in self._transports:
+			transport.close()
+		if self._owns_root:
+			shutil.rmtree(self.root, ignore_errors=True)
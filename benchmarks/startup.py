@@ -0,0 +1,84 @@
+"""
+This module benchmarks how long the cli takes to start.
+
+Every run starts a new interpreter, so the timings include the
+interpreter's own startup. The benchmark fails if the median run takes
+longer than the budget, and lists the slowest imports so the cause is
+easy to find.
+
+    python -m alexis.benchmarks.startup --budget 0.3 login --help
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+STARTUP_BUDGET = 0.3
+"Seconds the median cli startup may take"
+
+PACKAGE = (__package__ or "alexis.benchmarks").rsplit(".", 1)[0]
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(args: List[str]) -> float:
+	"""
+	run the cli once
+
+	Returns: the number of seconds the run took
+	"""
+
+	start = time.perf_counter()
+	subprocess.run(
+		[sys.executable, "-m", PACKAGE, *args],
+		cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+		check=True,
+	)
+	return time.perf_counter() - start
+
+
+def slowest_imports(args: List[str], count: int = 10) -> List[Tuple[int, str]]:
+	"""
+	Returns: the cumulative import time in microseconds and name of the
+	slowest top-level imports
+	"""
+
+	result = subprocess.run(
+		[sys.executable, "-X", "importtime", "-m", PACKAGE, *args],
+		cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+	)
+	imports = []
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "|" not in line:
+			continue
+		_, cumulative, name = line.split("|")
+		if not name.startswith("  ") and cumulative.strip().isdigit():
+			imports.append((int(cumulative), name.strip()))
+	return sorted(imports, reverse=True)[:count]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--runs", type=int, default=10)
+	parser.add_argument("--budget", type=float, default=STARTUP_BUDGET)
+	parser.add_argument("args", nargs="*", default=["--help"],
+		help="arguments passed to the cli")
+	options = parser.parse_args()
+
+	# the first run may do the one-time setup
+	run(options.args)
+	timings = [run(options.args) for _ in range(options.runs)]
+	median = statistics.median(timings)
+	print(f"startup: median {median * 1000:.1f}ms, "
+		f"min {min(timings) * 1000:.1f}ms over {options.runs} runs")
+	for cumulative, name in slowest_imports(options.args):
+		print(f"  {cumulative / 1000:8.1f}ms  {name}")
+	if median > options.budget:
+		print(f"startup is over its {options.budget * 1000:.0f}ms budget")
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,320 @@
+"""
+This module benchmarks the sync path end to end against a local stand-in
+sandbox (see `server.SandboxServer`).
+
+Each scenario is timed over several runs. Results are written as json
+so that a later run can be compared against them:
+
+    python -m alexis.benchmarks.sync --latency 20 --output before.json
+    python -m alexis.benchmarks.sync --latency 20 --compare before.json
+
+Comparing exits with a non-zero status if any scenario got slower by
+more than the threshold.
+
+SCENARIOS
+=========
+
+pull-small, pull-large:
+	the original changed; `Cache.open` brings the cache up to date
+
+push-small, push-large:
+	the cache changed; `Cache.open` brings the original up to date
+
+cold-open, warm-open:
+	`Cache.open` on a file that isn't cached, and on one that is
+
+many-small-files, few-large-files:
+	caching the same number of bytes spread over many or few files
+
+sandbox-switching:
+	opening files on two sandboxes in turn
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+from .server import SandboxServer
+
+SMALL = 4 * 1024
+"size of a small file"
+
+LARGE = 4 * 1024 * 1024
+"size of a large file"
+
+Scenario = Callable[['Environment'], int]
+"a single timed run of a scenario. it returns the number of bytes moved"
+
+
+class Environment:
+	"""This interface points the application at a temporary home and a
+	stand-in sandbox for the length of a benchmark. The application keeps
+	global state, so a process should only use one environment.
+	"""
+
+	def __init__(self, latency: float = 0.0, bandwidth: int = 0):
+		self.server = SandboxServer(latency=latency, bandwidth=bandwidth)
+		self.home = tempfile.mkdtemp(prefix="alexis-bench-")
+		self.sandboxes: list = []
+		self._counter = 0
+
+	def __enter__(self):
+		from .. import config
+
+		for name in ("CACHE_DIR", "METADATA_DIR", "DATA_DIR", "CHECKPOINT_DIR"):
+			path = os.path.join(self.home, name.lower())
+			os.makedirs(path)
+			setattr(config, name, path)
+		config.JOURNAL_FILE = os.path.join(config.DATA_DIR, "journal")
+		config.METRICS_FILE = os.path.join(config.DATA_DIR, "metrics.json")
+
+		from ..connection import pool
+		from ..database import DB, MODELS, Sandbox
+		from ..network import monitor
+
+		DB.init(os.path.join(self.home, "alexis.sql"))
+		DB.create_tables(MODELS)
+		self.server.start()
+		pool.port = monitor.port = self.server.port
+		for name in ("first", "second"):
+			os.makedirs(self.server.path(name))
+			self.sandboxes.append(Sandbox.create(
+				name=name, host=self.server.host, username=name, password=name))
+		return self
+
+	def __exit__(self, *exc):
+		from ..analytics import recorder
+		from ..connection import pool
+		from ..metastore import store
+		from ..metrics import metrics
+		from ..sync import engine
+
+		engine.stop()
+		store.flush()
+		recorder.shutdown()
+		# the metrics file goes with the temporary home
+		metrics.enabled = False
+		pool.close()
+		self.server.stop()
+		shutil.rmtree(self.home, ignore_errors=True)
+
+	def remote(self, size: int, sandbox: int = 0, name: Optional[str] = None):
+		"""
+		create a file of `size` random bytes on a sandbox
+
+		Returns: the file as a remote.RemoteFile
+		"""
+
+		from ..remote import RemoteFile
+
+		if name is None:
+			self._counter += 1
+			name = f"file-{self._counter}"
+		sandbox = self.sandboxes[sandbox]
+		path = self.server.path(sandbox.name, name)
+		with open(path, "wb") as f:
+			f.write(os.urandom(size))
+		return RemoteFile(sandbox, path)
+
+	def cached(self, size: int, sandbox: int = 0):
+		"""
+		create a file on a sandbox and cache it
+
+		Returns: the synced cache.Cache
+		"""
+
+		from ..cache import Cache
+
+		cache = Cache(self.remote(size, sandbox))
+		cache.open()
+		return cache
+
+
+def touch_remote(path: str, size: int, change: int):
+	"""
+	change `change` bytes in the middle of a file on the stand-in sandbox,
+	moving its mtime forward
+	"""
+
+	with open(path, "r+b") as f:
+		f.seek(size // 2)
+		f.write(os.urandom(change))
+	stat = os.stat(path)
+	os.utime(path, (stat.st_atime, time.time() + 1))
+
+
+def pull(size: int) -> Callable[[Environment], Scenario]:
+	def setup(env: Environment) -> Scenario:
+		cache = env.cached(size)
+
+		def run(env: Environment) -> int:
+			touch_remote(cache.file.path, size, 64)
+			cache.open()
+			return size
+		return run
+	return setup
+
+
+def push(size: int) -> Callable[[Environment], Scenario]:
+	def setup(env: Environment) -> Scenario:
+		cache = env.cached(size)
+
+		def run(env: Environment) -> int:
+			data = bytearray(cache.read_bytes())
+			data[size // 2:size // 2 + 64] = os.urandom(64)
+			cache.write(bytes(data))
+			cache.open()
+			return size
+		return run
+	return setup
+
+
+def cold_open(env: Environment) -> Scenario:
+	def run(env: Environment) -> int:
+		env.cached(SMALL)
+		return SMALL
+	return run
+
+
+def warm_open(env: Environment) -> Scenario:
+	cache = env.cached(SMALL)
+
+	def run(env: Environment) -> int:
+		cache.open()
+		return 0
+	return run
+
+
+def spread(count: int, size: int) -> Callable[[Environment], Scenario]:
+	def setup(env: Environment) -> Scenario:
+		def run(env: Environment) -> int:
+			for _ in range(count):
+				env.cached(size)
+			return count * size
+		return run
+	return setup
+
+
+def sandbox_switching(env: Environment) -> Scenario:
+	caches = [env.cached(SMALL, 0), env.cached(SMALL, 1)]
+
+	def run(env: Environment) -> int:
+		for _ in range(10):
+			for cache in caches:
+				touch_remote(cache.file.path, SMALL, 16)
+				cache.open()
+		return 20 * SMALL
+	return run
+
+
+SCENARIOS: Dict[str, Callable[[Environment], Scenario]] = {
+	"pull-small": pull(SMALL),
+	"pull-large": pull(LARGE),
+	"push-small": push(SMALL),
+	"push-large": push(LARGE),
+	"cold-open": cold_open,
+	"warm-open": warm_open,
+	"many-small-files": spread(64, 16 * 1024),
+	"few-large-files": spread(2, 512 * 1024),
+	"sandbox-switching": sandbox_switching,
+}
+
+
+def measure(
+	name: str, env: Environment, runs: int
+) -> Dict[str, float]:
+	"""
+	time a scenario
+
+	Returns: the scenario's timings in seconds and throughput
+	"""
+
+	run = SCENARIOS[name](env)
+	timings, moved = [], 0
+	for _ in range(runs):
+		start = time.perf_counter()
+		moved += run(env)
+		timings.append(time.perf_counter() - start)
+	total = sum(timings)
+	return dict(
+		runs=runs,
+		median=statistics.median(timings),
+		mean=statistics.mean(timings),
+		min=min(timings),
+		max=max(timings),
+		bytes_per_second=moved / total if total else 0.0,
+	)
+
+
+def compare(
+	results: Dict[str, dict], baseline: Dict[str, dict], threshold: float
+) -> List[str]:
+	"""
+	Returns: the scenarios whose median got slower than the baseline's
+	by more than `threshold` (0.1 is 10%)
+	"""
+
+	regressions = []
+	for name, result in results.items():
+		before = baseline.get(name)
+		if before is None or not before["median"]:
+			continue
+		change = result["median"] / before["median"] - 1
+		print(f"  {name:20} {change:+7.1%}")
+		if change > threshold:
+			regressions.append(name)
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--latency", type=float, default=0.0,
+		help="one way latency of the simulated link, in milliseconds")
+	parser.add_argument("--bandwidth", type=int, default=0,
+		help="bandwidth of the simulated link, in bytes per second")
+	parser.add_argument("--runs", type=int, default=5)
+	parser.add_argument("--scenario", "-s", action="append",
+		choices=sorted(SCENARIOS), help="only run these scenarios")
+	parser.add_argument("--output", "-o", help="write the results to a json file")
+	parser.add_argument("--compare", "-c", help="compare with earlier results")
+	parser.add_argument("--threshold", type=float, default=0.1,
+		help="slowdown that counts as a regression, 0.1 is 10%%")
+	options = parser.parse_args()
+
+	from ..logger import logger
+
+	logger.setLevel("WARNING")
+	results = {}
+	with Environment(options.latency / 1000, options.bandwidth) as env:
+		for name in options.scenario or SCENARIOS:
+			results[name] = result = measure(name, env, options.runs)
+			print(f"{name:20} median {result['median'] * 1000:9.1f}ms  "
+				f"{result['bytes_per_second'] / 1024:10.1f} KiB/s")
+
+	report = dict(
+		link=dict(latency=options.latency, bandwidth=options.bandwidth),
+		python=platform.python_version(),
+		platform=platform.platform(),
+		time=time.time(),
+		results=results,
+	)
+	if options.output:
+		with open(options.output, "w") as f:
+			json.dump(report, f, indent=2)
+	if options.compare:
+		with open(options.compare, "r") as f:
+			baseline = json.load(f)["results"]
+		regressions = compare(results, baseline, options.threshold)
+		if regressions:
+			print("regressed: " + ", ".join(regressions))
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,22 +1,42 @@
 import os
 from dataclasses import dataclass
-from typing import Callable, Optional, Type
+from enum import Enum
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, Type
 from datetime import datetime
-import config
-import json
-from logger import logger
-from typedef import FileType, TimeStamp
+from . import config, delta, transfer
+from .analytics import recorder
+from .compression import compressor, get_codec, get_compressed_location
+from .logger import logger
+from .journal import APPEND, DELETE, WRITE, journal
+from .mapping import mappings, partial_path, write_file
+from .memory import tier
+from .metrics import metrics
+from .metastore import store
+from .network import monitor
+from .snapshot import snapshots
+from .sync import engine
+from .typedef import FileType, StatType, TimeStamp
+
+if TYPE_CHECKING:
+	from .caching import CacheManager
+
+
+def get_cache_hash(path: str, sandbox: Optional[str] = None) -> str:
+	"""generate a unique hash for the cache. every sandbox has a namespace
+	of its own, so the same path on two sandboxes gets two caches.
 
+	Args:
+		path: the path of the original
+		sandbox: the name of the sandbox the original lives on, None for
+		local files
 
-def get_cache_hash(path: str) -> str:
-	"""generate a unique hash for the cache
-	
-	NOTE: the hash should always be the same for the same <path>
+	NOTE: the hash should always be the same for the same <sandbox> and <path>
 	"""
 
 	import hashlib
 
-	return hashlib.sha1(path.encode("utf-8")).hexdigest()
+	key = path if sandbox is None else f"{sandbox}:{path}"
+	return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
 
 def get_cache_location(hash: str) -> str:
@@ -31,16 +51,30 @@ def get_cache_location(hash: str) -> str:
 	return os.path.join(config.CACHE_DIR, hash)
 
 
-def get_metadata_location(hash: str) -> str:
+def cache_exists(hash: str) -> bool:
 	"""
-	get the path where the metadata would be stored
+	check whether a cache holds contents, in memory, on disk or
+	compressed, without creating it
 
 	Args:
 		hash: the file's unique hash
 	"""
 
-	return os.path.join(config.METADATA_DIR, hash + ".json")
+	return (hash in tier or os.path.isfile(get_cache_location(hash))
+		or os.path.isfile(get_compressed_location(hash)))
+
+
+class CacheState(Enum):
+	"""Different states of a cache file
 
+	* MODIFIED: the cache has been modified but not saved
+	* STAGED: the cache has been saved but not synced with the original
+	* SYNCED: the cache has been synced with the original
+	"""
+
+	MODIFIED = 0
+	STAGED = 1
+	SYNCED = 2
 
 
 class Metadata:
@@ -66,6 +100,12 @@ class Metadata:
 	modified_at: TimeStamp
 	"a timestamp showing when the cache was last modified"
 
+	sandbox: Optional[str]
+	"the name of the sandbox the original file lives on"
+
+	codec: int
+	"the codec the cache is compressed with, 0 if it isn't compressed"
+
 	def __init__(self, cache: 'Cache', file: 'FileType'):
 		"""
 		initialize the metadata for a cache
@@ -73,18 +113,20 @@ class Metadata:
 		self.hash = cache.hash
 		self.origin = file.path
 		self.name = file.name
-		location = get_metadata_location(cache.hash)
+		sandbox = getattr(file, "sandbox", None)
+		self.sandbox = sandbox.name if sandbox is not None else None
+		self.codec = 0
 
-		file_stat = os.stat(cache.path)
-		self.created_at = file_stat.st_ctime
-		self.modified_at = file_stat.st_mtime
-
-		if os.path.isfile(location):
-			with open(location, 'r') as f:
-				self.json = json.load(f)
+		row = store.load(cache.hash)
+		if row is not None:
+			self.json = row
 			return
+		# a cache without metadata has never been synced, so it must not
+		# look newer than the original (or be pinned as staged)
+		self.created_at = datetime.now().timestamp()
 		self.last_sync = 0.0
-		
+		self.modified_at = 0.0
+
 	@property
 	def json(self):
 		"""
@@ -93,8 +135,9 @@ class Metadata:
 
 		return dict(
 			hash=self.hash, origin=self.origin, name=self.name,
-			created_at=self.created_at, last_sync=self.last_sync,
-			modified_at=self.modified_at
+			sandbox=self.sandbox, created_at=self.created_at,
+			last_sync=self.last_sync, modified_at=self.modified_at,
+			state=self.state.value, codec=self.codec
 		)
 
 	@json.setter
@@ -103,20 +146,32 @@ class Metadata:
 		update the metadata from a dictionary
 		"""
 
+		self.created_at = value['created_at']
 		self.last_sync = value['last_sync']
+		self.modified_at = value['modified_at']
+		self.codec = value.get('codec') or 0
+
+	@property
+	def state(self) -> CacheState:
+		"""
+		the state of the cache, derived from its timestamps
+		"""
 
+		if self.modified_at > self.last_sync:
+			return CacheState.STAGED
+		return CacheState.SYNCED
 
 	def save(self):
 		"""
-		write contents in metadata to a file
+		queue the metadata to be written to the metadata store. the codec
+		is owned by the compressor, so it is taken from the store rather
+		than from this object.
 		"""
-	
-		location = get_metadata_location(self.hash)
-		with open(location, "w+") as f:
-			logger.debug("saving metadata for '%s' in '%s'", self.origin, location)
-			json.dump(self.json, f)
-		logger.debug("metadata saved")
-		
+
+		logger.debug("saving metadata for '%s'", self.origin)
+		self.codec = get_codec(self.hash)
+		store.save(self.json)
+
 	def update_sync(self, ts: Optional[TimeStamp] = None):
 		"""
 		update last_sync on the metadata. If ts(timestamp) is not
@@ -126,6 +181,7 @@ class Metadata:
 			self.last_sync = ts
 		else:
 			self.last_sync = datetime.now().timestamp() - 0.001
+		self.save()
 	
 	def update_modified(self, ts: Optional[TimeStamp] = None):
 		"""
@@ -136,6 +192,7 @@ class Metadata:
 			self.modified_at = ts
 		else:
 			self.modified_at = datetime.now().timestamp() - 0.001
+		self.save()
 	
 
 
@@ -161,6 +218,9 @@ class Cache:
 	file: 'FileType'
 	"the cached file"
 
+	manager: 'CacheManager'
+	"the manager that keeps track of this cache"
+
 	def __init__(self, file: FileType):
 		"""
 		initialize a new cache object. this object could be for a new cache file
@@ -170,41 +230,160 @@ class Cache:
 			file: a file object. this object represents the file to cache
 		"""
 		self.file = file
-		self.hash = get_cache_hash(file.path)
+		sandbox = getattr(file, "sandbox", None)
+		self.hash = get_cache_hash(
+			file.path, sandbox.name if sandbox is not None else None)
 		self.name = file.name
 		self.path = get_cache_location(self.hash)
 		logger.debug("cache '%s' for '%s'", self.hash, file.path)
 		if os.path.isfile(self.path):
-			logger.info("cache '%s' already exists", hash)
+			logger.debug("cache '%s' already exists", self.hash)
+		elif os.path.isfile(get_compressed_location(self.hash)):
+			logger.debug("cache '%s' exists and is compressed", self.hash)
 		else:
-			logger.info("creating cache '%s'", self.hash)
+			logger.debug("creating cache '%s'", self.hash)
+			metrics.inc("cache.misses")
 			try:
 				open(self.path, 'w+').close()
 			except Exception as err:
 				logger.error(err)
 		self.meta = Metadata(self, file)
-		
+		self._syncing = False
+		self._touched = False
+
+		from .caching import manager
+		self.manager = manager
+		self.manager.track(self)
+
+	@property
+	def state(self) -> CacheState:
+		"""
+		the state of the cache. a cache with changes that only live in
+		memory is modified.
+		"""
 
-	def open(self):
+		if tier.is_dirty(self.hash):
+			return CacheState.MODIFIED
+		return self.meta.state
+
+	def flush(self):
+		"""
+		write changes held in memory back to the cache file
 		"""
-		opens the cache and does syncing
+
+		if tier.flush(self.hash):
+			self.manager.track(self)
+
+	def needs_sync(self, file_stat: StatType) -> bool:
 		"""
-		file_stat = self.file.stat()
-		logger.debug("file stat: created = '%s', modified = '%s'",
-					datetime.fromtimestamp(file_stat.st_ctime),
+		Args:
+			file_stat: the stat of the original
+
+		Returns: True if the cache or its original changed since the
+		last sync
+		"""
+
+		return (file_stat.st_mtime > self.meta.last_sync
+			or self.meta.modified_at > self.meta.last_sync)
+
+	def open(self, file_stat: Optional[StatType] = None) -> bool:
+		"""
+		opens the cache and does syncing. the sync goes through the sync
+		engine, ahead of background syncs and never at the same time as
+		another sync of the cache.
+
+		Args:
+			file_stat: the stat of the original, if it is already known.
+			the cache is then synced right away, on this thread
+
+		Returns: True if the cache is in sync with its original, False if
+		it could not be synced
+		"""
+
+		if file_stat is not None:
+			self.sync(file_stat)
+			return True
+		return engine.sync(self)
+
+	def sync(self, file_stat: Optional[StatType] = None):
+		"""
+		bring the cache and its original up to date with each other, on
+		this thread
+
+		Args:
+			file_stat: the stat of the original, if it is already known
+		"""
+
+		if file_stat is None:
+			file_stat = self.file.stat()
+		if not self.needs_sync(file_stat):
+			metrics.inc("cache.fresh")
+			self._touch()
+			return
+		# sftp stats have no st_ctime
+		logger.debug("file stat: modified = '%s'",
 					datetime.fromtimestamp(file_stat.st_mtime))
-		if self.meta.modified_at < file_stat.st_mtime:
-			logger.info("origin newer, overwriting cache")
-			self.write(self.file.read())
-		elif self.meta.modified_at > file_stat.st_mtime:
-			logger.info("cache newer, overwriting origin")
-			self.file.write(self.read())
+		upto = journal.watermark()
+		self._syncing = True
+		try:
+			with metrics.span("cache.sync", file=self.name):
+				if self.meta.modified_at < file_stat.st_mtime:
+					logger.info("origin newer, overwriting cache")
+					metrics.inc("cache.pulls")
+					self.flush()
+					with metrics.span("delta.pull"):
+						data = delta.pull(self, file_stat.st_size)
+					if data is None:
+						self._pull(file_stat.st_size)
+					else:
+						self.write(data)
+				elif self.meta.modified_at > file_stat.st_mtime:
+					logger.info("cache newer, overwriting origin")
+					metrics.inc("cache.pushes")
+					with metrics.span("delta.push"):
+						pushed = delta.push(self)
+					if not pushed:
+						self.file.write_stream(self.iter_bytes())
+			self.flush()
+			self.mark_synced(upto)
+			if config.SNAPSHOT_ON_SYNC:
+				snapshots.schedule(self)
+		finally:
+			self._syncing = False
+
+	def recreate_original(self):
+		"""
+		write the cache to its original, creating the original if it was
+		deleted, and record that they are in sync
+		"""
+
+		upto = journal.watermark()
+		self._syncing = True
+		try:
+			with metrics.span("cache.sync", file=self.name):
+				metrics.inc("cache.pushes")
+				self.flush()
+				self.file.write_stream(self.iter_bytes())
+			self.mark_synced(upto)
+		finally:
+			self._syncing = False
+
+	def mark_synced(self, upto: Optional[int] = None):
+		"""
+		record that the cache and its original now have the same contents
+
+		Args:
+			upto: the journal's watermark from before the sync began.
+				changes recorded after it stay pending.
+		"""
+
 		self.meta.update_sync()
 		self.meta.update_modified(self.meta.last_sync)
-	
+		self.manager.track(self)
+		journal.commit(self.hash, upto=upto)
 
 	def read(self, size: Optional[int]=None) -> str:
-		"""read the contents of the cache.
+		"""read the contents of the cache as text.
 
 		Args:
 			size: the number of bytes to read from the cache
@@ -213,34 +392,263 @@ class Cache:
 			The contents of the cache
 		"""
 
-		with open(self.path, "r") as cachefile:
+		return self.read_bytes(size).decode("utf-8")
+
+	def read_bytes(self, size: Optional[int]=None) -> bytes:
+		"""read the raw contents of the cache.
+
+		Args:
+			size: the number of bytes to read from the cache
+
+		Returns:
+			The contents of the cache
+		"""
+
+		contents = tier.get(self.hash)
+		if contents is not None:
+			metrics.inc("cache.hits.memory")
+			if size is not None:
+				contents = contents[:size]
+			self._used(len(contents))
+			return contents
+		try:
+			with open(self.path, "rb") as cachefile:
+				contents = cachefile.read(-1 if size is None else size)
+			metrics.inc("cache.hits.disk")
+		except FileNotFoundError:
+			contents = self._inflate()
+			metrics.inc("cache.hits.compressed")
 			if size is not None:
-				contents = cachefile.read(size)
-			else:
-				contents = cachefile.read()
+				contents = contents[:size]
+		if size is None and tier.record(self.hash):
+			tier.promote(self.hash, self.path, contents)
+		self._used(len(contents))
 		return contents
 
-	def append(self, content: str):
-		"""add new text to the cache without truncating
+	def iter_bytes(
+		self, chunk_size: int = config.IO_CHUNK_SIZE
+	) -> Iterator[memoryview]:
+		"""stream the raw contents of the cache in chunks of at most
+		`chunk_size` bytes. the chunks are slices of the cache's memory
+		mapping, so nothing is copied.
+
+		Args:
+			chunk_size: the size of each chunk
+		"""
+
+		view = self.view()
+		for offset in range(0, len(view), chunk_size):
+			yield view[offset:offset + chunk_size]
+
+	def view(self, offset: int = 0, size: Optional[int] = None) -> memoryview:
+		"""get a read-only, zero-copy view of the contents of the cache.
+		the cache file stays mapped between calls; a view taken before the
+		cache is rewritten keeps showing the old contents.
+
+		Args:
+			offset: the position of the first byte of the view
+			size: the number of bytes in the view. defaults to the rest of
+			the cache
+
+		Returns:
+			a memoryview that can be sliced or sent without copying
+		"""
+
+		self.flush()
+		try:
+			view = mappings.view(self.path)
+		except FileNotFoundError:
+			self._inflate()
+			view = mappings.view(self.path)
+		end = len(view) if size is None else offset + size
+		view = view[offset:end]
+		self._used(len(view))
+		return view
+
+	def append(self, content: 'str | bytes'):
+		"""add new content to the cache without truncating
 		the existing contents of the cache.
 		All appended content would be added after the existing content
 		in the file.
 
 		Args:
-			content: text to add to the file
+			content: text or bytes to add to the file
 		"""
 
-		with open(self.path, "a") as cachefile:
-			cachefile.write(content)
-		self.meta.update_modified()
-	
-	def write(self, content: str):
+		if isinstance(content, str):
+			content = content.encode("utf-8")
+		self._journal(APPEND)
+		if not tier.append(self.hash, content):
+			with compressor.lock:
+				if not os.path.isfile(self.path):
+					self._inflate()
+				with open(self.path, "ab") as cachefile:
+					cachefile.write(content)
+			mappings.invalidate(self.path)
+			tier.record(self.hash)
+		self._used(len(content), written=True)
+		self._modified()
+
+	def write(self, content: 'str | bytes'):
 		"""overwrite contents in cache with new content
 
 		Args:
-			content: text to write to the file
+			content: text or bytes to write to the file
+		"""
+
+		if isinstance(content, str):
+			content = content.encode("utf-8")
+		self._journal(WRITE)
+		in_memory = tier.write(self.hash, content) or (
+			tier.record(self.hash)
+			and tier.promote(self.hash, self.path, content, dirty=True)
+		)
+		if not in_memory:
+			with compressor.lock:
+				write_file(self.path, content)
+				compressor.discard(self.hash)
+		self._used(len(content), written=True)
+		self._modified()
+
+	def write_stream(self, chunks: Iterable[bytes]):
+		"""overwrite contents in cache with a stream of chunks, in
+		constant memory. the cache is replaced only once the stream is
+		complete.
+
+		Args:
+			chunks: an iterable of bytes-like objects
+		"""
+
+		def fill(partial: str) -> int:
+			size = 0
+			with open(partial, "wb") as cachefile:
+				for chunk in chunks:
+					size += cachefile.write(chunk)
+			return size
+
+		self._replace(fill)
+
+	def _pull(self, size: int):
+		"""
+		replace the contents of the cache with its original. originals on
+		a sandbox are downloaded with pipelined, range-parallel reads.
+
+		Args:
+			size: the size of the original in bytes
+		"""
+
+		if getattr(self.file, "sandbox", None) is None:
+			self.write_stream(self.file.iter_bytes())
+			return
+		self._replace(
+			lambda partial: transfer.download(self.file, partial, size))
+
+	def _replace(self, fill: Callable[[str], int]):
+		"""
+		replace the contents of the cache with a file written by `fill`,
+		which is given the path to write and returns the number of bytes
+		written. the cache is replaced only once `fill` returns.
+		"""
+
+		self._journal(WRITE)
+		partial = partial_path(self.path)
+		try:
+			size = fill(partial)
+		except BaseException:
+			try:
+				os.remove(partial)
+			except FileNotFoundError:
+				pass
+			raise
+		tier.discard(self.hash)
+		with compressor.lock:
+			os.replace(partial, self.path)
+			compressor.discard(self.hash)
+		mappings.invalidate(self.path)
+		self._used(size, written=True)
+		self._modified()
+
+	def delete(self):
+		"""delete the original and the cache. if the sandbox can't be
+		reached, the original is deleted once it can.
+		"""
+
+		self._journal(DELETE)
+		if self.meta.sandbox is None:
+			try:
+				os.remove(self.file.path)
+			except FileNotFoundError:
+				pass
+		self.manager.untrack(self.hash)
+		tier.discard(self.hash)
+		store.delete(self.hash)
+		mappings.invalidate(self.path)
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+		compressor.discard(self.hash)
+		host = getattr(getattr(self.file, "sandbox", None), "host", None)
+		if host is None:
+			return
+		if monitor.is_online(host):
+			journal.replay(self.meta.sandbox, [self.hash])
+		else:
+			# replayed by the journal once the host is back
+			monitor.watch(host)
+
+	def _inflate(self) -> bytes:
 		"""
+		restore the raw file of a cache that was compressed while it
+		was cold
+
+		Returns: the contents of the cache
+
+		Raises:
+			FileNotFoundError: if the cache is not compressed either
+		"""
+
+		contents = compressor.inflate(self.hash)
+		if contents is None:
+			raise FileNotFoundError(self.path)
+		self.manager.track(self)
+		return contents
+
+	def _journal(self, op: str):
+		"""
+		record a change in the journal before it is made, unless it is
+		the cache being updated from its original
+		"""
+
+		if self.meta.sandbox is not None and not self._syncing:
+			journal.record(op, self.hash, self.meta.sandbox, self.file.path)
+
+	def _used(self, size: int, written: bool = False):
+		"""
+		record a use of the cache for eviction and usage analytics, unless
+		it is the cache being synced
+		"""
+
+		if self._syncing:
+			return
+		self._touch()
+		if written:
+			recorder.write(self, size)
+		else:
+			recorder.read(self, size)
+
+	def _touch(self):
+		"""
+		record a use of the cache with the manager. only the first use of
+		this cache object counts as a hit, so opening a file and reading it
+		is one reference to it, not two.
+		"""
+
+		self.manager.touch(self.hash, hit=not self._touched)
+		self._touched = True
 
-		with open(self.path, "w") as cachefile:
-			cachefile.write(content)
+	def _modified(self):
 		self.meta.update_modified()
+		self.manager.track(self)
+		if not self._syncing:
+			engine.schedule(self)
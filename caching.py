@@ -0,0 +1,394 @@
+"""
+This module contains the cache manager.
+
+The cache manager keeps track of every cache file in `config.CACHE_DIR`
+and evicts caches when the cache grows beyond its byte or entry budget.
+Which caches go first is decided by the eviction policy of their sandbox
+(see `eviction`). The budget is shared, so when it is exceeded the
+sandbox whose synced caches take up the most of it gives up a cache, and
+its policy picks which. Only synced caches are ever evicted; modified and
+staged caches hold changes that have not reached the original yet.
+Synced caches that go unused are handed to the compression tier.
+
+CLASSES DECLARED
+================
+
+CacheEntry:
+	the bookkeeping the manager keeps for a single cache file
+
+CacheManager:
+	tracks cache files and enforces the cache budget
+
+OBJECTS DECLARED
+================
+
+manager:
+	the application wide cache manager
+"""
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from . import config
+from .cache import CacheState, get_cache_location
+from .compression import SUFFIX, compressor, get_compressed_location
+from .eviction import EvictionPolicy, LRUPolicy, get_policy
+from .logger import logger
+from .mapping import mappings
+from .memory import tier
+from .metrics import metrics
+from .metastore import store
+
+if TYPE_CHECKING:
+	from .cache import Cache
+
+
+class CacheEntry:
+	"""This interface represents a cache file tracked by the manager.
+	"""
+
+	__slots__ = (
+		"hash", "size", "state", "sandbox", "accessed", "hits", "compressed")
+
+	hash: str
+	"the cache's hash"
+
+	size: int
+	"the size of the cache file in bytes"
+
+	state: CacheState
+	"the state of the cache"
+
+	sandbox: Optional[str]
+	"the name of the sandbox the original lives on"
+
+	accessed: float
+	"a timestamp showing when the cache was last used"
+
+	hits: int
+	"the number of times the cache was used since it was tracked"
+
+	compressed: bool
+	"True if the cache is in the compression tier"
+
+	def __init__(
+		self, hash: str, size: int, state: CacheState,
+		sandbox: Optional[str] = None, accessed: Optional[float] = None,
+		compressed: bool = False
+	):
+		self.hash = hash
+		self.size = size
+		self.state = state
+		self.sandbox = sandbox
+		self.accessed = time.time() if accessed is None else accessed
+		self.hits = 0
+		self.compressed = compressed
+
+	@property
+	def evictable(self) -> bool:
+		return self.state is CacheState.SYNCED
+
+
+class CacheManager:
+	"""This interface keeps the cache directory within its budget.
+
+	Synced entries are ordered by the eviction policy of their sandbox.
+	When the cache is over budget every policy proposes a victim and the
+	least recently used of them is evicted, so sandboxes that all use LRU
+	share a single LRU. Modified and staged entries are kept away from the
+	policies and are never evicted.
+	"""
+
+	max_bytes: int
+	"the number of bytes the cache may hold"
+
+	max_entries: int
+	"the number of files the cache may hold"
+
+	size: int
+	"the number of bytes the cache currently holds"
+
+	evictions: int
+	"the number of entries evicted so far"
+
+	def __init__(
+		self,
+		max_bytes: int = config.CACHE_MAX_BYTES,
+		max_entries: int = config.CACHE_MAX_ENTRIES,
+	):
+		self.max_bytes = max_bytes
+		self.max_entries = max_entries
+		self.size = 0
+		self.evictions = 0
+		self._entries: Dict[str, CacheEntry] = {}
+		self._policies: Dict[Optional[str], EvictionPolicy] = {}
+		self._held: Dict[Optional[str], int] = {}
+		self._loaded = False
+		self._lock = threading.RLock()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def __contains__(self, hash: str) -> bool:
+		return hash in self._entries
+
+	def get(self, hash: str) -> Optional[CacheEntry]:
+		"""
+		get the entry tracked for a cache hash
+		"""
+
+		return self._entries.get(hash)
+
+	def policy(self, sandbox: Optional[str]) -> EvictionPolicy:
+		"""
+		get the eviction policy of a sandbox. sandboxes configured with a
+		policy that doesn't exist fall back to LRU.
+		"""
+
+		policy = self._policies.get(sandbox)
+		if policy is None:
+			try:
+				policy = get_policy(sandbox)
+			except ValueError as err:
+				logger.error("%s; using lru for '%s'", err, sandbox)
+				policy = LRUPolicy()
+			self._policies[sandbox] = policy
+		return policy
+
+	def load(self):
+		"""
+		track the cache files that already exist in the cache directory.
+		files are ordered by their last access time.
+		"""
+
+		with self._lock:
+			self._loaded = True
+			if not os.path.isdir(config.CACHE_DIR):
+				return
+			raw, packed = {}, {}
+			with os.scandir(config.CACHE_DIR) as it:
+				for entry in it:
+					if not entry.is_file() or entry.name.endswith(".part"):
+						continue
+					if entry.name.endswith(SUFFIX):
+						packed[entry.name[:-len(SUFFIX)]] = entry.stat()
+					else:
+						raw[entry.name] = entry.stat()
+			found = [(stat, hash, False) for hash, stat in raw.items()]
+			for hash, stat in packed.items():
+				if hash in raw:
+					# the raw file was restored after the cache was
+					# compressed; the compressed copy is stale
+					compressor.discard(hash)
+				else:
+					found.append((stat, hash, True))
+			found.sort(key=lambda item: item[0].st_atime)
+			index = store.index()
+			for stat, hash, compressed in found:
+				if hash in self:
+					continue
+				state, sandbox = index.get(hash, (CacheState.SYNCED.value, None))
+				self._insert(CacheEntry(hash, stat.st_size, CacheState(state),
+					sandbox, stat.st_atime, compressed))
+			logger.debug("cache manager loaded %d entries", len(found))
+		self.enforce()
+		compressor.start()
+
+	def _insert(self, entry: CacheEntry):
+		old = self._entries.get(entry.hash)
+		if old is not None:
+			self.size -= old.size
+			entry.hits = old.hits
+			if old.evictable:
+				self._held[old.sandbox] -= old.size
+			if old.evictable and (
+				not entry.evictable or old.sandbox != entry.sandbox
+			):
+				self.policy(old.sandbox).remove(entry.hash)
+		self._entries[entry.hash] = entry
+		self.size += entry.size
+		if entry.evictable:
+			self._held[entry.sandbox] = (
+				self._held.get(entry.sandbox, 0) + entry.size)
+			policy = self.policy(entry.sandbox)
+			if entry.hash in policy:
+				policy.refresh(entry)
+			else:
+				policy.insert(entry)
+
+	def track(self, cache: 'Cache'):
+		"""
+		start tracking a cache, or refresh the size and state of a cache
+		that is already tracked. the cache becomes the most recently used.
+
+		Args:
+			cache: an instance of cache.Cache
+		"""
+
+		with self._lock:
+			if not self._loaded:
+				self.load()
+			compressed = False
+			try:
+				size = os.path.getsize(cache.path)
+			except OSError:
+				try:
+					size = os.path.getsize(get_compressed_location(cache.hash))
+					compressed = True
+				except OSError:
+					size = 0
+			self._insert(CacheEntry(cache.hash, size, cache.state,
+				cache.meta.sandbox, compressed=compressed))
+		self.enforce(keep=cache.hash)
+
+	def touch(self, hash: str, hit: bool = True):
+		"""
+		record a use of a cache
+
+		Args:
+			hash: the cache's hash
+			hit: count the use as a new reference to the cache. uses after
+				the first within the same open only make it more recent.
+		"""
+
+		with self._lock:
+			entry = self._entries.get(hash)
+			if entry is not None:
+				entry.accessed = time.time()
+				if hit:
+					entry.hits += 1
+				if entry.evictable:
+					self.policy(entry.sandbox).touch(entry)
+
+	def cold(self, before: float) -> List[str]:
+		"""
+		get the synced caches that are not compressed and have not been
+		used since `before`, least recently used first
+		"""
+
+		with self._lock:
+			entries = [
+				entry for entry in self._entries.values()
+				if entry.evictable and not entry.compressed
+				and entry.accessed < before
+			]
+		entries.sort(key=lambda entry: entry.accessed)
+		return [entry.hash for entry in entries]
+
+	def resize(self, hash: str, size: int, compressed: bool):
+		"""
+		record that a cache moved in or out of the compression tier
+		"""
+
+		with self._lock:
+			entry = self._entries.get(hash)
+			if entry is None:
+				return
+			self.size += size - entry.size
+			if entry.evictable:
+				self._held[entry.sandbox] += size - entry.size
+			entry.size = size
+			entry.compressed = compressed
+
+	def untrack(self, hash: str):
+		"""
+		stop tracking a cache without deleting its files
+		"""
+
+		with self._lock:
+			entry = self._entries.pop(hash, None)
+			if entry is not None:
+				self.size -= entry.size
+				if entry.evictable:
+					self._held[entry.sandbox] -= entry.size
+					self.policy(entry.sandbox).remove(hash)
+
+	def over_budget(self) -> bool:
+		"""
+		Returns: True if the cache holds more than its budget allows
+		"""
+
+		return self.size > self.max_bytes or len(self) > self.max_entries
+
+	def victim(self, keep: Optional[str] = None) -> Optional[CacheEntry]:
+		"""
+		get the synced cache that should be evicted next, as picked by the
+		policy of the sandbox holding the most of the budget: the most
+		bytes, or the most entries if only the entry budget is exceeded
+
+		Args:
+			keep: the hash of a cache that must not be picked
+		"""
+
+		with self._lock:
+			if self.size > self.max_bytes:
+				share = lambda sandbox: self._held.get(sandbox, 0)
+			else:
+				share = lambda sandbox: len(self._policies[sandbox])
+			for sandbox in sorted(self._policies, key=share, reverse=True):
+				victim = self._policies[sandbox].victim(keep)
+				if victim is not None:
+					return victim
+		return None
+
+	def enforce(self, keep: Optional[str] = None) -> int:
+		"""
+		evict synced caches until the cache is within its budget. cold
+		caches are compressed first when the byte budget is exceeded, so
+		fewer caches have to go.
+
+		Args:
+			keep: the hash of a cache that must not be evicted
+
+		Returns: the number of caches evicted
+		"""
+
+		evicted = 0
+		with self._lock:
+			if self.size > self.max_bytes:
+				compressor.compress_cold()
+			while self.over_budget():
+				victim = self.victim(keep)
+				if victim is None:
+					break
+				self.evict(victim.hash)
+				evicted += 1
+			if self.over_budget():
+				logger.debug(
+					"cache is over budget but %d entries are not synced",
+					sum(not entry.evictable for entry in self._entries.values()),
+				)
+		return evicted
+
+	def evict(self, hash: str) -> bool:
+		"""
+		delete a synced cache and its metadata
+
+		Returns: True if the cache was evicted
+		"""
+
+		with self._lock:
+			entry = self._entries.get(hash)
+			if entry is None or not entry.evictable:
+				return False
+			del self._entries[hash]
+			self._held[entry.sandbox] -= entry.size
+			self.policy(entry.sandbox).remove(hash, evicted=True)
+			self.size -= entry.size
+			self.evictions += 1
+		metrics.inc("cache.evictions")
+		logger.debug("evicting cache '%s' (%d bytes)", hash, entry.size)
+		tier.discard(hash)
+		store.delete(hash)
+		location = get_cache_location(hash)
+		mappings.invalidate(location)
+		try:
+			os.remove(location)
+		except FileNotFoundError:
+			pass
+		compressor.discard(hash)
+		return True
+
+
+manager = CacheManager()
@@ -1,10 +1,5 @@
 import click
-from .auth import (
-	login as _login,
-	is_logged_in
-)
-from rich.prompt import Prompt
-from .database import DB, Sandbox
+from . import config
 from .logger import logger
 
 
@@ -24,6 +19,9 @@ def login(host, username, password, name):
 	"""
 	login into an ALX sandbox
 	"""
+
+	from .auth import login as _login
+
 	_login(host, username, password, name)
 
 
@@ -36,12 +34,15 @@ def logout(host, name, confirm):
 	logout from an ALX sandbox
 	"""
 
+	from rich.prompt import Prompt
+	from .auth import is_logged_in
+	from .registry import registry
+
 	if name and not host:
-		with DB.atomic():
-			if (sandbox:= Sandbox.select().where(Sandbox.name == name)):
-				host = sandbox.host
-			else:
-				raise click.Abort(f"no sandbox named '{host}'")
+		if (sandbox := registry.get(name)):
+			host = sandbox.host
+		else:
+			raise click.Abort(f"no sandbox named '{name}'")
 	else:
 		name = None
 	if not confirm:
@@ -53,4 +54,248 @@ def logout(host, name, confirm):
 			raise click.Abort(f"sandbox '{name}' is not logged in")
 		raise click.Abort(f"sandbox '{host}' is not logged in")
 	logger.debug("logging out...")
-	
\ No newline at end of file
+	
+
+@main.command()
+@click.argument("name")
+@click.option("--prewarm", is_flag=True,
+	help="sync the sandbox's recently used files before switching to it")
+def switch(name, prewarm):
+	"""
+	make another logged in sandbox the active one
+	"""
+
+	from rich.console import Console
+	from .auth.activate import switch_sandbox
+	from .registry import registry
+
+	sandbox = registry.get(name)
+	if sandbox is None:
+		raise click.Abort(f"no sandbox named '{name}'")
+	warming = switch_sandbox(sandbox, prewarm)
+	if warming is not None:
+		with Console().status(f"pre-warming {name}..."):
+			warming.join()
+
+
+@main.command()
+@click.argument("directory")
+@click.option("--include", "-i", multiple=True,
+	help="glob pattern of files to fetch, relative to DIRECTORY")
+@click.option("--exclude", "-e", multiple=True,
+	help="glob pattern of files to leave out, relative to DIRECTORY")
+@click.option("--workers", "-w", type=int, default=config.PREFETCH_WORKERS,
+	show_default=True, help="number of files to download at the same time")
+@click.option("--restart", is_flag=True,
+	help="ignore the progress of an interrupted prefetch")
+def prefetch(directory, include, exclude, workers, restart):
+	"""
+	download the files in a sandbox directory into the cache
+	"""
+
+	from rich.progress import Progress
+	from .auth.activate import get_active_sandbox
+	from .prefetch import prefetch as _prefetch
+
+	sandbox = get_active_sandbox()
+	if sandbox is None:
+		raise click.Abort("no sandbox is active")
+	with Progress(transient=True) as bar:
+		task = bar.add_task(f"prefetching {directory}", total=None)
+
+		def progress(path, done, total):
+			bar.update(task, completed=done, total=total)
+
+		result = _prefetch(sandbox, directory, include or ("*",), exclude,
+			workers, resume=not restart, progress=progress)
+	logger.info("downloaded %d files (%d bytes), %d already cached",
+		len(result.downloaded), result.bytes, len(result.skipped))
+	for path, reason in result.failed:
+		logger.warning("could not download %s: %s", path, reason)
+
+
+@main.command()
+@click.argument("directory")
+def sync(directory):
+	"""
+	sync the cached files under a sandbox directory with their originals
+	"""
+
+	from .auth.activate import get_active_sandbox
+	from .manifest import sync_tree
+
+	sandbox = get_active_sandbox()
+	if sandbox is None:
+		raise click.Abort("no sandbox is active")
+	synced = sync_tree(sandbox, directory)
+	logger.info("synced %d files", len(synced))
+
+
+@main.command()
+@click.option("--name", "-n", help="only replay changes to this sandbox")
+def replay(name):
+	"""
+	push the changes that were made while a sandbox was unreachable
+	"""
+
+	from .journal import journal
+
+	pending = len(journal.pending(name))
+	if not pending:
+		logger.info("there are no pending changes")
+		return
+	pushed = journal.replay(name)
+	logger.info("pushed %d of %d pending changes", pushed, pending)
+
+
+@main.command(context_settings=dict(
+	ignore_unknown_options=True, allow_interspersed_args=False))
+@click.argument("command", nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option("--cwd", "-C", help="directory on the sandbox to run the command in")
+@click.option("--name", "-n", help="run on this sandbox instead of the active one")
+@click.option("--workers", "-w", type=int, default=config.RUN_WORKERS,
+	show_default=True, help="number of files to sync at the same time")
+def run(command, cwd, name, workers):
+	"""
+	run a command on a sandbox, syncing cached files before and after it
+	"""
+
+	import sys
+	from .auth.activate import get_active_sandbox
+	from .registry import registry
+	from .runner import run as _run
+
+	sandbox = registry.get(name) if name else get_active_sandbox()
+	if sandbox is None:
+		raise click.Abort(
+			f"no sandbox named '{name}'" if name else "no sandbox is active")
+
+	def output(stream):
+		def write(data: bytes):
+			stream.write(data)
+			stream.flush()
+		return write
+
+	result = _run(sandbox, " ".join(command), cwd,
+		output(sys.stdout.buffer), output(sys.stderr.buffer), workers)
+	logger.debug("pushed %d and pulled %d files",
+		len(result.pushed), len(result.pulled))
+	for path, reason in result.failed:
+		logger.warning("could not sync %s: %s", path, reason)
+	sys.exit(result.status)
+
+
+@main.command()
+@click.option("--json", "as_json", is_flag=True,
+	help="print every metric as json")
+@click.option("--trace", is_flag=True, help="show the most recent spans")
+@click.option("--reset", is_flag=True, help="forget every metric")
+def stats(as_json, trace, reset):
+	"""
+	show counters, timings and traces collected across runs
+	"""
+
+	import json
+	from rich.console import Console
+	from rich.table import Column, Table
+	from .metrics import metrics
+
+	if reset:
+		metrics.reset()
+		logger.info("metrics reset")
+		return
+	metrics.load()
+	data = metrics.json()
+	metrics.enabled = False  # don't add the loaded totals to the file again
+	if as_json:
+		click.echo(json.dumps(data, indent=2))
+		return
+	console = Console()
+	counters = Table(Column("counter", no_wrap=True), "value",
+		title="counters")
+	for name, value in data["counters"].items():
+		counters.add_row(name, f"{value:,}")
+	for name, value in data["gauges"].items():
+		counters.add_row(name, f"{value['value']:,} (max {value['max']:,})")
+	console.print(counters)
+	timings = Table(Column("histogram", no_wrap=True), "count", "mean", "p50", "p95", "p99", "max",
+		title="histograms")
+	for name, histogram in metrics.histograms.items():
+		timings.add_row(name, f"{histogram.count:,}", *(
+			f"{value:.4g}" for value in (
+				histogram.mean, histogram.percentile(50),
+				histogram.percentile(95), histogram.percentile(99),
+				histogram.max)))
+	console.print(timings)
+	if trace:
+		spans = Table(Column("span", no_wrap=True), "parent", "duration",
+			"attributes", title="trace")
+		for span in data["spans"]:
+			spans.add_row(span["name"], span["parent"] or "",
+				f"{span['duration'] * 1000:.1f}ms",
+				" ".join(f"{k}={v}" for k, v in span["attrs"].items())
+				+ (f" error={span['error']}" if span["error"] else ""))
+		console.print(spans)
+
+
+DURATIONS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+
+def parse_duration(text: str) -> float:
+	"""
+	parse a duration such as "90", "30m", "24h" or "7d" into seconds
+	"""
+
+	unit = DURATIONS.get(text[-1:].lower())
+	try:
+		return float(text[:-1]) * unit if unit else float(text)
+	except ValueError:
+		raise click.BadParameter(f"'{text}' is not a duration like 30m or 7d")
+
+
+@main.command()
+@click.option("--by", "kind", default="path", show_default=True,
+	type=click.Choice(["path", "extension", "directory", "sandbox"]),
+	help="what to add up usage by")
+@click.option("--since", default="7d", show_default=True,
+	help="how far back to look, e.g. 24h or 30d. 'all' for everything")
+@click.option("--sandbox", "-n", help="only count files on this sandbox")
+@click.option("--sort", "order", default="reads", show_default=True,
+	type=click.Choice(["reads", "writes", "bytes_read", "bytes_written",
+		"last_access"]), help="what the busiest are sorted by")
+@click.option("--limit", "-l", type=int, default=20, show_default=True)
+@click.option("--history", help="show usage of a single key over time")
+@click.option("--json", "as_json", is_flag=True, help="print the results as json")
+def analytics(kind, since, sandbox, order, limit, history, as_json):
+	"""
+	show which files, file types and directories are used the most
+	"""
+
+	import json
+	import time
+	from datetime import datetime
+	from rich.console import Console
+	from rich.table import Column, Table
+	from .analytics import recorder
+
+	start = None if since == "all" else time.time() - parse_duration(since)
+	if history is not None:
+		rows = recorder.history(kind, history, sandbox, start)
+	else:
+		rows = recorder.top(kind, start, sandbox, order, limit)
+	if as_json:
+		click.echo(json.dumps(rows, indent=2))
+		return
+	first = "window" if history is not None else kind
+	table = Table(Column(first, no_wrap=True), "sandbox", "reads", "writes",
+		"read", "written", "last access")
+	for row in rows:
+		table.add_row(
+			datetime.fromtimestamp(row["window"]).strftime("%Y-%m-%d %H:%M")
+				if history is not None else row["key"] or "(none)",
+			row["sandbox"] or "(local)",
+			f"{row['reads']:,}", f"{row['writes']:,}",
+			f"{row['bytes_read']:,}", f"{row['bytes_written']:,}",
+			datetime.fromtimestamp(row["last_access"]).strftime(
+				"%Y-%m-%d %H:%M:%S"))
+	Console().print(table)
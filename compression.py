@@ -0,0 +1,268 @@
+"""
+This module contains the compression tier.
+
+Synced caches that have not been used for `config.COMPRESS_AFTER`
+seconds are compressed in the background, before caches are evicted to
+make room, and for up to `config.COMPRESS_AT_EXIT` seconds when the
+application exits, since most runs end before the background pass. A compressed cache lives in
+`<hash>.z` next to where the raw cache would be, and its codec is
+recorded in the cache's metadata. The raw file is restored the first
+time the cache is used again, so caches in use are never compressed and
+reading them costs nothing extra.
+
+FILE FORMAT
+===========
+
+">4sBQ" header: the magic b"AXZ1", the codec and the size of the raw
+contents, followed by the compressed contents.
+
+CLASSES DECLARED
+================
+
+Compressor:
+	compresses cold caches and restores them when they are used
+
+OBJECTS DECLARED
+================
+
+compressor:
+	the application wide compressor
+"""
+import atexit
+import os
+import struct
+import threading
+import time
+from typing import Optional
+
+from . import config
+from .logger import logger
+from .mapping import mappings, write_file
+from .memory import tier
+from .metastore import store
+from .snapshot import CODECS, compress, decompress
+
+HEADER = struct.Struct(">4sBQ")
+
+MAGIC = b"AXZ1"
+
+SUFFIX = ".z"
+
+
+def get_compressed_location(hash: str) -> str:
+	"""
+	get the path where the cache would be stored once compressed
+
+	Args:
+		hash: the file's unique hash
+	"""
+
+	return os.path.join(config.CACHE_DIR, hash + SUFFIX)
+
+
+def get_codec(hash: str) -> int:
+	"""
+	Returns: the codec a cache is compressed with according to the
+	metadata store, 0 if it isn't compressed
+	"""
+
+	row = store.load(hash)
+	return (row or {}).get("codec") or 0
+
+
+def _set_codec(hash: str, codec: int):
+	row = store.load(hash)
+	if row is not None and row.get("codec") != codec:
+		row["codec"] = codec
+		store.save(row)
+
+
+class Compressor:
+	"""This interface moves caches in and out of the compression tier.
+
+	`lock` must be held while a cache file is written, so a cache is never
+	compressed while it is being rewritten.
+	"""
+
+	def __init__(
+		self,
+		codec: str = config.COMPRESS_CODEC,
+		cold_after: float = config.COMPRESS_AFTER,
+		min_size: int = config.COMPRESS_MIN_SIZE,
+		interval: float = config.COMPRESS_INTERVAL,
+	):
+		self.codec = CODECS[codec]
+		self.cold_after = cold_after
+		self.min_size = min_size
+		self.interval = interval
+		self.compressed = 0
+		self.inflated = 0
+		self.saved = 0
+		self.lock = threading.RLock()
+		self._worker: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+
+	def compress(self, hash: str) -> int:
+		"""
+		compress a cache, unless it is in memory, too small or does not
+		get any smaller
+
+		Returns: the size of the compressed cache, or 0 if the cache was
+		left alone
+		"""
+
+		from .cache import get_cache_location
+
+		path = get_cache_location(hash)
+		if hash in tier:
+			return 0
+		try:
+			with open(path, "rb") as f:
+				before = os.fstat(f.fileno())
+				data = f.read()
+		except FileNotFoundError:
+			return 0
+		if len(data) < self.min_size:
+			return 0
+		packed = compress(data, self.codec)
+		if len(packed) + HEADER.size >= len(data) * 0.9:
+			return 0
+		with self.lock:
+			try:
+				after = os.stat(path)
+			except FileNotFoundError:
+				return 0
+			if hash in tier or (after.st_ino, after.st_mtime_ns) != (
+					before.st_ino, before.st_mtime_ns):
+				# the cache was used while it was being compressed
+				return 0
+			location = get_compressed_location(hash)
+			write_file(location, HEADER.pack(MAGIC, self.codec, len(data)) + packed)
+			mappings.invalidate(path)
+			os.remove(path)
+		_set_codec(hash, self.codec)
+		size = len(packed) + HEADER.size
+		self.compressed += 1
+		self.saved += len(data) - size
+		logger.debug("compressed cache '%s' from %d to %d bytes",
+			hash, len(data), size)
+		return size
+
+	def inflate(self, hash: str) -> Optional[bytes]:
+		"""
+		restore the raw file of a compressed cache
+
+		Returns: the contents of the cache, or None if it isn't compressed
+		"""
+
+		from .cache import get_cache_location
+
+		location = get_compressed_location(hash)
+		with self.lock:
+			try:
+				with open(location, "rb") as f:
+					magic, codec, size = HEADER.unpack(f.read(HEADER.size))
+					packed = f.read()
+			except FileNotFoundError:
+				return None
+			if magic != MAGIC:
+				raise ValueError(f"{location} is not a compressed cache")
+			data = decompress(packed, codec)
+			if len(data) != size:
+				raise ValueError(f"{location} is truncated")
+			write_file(get_cache_location(hash), data)
+			os.remove(location)
+		_set_codec(hash, 0)
+		self.inflated += 1
+		logger.debug("decompressed cache '%s'", hash)
+		return data
+
+	def discard(self, hash: str):
+		"""
+		drop the compressed copy of a cache that is being overwritten
+		"""
+
+		try:
+			os.remove(get_compressed_location(hash))
+		except FileNotFoundError:
+			return
+		_set_codec(hash, 0)
+
+	def compress_cold(
+		self, now: Optional[float] = None, budget: Optional[float] = None
+	) -> int:
+		"""
+		compress every synced cache that has gone unused for
+		`cold_after` seconds
+
+		Args:
+			now: the time to measure how long caches went unused from
+			budget: stop after this many seconds. without one, it stops
+				once the compressor is shut down.
+
+		Returns: the number of caches compressed
+		"""
+
+		from .caching import manager
+
+		now = time.time() if now is None else now
+		deadline = None if budget is None else time.monotonic() + budget
+		count = 0
+		for hash in manager.cold(now - self.cold_after):
+			if deadline is None and self._stopped.is_set():
+				break
+			if deadline is not None and time.monotonic() > deadline:
+				break
+			try:
+				size = self.compress(hash)
+			except OSError as err:
+				logger.error("could not compress cache '%s': %s", hash, err)
+				continue
+			if size:
+				manager.resize(hash, size, compressed=True)
+				count += 1
+		return count
+
+	def start(self):
+		"""
+		start compressing cold caches in the background
+		"""
+
+		if not self.interval:
+			return
+		if self._worker is not None and self._worker.is_alive():
+			return
+		self._stopped.clear()
+		self._worker = threading.Thread(
+			target=self._loop, name="alexis-compressor", daemon=True
+		)
+		self._worker.start()
+
+	def _loop(self):
+		while not self._stopped.wait(self.interval):
+			self.compress_cold()
+
+	def stats(self) -> dict:
+		return dict(
+			compressed=self.compressed,
+			inflated=self.inflated,
+			saved=self.saved,
+		)
+
+	def shutdown(self):
+		"""
+		stop the background pass, then compress cold caches for up to
+		`config.COMPRESS_AT_EXIT` seconds
+		"""
+
+		self._stopped.set()
+		if not config.COMPRESS_AT_EXIT:
+			return
+		try:
+			self.compress_cold(budget=config.COMPRESS_AT_EXIT)
+		except Exception as err:
+			logger.error("could not compress cold caches: %s", err)
+
+
+compressor = Compressor()
+atexit.register(compressor.shutdown)
@@ -27,6 +27,205 @@ ACTIVE_SANDBOX_FILE = os.path.join(DATA_DIR, "sb")
 DATABASE = os.path.join(DATA_DIR, "alexis.sql")
 "Path to database"
 
+SETUP_MARKER = os.path.join(DATA_DIR, ".setup")
+"Path to the file that shows the one-time setup has been done"
+
+METRICS_FILE = os.path.join(DATA_DIR, "metrics.json")
+"Path to the file metrics are accumulated in across runs"
+
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+"Maximum number of bytes the cache directory may hold before eviction"
+
+CACHE_MAX_ENTRIES = 10000
+"Maximum number of files the cache directory may hold before eviction"
+
+CACHE_POLICY = "lru"
+"""The eviction policy of sandboxes that aren't in `CACHE_POLICIES`: one
+of "lru", "lfu" (least frequently used, with aging) or "arc" (adaptive
+replacement cache). lfu and arc are not flushed by a one-off scan"""
+
+CACHE_POLICIES = {}
+"""The eviction policy of each sandbox, by sandbox name, e.g.
+{"build-host": "arc"}. the empty name stands for local files"""
+
+MEMORY_MAX_BYTES = 32 * 1024 * 1024
+"Maximum number of bytes the in-memory cache tier may hold"
+
+MEMORY_MAX_FILE_SIZE = 1024 * 1024
+"Largest file, in bytes, that may be promoted into the in-memory tier"
+
+MEMORY_PROMOTE_AFTER = 3
+"Number of reads or writes after which a cache is promoted into memory"
+
+MEMORY_FLUSH_INTERVAL = 2.0
+"Seconds between write-backs of modified in-memory caches to disk"
+
+METADATA_FLUSH_INTERVAL = 1.0
+"Seconds between batched writes of cache metadata to the database"
+
+METADATA_BATCH_SIZE = 256
+"Number of pending metadata updates that forces an early batched write"
+
+IO_CHUNK_SIZE = 64 * 1024
+"Size, in bytes, of the buffers used to stream files"
+
+MMAP_MAX_OPEN = 64
+"Maximum number of cache files kept memory mapped at the same time"
+
+DELTA_BLOCK_SIZE = 4096
+"Size, in bytes, of the blocks compared during a delta transfer"
+
+DELTA_MIN_SIZE = 64 * 1024
+"Files smaller than this many bytes are always transferred whole"
+
+DELTA_MAX_SIZE = 4 * 1024 * 1024
+"Files larger than this many bytes are streamed whole instead of diffed. diffing runs in python, so past a few MB it is slower than sending the file"
+
+DELTA_MAX_LITERAL = 0.5
+"Fraction of a file that may differ from its basis before a delta is abandoned for a full transfer"
+
+PREFETCH_WORKERS = 4
+"Number of sftp channels used to download files in parallel during prefetch"
+
+RANGE_MIN_SIZE = 16 * 1024 * 1024
+"Files of at least this many bytes are downloaded in ranges over several channels"
+
+RANGE_SIZE = 8 * 1024 * 1024
+"Size, in bytes, of the ranges large files are split into"
+
+RANGE_WORKERS = 4
+"Number of sftp channels fetching the ranges of a large file at the same time"
+
+RANGE_RETRIES = 3
+"Number of times a range that failed or didn't match its checksum is fetched again"
+
+DIRECTORY_TTL = 5.0
+"Seconds a cached directory listing is considered fresh"
+
+DIRECTORY_STALE_TTL = 300.0
+"Seconds a stale directory listing may still be served while it is refreshed"
+
+DIRECTORY_CACHE_SIZE = 256
+"Maximum number of directory listings kept in memory"
+
+TREE_STATE_DIR = ".cache/alexis/trees"
+"Directory on the sandbox, relative to the home directory, where the tree helper keeps the trees it built"
+
+TREE_STATES = 8
+"Number of trees the tree helper keeps on each sandbox"
+
+SYNC_DEBOUNCE = 0.5
+"Seconds to wait after the last write to a cache before it is synced"
+
+SYNC_WORKERS = 2
+"Maximum number of caches synced at the same time in the background"
+
+RUN_WORKERS = 4
+"Number of caches pushed or pulled at the same time around `alexis run`"
+
+COMPRESS_CODEC = "zlib"
+"The codec cold caches are compressed with: zlib or lzma"
+
+COMPRESS_AFTER = 10 * 60
+"Seconds a synced cache must go unused before it is compressed"
+
+COMPRESS_MIN_SIZE = 4 * 1024
+"Caches smaller than this many bytes are never compressed"
+
+COMPRESS_INTERVAL = 60
+"Seconds between background passes that compress cold caches"
+
+COMPRESS_AT_EXIT = 1.0
+"Seconds spent compressing cold caches when the application exits, 0 to skip it"
+
+SNAPSHOT_ON_SYNC = True
+"Take a snapshot of a cache every time it is synced"
+
+SNAPSHOT_CODEC = "zlib"
+"Compression used for snapshots, one of 'zlib', 'lzma' or 'none'"
+
+SNAPSHOT_DELTA = True
+"Store snapshots as deltas against the previous version when smaller"
+
+SNAPSHOT_MAX_CHAIN = 8
+"Maximum number of deltas that may be chained before a full snapshot"
+
+SNAPSHOT_MAX_SIZE = 16 * 1024 * 1024
+"Caches larger than this many bytes are not snapshotted"
+
+SNAPSHOT_KEEP = 20
+"Number of versions of each file kept by the retention policy"
+
+SNAPSHOT_MAX_AGE = 30 * 24 * 60 * 60
+"Seconds after which versions other than the latest are discarded"
+
+SNAPSHOT_PRUNE_INTERVAL = 6 * 60 * 60
+"Seconds between applications of the retention policy by the snapshot writer"
+
+JOURNAL_FILE = os.path.join(DATA_DIR, "journal")
+"The write-ahead journal of changes that have not reached a sandbox"
+
+JOURNAL_FSYNC = True
+"Whether journal records are forced to disk before a change is accepted"
+
+JOURNAL_COMPACT_AFTER = 1024
+"The number of journal records after which the journal is rewritten"
+
+SSH_PORT = 22
+"The port sandboxes accept ssh connections on"
+
+NETWORK_PROBE_TIMEOUT = 3.0
+"Seconds a reachability probe waits for a tcp connection"
+
+NETWORK_STATE_TTL = 30.0
+"Seconds the reachability of a sandbox host is trusted before it is probed again"
+
+NETWORK_BACKOFF = 1.0
+"Seconds to wait before probing a host again after its first failed probe"
+
+NETWORK_BACKOFF_MAX = 60.0
+"The longest wait between probes of a host that stays unreachable"
+
+ANALYTICS_ENABLED = True
+"Whether accesses to cached files are recorded for `alexis analytics`"
+
+ANALYTICS_WINDOW = 60 * 60
+"Seconds covered by a single usage rollup"
+
+ANALYTICS_FLUSH_INTERVAL = 30.0
+"Seconds between batched writes of recorded accesses to the database"
+
+ANALYTICS_BATCH_SIZE = 4096
+"Number of buffered accesses that wakes the writer early"
+
+ANALYTICS_RETENTION = 90 * 24 * 60 * 60
+"Seconds usage rollups are kept for"
+
+PREWARM_FILES = 32
+"""The number of most recently used files of a sandbox that are synced
+when it is pre-warmed before a switch"""
+
+METRICS_ENABLED = True
+"Whether counters, timings and traces are recorded"
+
+TRACE_BUFFER = 256
+"The number of most recent spans kept for `alexis stats --trace`"
+
+POOL_KEEPALIVE = 30
+"Seconds between keepalive packets sent on pooled ssh connections"
+
+POOL_IDLE_TIMEOUT = 300
+"Seconds a pooled ssh connection may stay unused before it is closed"
+
+POOL_MAX_CHANNELS = 8
+"Maximum number of idle sftp channels kept open per pooled connection"
+
+POOL_CONNECT_TIMEOUT = 10.0
+"Seconds opening a pooled ssh connection may wait for the tcp connection, the ssh banner and authentication, each"
+
+SFTP_WINDOW_SIZE = 16 * 1024 * 1024
+"Size, in bytes, of the flow control window of sftp channels. a channel moves at most one window per round-trip"
+
 DEBUG_MODE_ON = False
 "Toggle application debug mode"
 
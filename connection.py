@@ -0,0 +1,520 @@
+"""
+This module contains the ssh connection pool.
+
+Opening an ssh connection to a sandbox costs a tcp handshake, an ssh
+handshake and password authentication. The pool keeps one authenticated
+connection per sandbox alive and hands out sftp channels and exec sessions
+over it, so only the first remote operation pays that cost.
+
+A connection is in use while one of its sftp channels is checked out or
+one of its commands is running. Connections in use are never closed for
+being idle, however long the operation takes.
+
+CLASSES DECLARED
+================
+
+Connection:
+	a live, authenticated connection to a single sandbox
+
+ConnectionPool:
+	keeps connections alive, health checks them and closes idle ones
+
+OBJECTS DECLARED
+================
+
+pool:
+	the application wide connection pool
+"""
+import atexit
+import select
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import (
+	TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+)
+
+from . import config
+from .logger import logger
+from .metrics import metrics
+from .network import monitor
+
+if TYPE_CHECKING:
+	from paramiko import SFTPClient, SSHClient
+
+	from .database import Sandbox
+
+
+Key = Tuple[str, str]
+
+
+def get_pool_key(host: str, username: str) -> Key:
+	"""
+	get the key a connection is stored under in the pool
+
+	Args:
+		host: sandbox host
+		username: sandbox username
+	"""
+
+	return (host, username)
+
+
+class Connection:
+	"""This interface represents a live connection to a sandbox.
+	It keeps a stack of idle sftp channels so they can be reused.
+	"""
+
+	key: Key
+	"the key this connection is stored under in the pool"
+
+	client: 'SSHClient'
+	"the underlying ssh client"
+
+	last_used: float
+	"a monotonic timestamp showing when the connection was last used"
+
+	def __init__(self, key: Key, client: 'SSHClient', max_channels: int):
+		self.key = key
+		self.client = client
+		self.last_used = time.monotonic()
+		self._max_channels = max_channels
+		self._channels: List['SFTPClient'] = []
+		self._checked_out: 'weakref.WeakSet[SFTPClient]' = weakref.WeakSet()
+		self._commands = 0
+		self._lock = threading.Lock()
+
+	@property
+	def alive(self) -> bool:
+		"""
+		Returns: True if the underlying transport is still usable
+		"""
+
+		transport = self.client.get_transport()
+		return bool(
+			transport and transport.is_active() and transport.is_authenticated()
+		)
+
+	@property
+	def in_use(self) -> bool:
+		"""
+		Returns: True if a command is running or an sftp channel that is
+		still open is checked out
+		"""
+
+		with self._lock:
+			return self._commands > 0 or any(
+				not sftp.get_channel().closed for sftp in self._checked_out)
+
+	def touch(self):
+		"""
+		mark the connection as used
+		"""
+
+		self.last_used = time.monotonic()
+
+	@contextmanager
+	def _running(self) -> Iterator[None]:
+		with self._lock:
+			self._commands += 1
+		try:
+			yield
+		finally:
+			with self._lock:
+				self._commands -= 1
+			self.touch()
+
+	def checkout_sftp(self) -> 'SFTPClient':
+		"""
+		get an sftp channel, reusing an idle one when possible
+		"""
+
+		self.touch()
+		with self._lock:
+			while self._channels:
+				sftp = self._channels.pop()
+				if not sftp.get_channel().closed:
+					self._checked_out.add(sftp)
+					return sftp
+		from paramiko import SFTPClient
+
+		logger.debug("opening sftp channel on %s", self.key[0])
+		sftp = SFTPClient.from_transport(
+			self.client.get_transport(), window_size=config.SFTP_WINDOW_SIZE)
+		with self._lock:
+			self._checked_out.add(sftp)
+		return sftp
+
+	def checkin_sftp(self, sftp: 'SFTPClient'):
+		"""
+		return an sftp channel so it can be reused
+		"""
+
+		self.touch()
+		with self._lock:
+			self._checked_out.discard(sftp)
+			if (len(self._channels) < self._max_channels
+					and not sftp.get_channel().closed):
+				self._channels.append(sftp)
+				return
+		sftp.close()
+
+	def exec_command(
+		self, command: str, stdin: Optional[bytes] = None,
+		timeout: Optional[float] = None
+	) -> Tuple[int, bytes, bytes]:
+		"""
+		run a command on the sandbox over a new exec session
+
+		Args:
+			command: the command to run
+			stdin: data to feed the command on its standard input
+			timeout: seconds to wait on the channel before giving up
+
+		Returns: the exit status, stdout and stderr of the command
+		"""
+
+		with self._running(), metrics.span("ssh.exec"):
+			start = time.perf_counter()
+			_in, out, err = self.client.exec_command(command, timeout=timeout)
+			if stdin is not None:
+				_in.write(stdin)
+				metrics.inc("bytes.up", len(stdin))
+			_in.channel.shutdown_write()
+			stdout = out.read()
+			metrics.observe("ssh.rtt", time.perf_counter() - start)
+			stderr = err.read()
+			status = out.channel.recv_exit_status()
+			metrics.inc("bytes.down", len(stdout) + len(stderr))
+		return status, stdout, stderr
+
+	def stream_command(
+		self, command: str,
+		stdout: Callable[[bytes], None], stderr: Callable[[bytes], None],
+		timeout: Optional[float] = None
+	) -> int:
+		"""
+		run a command on the sandbox over a new exec session, handing its
+		output to `stdout` and `stderr` as it arrives
+
+		Args:
+			command: the command to run
+			stdout: called with every chunk of standard output
+			stderr: called with every chunk of standard error
+			timeout: seconds to wait for the session to open
+
+		Returns: the exit status of the command
+		"""
+
+		with self._running(), metrics.span("ssh.stream"):
+			channel = self.client.get_transport().open_session(timeout=timeout)
+			try:
+				channel.exec_command(command)
+				channel.shutdown_write()
+				while True:
+					if channel.recv_ready():
+						data = channel.recv(65536)
+						metrics.inc("bytes.down", len(data))
+						stdout(data)
+					elif channel.recv_stderr_ready():
+						data = channel.recv_stderr(65536)
+						metrics.inc("bytes.down", len(data))
+						stderr(data)
+					elif channel.exit_status_ready() or channel.eof_received:
+						# output is sent before the exit status, so there
+						# is nothing left to read
+						break
+					else:
+						select.select([channel], [], [], 1.0)
+				status = channel.recv_exit_status()
+			finally:
+				channel.close()
+		return status
+
+	def close(self):
+		"""
+		close every channel and the connection itself
+		"""
+
+		with self._lock:
+			channels, self._channels = self._channels, []
+		for sftp in channels:
+			sftp.close()
+		self.client.close()
+
+
+class ConnectionPool:
+	"""This interface keeps one live connection per sandbox.
+
+	Connections are health checked before they are handed out, are kept
+	alive with ssh keepalive packets and are closed after they have been
+	idle for `idle_timeout` seconds.
+	"""
+
+	def __init__(
+		self,
+		keepalive: int = config.POOL_KEEPALIVE,
+		idle_timeout: float = config.POOL_IDLE_TIMEOUT,
+		max_channels: int = config.POOL_MAX_CHANNELS,
+		port: int = config.SSH_PORT,
+		connect_timeout: float = config.POOL_CONNECT_TIMEOUT,
+	):
+		self.keepalive = keepalive
+		self.idle_timeout = idle_timeout
+		self.max_channels = max_channels
+		self.port = port
+		self.connect_timeout = connect_timeout
+		self._connections: Dict[Key, Connection] = {}
+		self._opening: Dict[Key, threading.Lock] = {}
+		self._lock = threading.RLock()
+		self._reaper: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+		self._listeners: List[Callable[[Key], None]] = []
+
+	def __len__(self) -> int:
+		return len(self._connections)
+
+	def _open(self, host: str, username: str, password: str) -> 'SSHClient':
+		"""
+		open and authenticate a new ssh connection
+		"""
+
+		from paramiko import AutoAddPolicy, SSHClient
+
+		client = SSHClient()
+		client.set_missing_host_key_policy(AutoAddPolicy)
+		logger.debug("opening ssh connection to %s", host)
+		with metrics.timer("ssh.handshake"):
+			client.connect(
+				hostname=host,
+				port=self.port,
+				username=username,
+				password=password,
+				look_for_keys=False,
+				timeout=self.connect_timeout,
+				banner_timeout=self.connect_timeout,
+				auth_timeout=self.connect_timeout,
+			)
+		transport = client.get_transport()
+		if transport and self.keepalive:
+			transport.set_keepalive(self.keepalive)
+		return client
+
+	def connect(self, host: str, username: str, password: str) -> Connection:
+		"""
+		get a live connection to a sandbox, opening one if there is none
+		or the pooled one is dead.
+
+		Args:
+			host: sandbox host
+			username: sandbox username
+			password: sandbox password
+
+		Returns: a live connection
+
+		Raises:
+			OSError: if the sandbox could not be reached
+			paramiko.SSHException: if the ssh handshake or authentication
+			failed
+		"""
+
+		from paramiko import AuthenticationException, SSHException
+
+		key = get_pool_key(host, username)
+		with self._lock:
+			conn = self._reuse(key)
+			if conn is not None:
+				return conn
+			opening = self._opening.setdefault(key, threading.Lock())
+		# only callers for the same sandbox wait for the handshake
+		with opening:
+			with self._lock:
+				conn = self._reuse(key)
+				if conn is not None:
+					return conn
+			error: Optional[Exception] = None
+			try:
+				client = self._open(host, username, password)
+			except (OSError, SSHException) as err:
+				error = err
+			else:
+				metrics.inc("pool.opened")
+				conn = Connection(key, client, self.max_channels)
+				with self._lock:
+					self._connections[key] = conn
+					self._start_reaper()
+		# listeners of the monitor may use the pool, so the connection is
+		# stored and the lock released before they run
+		# a rejected password still means the host answered
+		monitor.report(
+			host, error is None or isinstance(error, AuthenticationException))
+		if error is not None:
+			raise error
+		self._notify(key)
+		return conn
+
+	def _reuse(self, key: Key) -> Optional[Connection]:
+		"""
+		get the pooled connection for a key if it is alive, discarding it
+		if it is dead. called with the lock held.
+		"""
+
+		conn = self._connections.get(key)
+		if conn is None:
+			return None
+		if conn.alive:
+			conn.touch()
+			metrics.inc("pool.reused")
+			return conn
+		logger.debug("pooled connection to %s is dead", key[0])
+		self._discard(key)
+		return None
+
+	def add_listener(self, callback: Callable[[Key], None]):
+		"""
+		call `callback` with the key of every new connection the pool
+		opens. callbacks run on a background thread.
+		"""
+
+		self._listeners.append(callback)
+
+	def _notify(self, key: Key):
+		def notify():
+			for callback in self._listeners:
+				try:
+					callback(key)
+				except Exception as err:
+					logger.error("connection listener failed: %s", err)
+
+		if self._listeners:
+			threading.Thread(
+				target=notify, name="alexis-pool-listener", daemon=True
+			).start()
+
+	def get(self, sandbox: 'Sandbox') -> Connection:
+		"""
+		get a live connection to a sandbox
+
+		Args:
+			sandbox: an instance of database.Sandbox
+		"""
+
+		return self.connect(
+			sandbox.host, sandbox.username, sandbox.password  # type: ignore
+		)
+
+	@contextmanager
+	def sftp(self, sandbox: 'Sandbox') -> Iterator['SFTPClient']:
+		"""
+		borrow an sftp channel to a sandbox. the channel is returned to
+		the pool when the context exits.
+
+		Args:
+			sandbox: an instance of database.Sandbox
+		"""
+
+		conn = self.get(sandbox)
+		sftp = conn.checkout_sftp()
+		try:
+			yield sftp
+		except BaseException:
+			sftp.close()
+			raise
+		else:
+			conn.checkin_sftp(sftp)
+
+	def exec_command(
+		self, sandbox: 'Sandbox', command: str,
+		stdin: Optional[bytes] = None, timeout: Optional[float] = None
+	) -> Tuple[int, bytes, bytes]:
+		"""
+		run a command on a sandbox over a pooled connection
+
+		Returns: the exit status, stdout and stderr of the command
+		"""
+
+		return self.get(sandbox).exec_command(command, stdin, timeout)
+
+	def stream_command(
+		self, sandbox: 'Sandbox', command: str,
+		stdout: Callable[[bytes], None], stderr: Callable[[bytes], None],
+		timeout: Optional[float] = None
+	) -> int:
+		"""
+		run a command on a sandbox over a pooled connection, streaming its
+		output
+
+		Returns: the exit status of the command
+		"""
+
+		return self.get(sandbox).stream_command(command, stdout, stderr, timeout)
+
+	def _discard(self, key: Key):
+		conn = self._connections.pop(key, None)
+		if conn is not None:
+			try:
+				conn.close()
+			except Exception as err:
+				logger.debug("error closing connection %s: %s", key[0], err)
+
+	def evict_idle(self, now: Optional[float] = None) -> int:
+		"""
+		close connections that are dead or have been idle for too long.
+		connections in use are left open.
+
+		Returns: the number of connections closed
+		"""
+
+		now = time.monotonic() if now is None else now
+		evicted = 0
+		with self._lock:
+			for key, conn in list(self._connections.items()):
+				idle = now - conn.last_used > self.idle_timeout and not conn.in_use
+				if idle or not conn.alive:
+					logger.debug("closing idle connection to %s", key[0])
+					self._discard(key)
+					evicted += 1
+		return evicted
+
+	def close(self, sandbox: Optional['Sandbox'] = None):
+		"""
+		close the connection to a sandbox, or every connection if no
+		sandbox is supplied
+		"""
+
+		with self._lock:
+			if sandbox is not None:
+				self._discard(
+					get_pool_key(sandbox.host, sandbox.username)  # type: ignore
+				)
+				return
+			for key in list(self._connections):
+				self._discard(key)
+
+	def _start_reaper(self):
+		if self._reaper is not None and self._reaper.is_alive():
+			return
+		self._reaper = threading.Thread(
+			target=self._reap, name="alexis-pool-reaper", daemon=True
+		)
+		self._reaper.start()
+
+	def _reap(self):
+		interval = max(1.0, min(self.idle_timeout, self.keepalive or 30) / 2)
+		while not self._stopped.wait(interval):
+			self.evict_idle()
+			if not self._connections:
+				break
+
+	def shutdown(self):
+		"""
+		stop the reaper and close every connection
+		"""
+
+		self._stopped.set()
+		self.close()
+
+
+pool = ConnectionPool()
+atexit.register(pool.shutdown)
@@ -2,13 +2,21 @@ from dataclasses import dataclass
 from peewee import (
 	SqliteDatabase,
 	Model,
-	CharField
+	CharField,
+	FloatField,
+	IntegerField,
+	TextField
 )
 from .config import DATABASE
 import os
 
 
-DB = SqliteDatabase(DATABASE)
+DB = SqliteDatabase(DATABASE, pragmas={
+	# readers don't wait on the writer, and commits don't fsync the
+	# database, only the write-ahead log at checkpoints
+	"journal_mode": "wal",
+	"synchronous": "normal",
+})
 
 class BaseModel(Model):
 	class Meta:
@@ -17,11 +25,63 @@ class BaseModel(Model):
 
 class Sandbox(BaseModel):
 	name = CharField(max_length=20, unique=True)
-	host = CharField(max_length=50)
+	host = CharField(max_length=50, index=True)
 	username = CharField(max_length=20)
 	password = CharField(max_length=50)
 
 	def login(self):
 		"""
 		delt
-		"""
\ No newline at end of file
+		"""
+
+
+class CacheMetadata(BaseModel):
+	hash = CharField(max_length=40, primary_key=True)
+	origin = TextField()
+	name = CharField()
+	sandbox = CharField(max_length=20, null=True)
+	created_at = FloatField()
+	last_sync = FloatField(default=0.0)
+	modified_at = FloatField(default=0.0)
+	state = IntegerField(index=True)
+	codec = IntegerField(default=0)
+
+	class Meta:
+		indexes = (
+			(("sandbox", "state"), False),
+		)
+
+
+
+class Snapshot(BaseModel):
+	cache = CharField(max_length=40)
+	version = IntegerField()
+	digest = CharField(max_length=64, index=True)
+	size = IntegerField()
+	created_at = FloatField()
+
+	class Meta:
+		indexes = (
+			(("cache", "version"), True),
+		)
+
+
+class FileUsage(BaseModel):
+	kind = CharField(max_length=10)
+	sandbox = CharField(max_length=20, default="")
+	key = TextField()
+	window = IntegerField(index=True)
+	reads = IntegerField(default=0)
+	writes = IntegerField(default=0)
+	bytes_read = IntegerField(default=0)
+	bytes_written = IntegerField(default=0)
+	last_access = FloatField(default=0.0)
+
+	class Meta:
+		indexes = (
+			(("kind", "sandbox", "key", "window"), True),
+		)
+
+
+MODELS = [Sandbox, CacheMetadata, Snapshot, FileUsage]
+"every table in the database"
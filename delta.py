@@ -0,0 +1,325 @@
+"""
+This module contains the delta (rsync style) transfer used when syncing
+a cache with its original.
+
+The receiving side splits its copy of a file into blocks and sends a
+signature: a weak rolling checksum and a strong md5 checksum per block.
+The sending side slides a window over its copy, using the rolling
+checksum to find blocks the receiver already has, and sends back only
+copy instructions for those blocks and literal bytes for everything else.
+
+Signatures and deltas of the original are computed on the sandbox by a
+small helper that runs over an exec channel. The helper is built from
+the functions in this module, so both sides always agree on the format.
+
+Sliding the window runs in python, a byte at a time where blocks don't
+match. So a delta is given up, and the file sent whole, as soon as more
+than `config.DELTA_MAX_LITERAL` of it turns out to be new.
+
+FORMATS
+=======
+
+signature:
+	">I" block size, then ">I16s" (weak checksum, md5) for every block
+
+delta:
+	">I" block size, then records of
+	b"C" ">II" (first block, number of blocks) - copy blocks from basis
+	b"D" ">I" (length) + bytes                 - literal bytes
+	b"H" 16 bytes                              - md5 of the result
+"""
+import hashlib
+import inspect
+import itertools
+import os
+import shlex
+import struct
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from . import config
+from .connection import pool
+from .directory import directories
+from .logger import logger
+
+if TYPE_CHECKING:
+	from .cache import Cache
+
+
+def weak_checksum(block: bytes) -> Tuple[int, int]:
+	"""
+	compute the two halves of the rolling checksum of a block
+	"""
+
+	a = sum(block) & 0xFFFF
+	# the sum of the prefix sums weighs every byte by its distance from
+	# the end of the block, like the rolling update does
+	b = sum(itertools.accumulate(block)) & 0xFFFF
+	return a, b
+
+
+def signature(data: bytes, block_size: int) -> bytes:
+	"""
+	compute the block signature of `data`
+	"""
+
+	out = [struct.pack(">I", block_size)]
+	for i in range(0, len(data) - block_size + 1, block_size):
+		block = data[i:i + block_size]
+		a, b = weak_checksum(block)
+		out.append(struct.pack(
+			">I16s", a | (b << 16), hashlib.md5(block).digest()))
+	return b"".join(out)
+
+
+def make_delta(
+	sig: bytes, data: bytes, max_literal: Optional[int] = None
+) -> Optional[bytes]:
+	"""
+	compute the delta that turns the file described by `sig` into `data`
+
+	Args:
+		sig: the signature of the basis
+		data: the new contents
+		max_literal: give up once more than this many bytes are not in
+			the basis
+
+	Returns: the delta, or None if it was given up
+	"""
+
+	block_size, = struct.unpack_from(">I", sig)
+	table = {}
+	for index, offset in enumerate(range(4, len(sig), 20)):
+		weak, strong = struct.unpack_from(">I16s", sig, offset)
+		table.setdefault(weak, []).append((index, strong))
+
+	out = [struct.pack(">I", block_size)]
+	run = None
+	literal = 0
+	i = 0
+	n = len(data)
+	sent = 0
+	limit = n if max_literal is None else max_literal
+
+	def emit_literal(end):
+		nonlocal sent
+		if end > literal:
+			out.append(b"D" + struct.pack(">I", end - literal) + data[literal:end])
+			sent += end - literal
+
+	def emit_run():
+		if run is not None:
+			out.append(b"C" + struct.pack(">II", run[0], run[1]))
+
+	if n >= block_size and table:
+		a, b = weak_checksum(data[:block_size])
+		while True:
+			match = None
+			candidates = table.get(a | (b << 16))
+			if candidates:
+				strong = hashlib.md5(data[i:i + block_size]).digest()
+				for index, digest in candidates:
+					if digest == strong:
+						match = index
+						break
+			if match is not None:
+				if i > literal:
+					emit_run()
+					run = None
+					emit_literal(i)
+				if run is not None and run[0] + run[1] == match:
+					run = (run[0], run[1] + 1)
+				else:
+					emit_run()
+					run = (match, 1)
+				i += block_size
+				literal = i
+				if i + block_size > n:
+					break
+				a, b = weak_checksum(data[i:i + block_size])
+				continue
+			if i + block_size >= n:
+				break
+			if sent + i - literal > limit:
+				return None
+			old, new = data[i], data[i + block_size]
+			a = (a - old + new) & 0xFFFF
+			b = (b - block_size * old + a) & 0xFFFF
+			i += 1
+	emit_run()
+	emit_literal(n)
+	if sent > limit:
+		return None
+	out.append(b"H" + hashlib.md5(data).digest())
+	return b"".join(out)
+
+
+def apply_delta(basis: bytes, delta: bytes) -> bytes:
+	"""
+	rebuild a file from its basis and a delta
+
+	Raises:
+		ValueError: if the delta is malformed or the result doesn't match
+		the checksum in the delta
+	"""
+
+	block_size, = struct.unpack_from(">I", delta)
+	out = []
+	digest = None
+	i = 4
+	while i < len(delta):
+		op = delta[i:i + 1]
+		if op == b"C":
+			start, count = struct.unpack_from(">II", delta, i + 1)
+			out.append(basis[start * block_size:(start + count) * block_size])
+			i += 9
+		elif op == b"D":
+			length, = struct.unpack_from(">I", delta, i + 1)
+			out.append(delta[i + 5:i + 5 + length])
+			i += 5 + length
+		elif op == b"H":
+			digest = delta[i + 1:i + 17]
+			i += 17
+		else:
+			raise ValueError("malformed delta")
+	result = b"".join(out)
+	if digest is None or hashlib.md5(result).digest() != digest:
+		raise ValueError("delta checksum mismatch")
+	return result
+
+
+def _helper_main():
+	import os
+	import sys
+
+	command, path = sys.argv[1], sys.argv[2]
+	stdout = sys.stdout.buffer
+	if command == "sig":
+		with open(path, "rb") as f:
+			stdout.write(signature(f.read(), int(sys.argv[3])))
+	elif command == "delta":
+		sig = sys.stdin.buffer.read()
+		with open(path, "rb") as f:
+			data = f.read()
+		patch = make_delta(sig, data, int(len(data) * float(sys.argv[3])))
+		if patch is not None and len(patch) < len(data):
+			stdout.write(b"D" + patch)
+		else:
+			stdout.write(b"F" + data)
+	elif command == "patch":
+		patch = sys.stdin.buffer.read()
+		with open(path, "rb") as f:
+			data = apply_delta(f.read(), patch)
+		tmp = path + ".alexis-tmp"
+		with open(tmp, "wb") as f:
+			f.write(data)
+		os.chmod(tmp, os.stat(path).st_mode)
+		os.replace(tmp, path)
+
+
+_helper: Optional[str] = None
+
+
+def worth_diffing(size: int) -> bool:
+	"""
+	Returns: True if a file of `size` bytes should be sent as a delta.
+	small files are cheaper to send whole, and large ones are streamed
+	whole so that they never have to fit in memory.
+	"""
+
+	return config.DELTA_MIN_SIZE <= size <= config.DELTA_MAX_SIZE
+
+
+def remote_command(command: str, path: str, *args) -> str:
+	"""
+	build the shell command that runs the delta helper on a sandbox
+	"""
+
+	global _helper
+	if _helper is None:
+		functions = (weak_checksum, signature, make_delta, apply_delta, _helper_main)
+		_helper = "\n".join(
+			["import hashlib", "import itertools", "import struct",
+				"from typing import Optional, Tuple"]
+			+ [inspect.getsource(f) for f in functions]
+			+ ["_helper_main()"]
+		)
+	argv = " ".join(shlex.quote(str(arg)) for arg in (command, path) + args)
+	return f"python3 -c {shlex.quote(_helper)} {argv}"
+
+
+def pull(cache: 'Cache', size: int) -> Optional[bytes]:
+	"""
+	fetch the original of a remote cache as a delta against the cache
+
+	Args:
+		cache: a cache whose file is a remote.RemoteFile
+		size: the size of the original in bytes
+
+	Returns: the new contents of the cache, or None if the caller should
+	fall back to a full transfer
+	"""
+
+	sandbox = getattr(cache.file, "sandbox", None)
+	if sandbox is None or not worth_diffing(size):
+		return None
+	view = cache.view()
+	if not worth_diffing(len(view)):
+		return None
+	basis = bytes(view)
+	sig = signature(basis, config.DELTA_BLOCK_SIZE)
+	status, out, err = pool.exec_command(
+		sandbox,
+		remote_command("delta", cache.file.path, config.DELTA_MAX_LITERAL),
+		stdin=sig)
+	if status != 0 or not out:
+		logger.debug("delta helper failed (%d): %s", status, err)
+		return None
+	if out[:1] == b"F":
+		logger.debug("delta larger than '%s', got the full file", cache.name)
+		return out[1:]
+	try:
+		data = apply_delta(basis, out[1:])
+	except (ValueError, struct.error) as err:
+		logger.debug("could not apply delta for '%s': %s", cache.name, err)
+		return None
+	logger.debug("pulled '%s' with a %d byte delta", cache.name, len(out))
+	return data
+
+
+def push(cache: 'Cache') -> bool:
+	"""
+	send the contents of a remote cache to its original as a delta
+
+	Args:
+		cache: a cache whose file is a remote.RemoteFile
+
+	Returns: True if the original was updated, False if the caller should
+	fall back to a full transfer
+	"""
+
+	sandbox = getattr(cache.file, "sandbox", None)
+	if sandbox is None:
+		return False
+	view = cache.view()
+	if not worth_diffing(len(view)):
+		return False
+	data = bytes(view)
+	status, sig, err = pool.exec_command(
+		sandbox,
+		remote_command("sig", cache.file.path, config.DELTA_BLOCK_SIZE))
+	if status != 0 or not sig:
+		logger.debug("delta helper failed (%d): %s", status, err)
+		return False
+	patch = make_delta(sig, data, int(len(data) * config.DELTA_MAX_LITERAL))
+	if patch is None or len(patch) >= len(data):
+		logger.debug("'%s' changed too much for a delta, sending the full file",
+			cache.name)
+		return False
+	status, _, err = pool.exec_command(
+		sandbox, remote_command("patch", cache.file.path), stdin=patch)
+	if status != 0:
+		logger.debug("delta helper failed (%d): %s", status, err)
+		return False
+	directories.invalidate_file(sandbox, cache.file.path)
+	logger.debug("pushed '%s' with a %d byte delta", cache.name, len(patch))
+	return True
@@ -0,0 +1,324 @@
+"""
+This module contains the directory structure cache.
+
+A directory state is the immediate (non-recursive) contents of a
+directory on a sandbox: the name, type, size and mtime of every child.
+States are cached per sandbox and path for `config.DIRECTORY_TTL`
+seconds. Once a state is stale it can still be served, for up to
+`config.DIRECTORY_STALE_TTL` seconds, while a background refresh fetches
+the new listing. Our own writes invalidate the state of the directory
+they happen in. A listing that was running while a state was invalidated
+may predate the write, so it is returned but not cached.
+
+CLASSES DECLARED
+================
+
+DirEntry:
+	a single child of a directory
+
+DirectoryState:
+	the contents of a directory at the time it was listed
+
+DirectoryCache:
+	caches directory states
+
+OBJECTS DECLARED
+================
+
+directories:
+	the application wide directory cache
+"""
+import posixpath
+import stat
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from . import config
+from .connection import pool
+from .logger import logger
+
+if TYPE_CHECKING:
+	from paramiko import SFTPAttributes
+
+	from .database import Sandbox
+	from .merkle import MerkleTree, TreeDiff
+
+Key = Tuple[str, str]
+
+DIRECTORY = "d"
+FILE = "f"
+SYMLINK = "l"
+OTHER = "o"
+
+
+def get_entry_type(mode: int) -> str:
+	"""
+	Returns: the type of a directory child with the given st_mode
+	"""
+
+	if stat.S_ISDIR(mode):
+		return DIRECTORY
+	if stat.S_ISREG(mode):
+		return FILE
+	if stat.S_ISLNK(mode):
+		return SYMLINK
+	return OTHER
+
+
+class DirEntry(NamedTuple):
+	"""a single child of a directory"""
+
+	name: str
+	type: str
+	"one of DIRECTORY, FILE, SYMLINK or OTHER"
+	size: int
+	mtime: float
+
+	@property
+	def st_size(self) -> int:
+		return self.size
+
+	@property
+	def st_mtime(self) -> float:
+		return self.mtime
+
+	@classmethod
+	def from_attrs(cls, attrs: 'SFTPAttributes') -> 'DirEntry':
+		return cls(
+			attrs.filename, get_entry_type(attrs.st_mode or 0),
+			attrs.st_size or 0, float(attrs.st_mtime or 0))
+
+
+class DirectoryState:
+	"""This interface represents the contents of a directory.
+	"""
+
+	__slots__ = ("path", "entries", "fetched_at")
+
+	path: str
+	"absolute path of the directory on the sandbox"
+
+	entries: Tuple[DirEntry, ...]
+	"the children of the directory, sorted by name"
+
+	fetched_at: float
+	"a monotonic timestamp showing when the directory was listed"
+
+	def __init__(
+		self, path: str, entries: Iterable[DirEntry],
+		fetched_at: Optional[float] = None
+	):
+		self.path = path
+		self.entries = tuple(sorted(entries))
+		self.fetched_at = time.monotonic() if fetched_at is None else fetched_at
+
+	def __iter__(self):
+		return iter(self.entries)
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+	@property
+	def age(self) -> float:
+		return time.monotonic() - self.fetched_at
+
+	def get(self, name: str) -> Optional[DirEntry]:
+		"""
+		get a child of the directory by name
+		"""
+
+		for entry in self.entries:
+			if entry.name == name:
+				return entry
+		return None
+
+
+def get_directory_key(sandbox: 'Sandbox', path: str) -> Key:
+	return (sandbox.name, posixpath.normpath(path))  # type: ignore
+
+
+class DirectoryCache:
+	"""This interface caches directory states of sandboxes.
+
+	With `stale_while_revalidate` on, a state older than `ttl` but younger
+	than `stale_ttl` is returned right away and refreshed in the
+	background. Otherwise a stale state is refreshed before it is
+	returned.
+	"""
+
+	def __init__(
+		self,
+		ttl: float = config.DIRECTORY_TTL,
+		stale_ttl: float = config.DIRECTORY_STALE_TTL,
+		max_entries: int = config.DIRECTORY_CACHE_SIZE,
+		stale_while_revalidate: bool = True,
+	):
+		self.ttl = ttl
+		self.stale_ttl = stale_ttl
+		self.max_entries = max_entries
+		self.stale_while_revalidate = stale_while_revalidate
+		self._states: 'OrderedDict[Key, DirectoryState]' = OrderedDict()
+		self._refreshing: Dict[Key, threading.Thread] = {}
+		self._generation = 0
+		self._lock = threading.RLock()
+
+	def __contains__(self, key: Key) -> bool:
+		return key in self._states
+
+	def fetch(self, sandbox: 'Sandbox', path: str) -> DirectoryState:
+		"""
+		list a directory on a sandbox and cache its state
+		"""
+
+		key = get_directory_key(sandbox, path)
+		generation = self._generation
+		with pool.sftp(sandbox) as sftp:
+			attrs = sftp.listdir_attr(key[1])
+		state = DirectoryState(key[1], map(DirEntry.from_attrs, attrs))
+		with self._lock:
+			if generation == self._generation:
+				self.put(sandbox, state)
+			else:
+				logger.debug("not caching %s; it was invalidated while listed",
+					key[1])
+		return state
+
+	def put(self, sandbox: 'Sandbox', state: DirectoryState):
+		"""
+		cache the state of a directory
+		"""
+
+		key = get_directory_key(sandbox, state.path)
+		with self._lock:
+			self._states[key] = state
+			self._states.move_to_end(key)
+			while len(self._states) > self.max_entries:
+				self._states.popitem(last=False)
+
+	def get(
+		self, sandbox: 'Sandbox', path: str, refresh: bool = False,
+		stale: bool = True
+	) -> DirectoryState:
+		"""
+		get the state of a directory on a sandbox
+
+		Args:
+			sandbox: an instance of database.Sandbox
+			path: absolute path of the directory
+			refresh: list the directory even if its state is fresh
+			stale: return a stale state while it is refreshed in the
+				background, if `stale_while_revalidate` is on
+		"""
+
+		key = get_directory_key(sandbox, path)
+		with self._lock:
+			state = self._states.get(key)
+			if state is not None:
+				self._states.move_to_end(key)
+		if state is None or refresh:
+			return self.fetch(sandbox, path)
+		age = state.age
+		if age <= self.ttl:
+			return state
+		if stale and self.stale_while_revalidate and age <= self.stale_ttl:
+			self.revalidate(sandbox, path)
+			return state
+		return self.fetch(sandbox, path)
+
+	def revalidate(self, sandbox: 'Sandbox', path: str):
+		"""
+		refresh the state of a directory in the background. nothing is done
+		if a refresh of the directory is already running.
+		"""
+
+		key = get_directory_key(sandbox, path)
+		with self._lock:
+			if key in self._refreshing:
+				return
+			thread = threading.Thread(
+				target=self._refresh, args=(sandbox, path, key),
+				name="alexis-directory-refresh", daemon=True,
+			)
+			self._refreshing[key] = thread
+		thread.start()
+
+	def _refresh(self, sandbox: 'Sandbox', path: str, key: Key):
+		try:
+			self.fetch(sandbox, path)
+		except Exception as err:
+			logger.debug("could not refresh %s: %s", path, err)
+		finally:
+			with self._lock:
+				self._refreshing.pop(key, None)
+
+	def refresh_tree(
+		self, sandbox: 'Sandbox', root: str
+	) -> Tuple['MerkleTree', 'TreeDiff']:
+		"""
+		refresh the states of every cached directory under `root` with a
+		single run of the tree helper (see `merkle`). states of directories
+		that didn't change are marked fresh without listing them again.
+
+		Returns: the tree of `root` and what changed in it
+		"""
+
+		from .merkle import trees
+
+		tree, diff = trees.refresh(sandbox, root)
+		self.apply_tree(sandbox, tree)
+		trees.commit(sandbox, tree)
+		return tree, diff
+
+	def apply_tree(self, sandbox: 'Sandbox', tree: 'MerkleTree'):
+		"""
+		replace the states of the cached directories a tree holds with
+		their listing in the tree
+		"""
+
+		with self._lock:
+			cached = [
+				key for key in self._states
+				if key[0] == sandbox.name and (key[1] == tree.root
+					or key[1].startswith(tree.root.rstrip("/") + "/"))
+			]
+		for key in cached:
+			state = tree.listing(key[1])
+			if state is None:
+				self.invalidate(sandbox, key[1])
+			else:
+				self.put(sandbox, state)
+
+	def invalidate(self, sandbox: 'Sandbox', path: str):
+		"""
+		forget the state of a directory
+		"""
+
+		with self._lock:
+			self._generation += 1
+			self._states.pop(get_directory_key(sandbox, path), None)
+
+	def invalidate_file(self, sandbox: 'Sandbox', path: str):
+		"""
+		forget the state of the directory a file lives in. called after
+		a file is written.
+		"""
+
+		self.invalidate(sandbox, posixpath.dirname(posixpath.normpath(path)))
+
+	def clear(self, sandbox: Optional['Sandbox'] = None):
+		"""
+		forget every directory state, or only those of a sandbox
+		"""
+
+		with self._lock:
+			self._generation += 1
+			if sandbox is None:
+				self._states.clear()
+				return
+			for key in [key for key in self._states if key[0] == sandbox.name]:
+				del self._states[key]
+
+
+directories = DirectoryCache()
@@ -0,0 +1,352 @@
+"""
+This module contains the eviction policies of the cache manager.
+
+A policy orders the synced caches of a sandbox and picks which one is
+evicted next. The cache manager keeps one policy per sandbox, chosen by
+`config.CACHE_POLICIES` (or `config.CACHE_POLICY` for sandboxes that are
+not listed), and asks each of them for a candidate when the cache is over
+its budget.
+
+A plain LRU evicts the working set whenever a large directory is read
+once. LFU and ARC remember how often each cache was used, so a one-off
+scan only evicts other caches that were used once.
+
+CLASSES DECLARED
+================
+
+EvictionPolicy:
+	the interface every policy implements
+
+LRUPolicy:
+	evicts the least recently used cache
+
+LFUPolicy:
+	evicts the least frequently used cache, with dynamic aging
+
+ARCPolicy:
+	adaptive replacement cache, balancing recency and frequency
+
+FUNCTIONS DECLARED
+==================
+
+get_policy(sandbox):
+	creates the policy configured for a sandbox
+"""
+import heapq
+import itertools
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Type
+
+from . import config
+
+if TYPE_CHECKING:
+	from .caching import CacheEntry
+
+
+class EvictionPolicy(ABC):
+	"""This interface orders the synced caches of a sandbox for eviction.
+
+	Policies only see synced caches; the manager keeps caches with
+	unsynced changes away from them. Every method is called with the
+	manager's lock held.
+	"""
+
+	name = ""
+	"the name the policy is selected by in `config`"
+
+	@abstractmethod
+	def __len__(self) -> int:
+		"""the number of caches the policy holds"""
+
+	@abstractmethod
+	def __contains__(self, hash: str) -> bool:
+		"""whether the policy holds the cache with `hash`"""
+
+	@abstractmethod
+	def __iter__(self) -> Iterator['CacheEntry']:
+		"""the entries of the caches the policy holds"""
+
+	@abstractmethod
+	def insert(self, entry: 'CacheEntry'):
+		"""
+		start ordering a cache. `entry.hits` says how often it was used
+		before, if it was tracked before.
+		"""
+
+	@abstractmethod
+	def touch(self, entry: 'CacheEntry'):
+		"""
+		record a use of a cache the policy already holds. `entry.hits`
+		already counts this use if it was a new reference to the cache;
+		further uses within the same open leave it as it was.
+		"""
+
+	def refresh(self, entry: 'CacheEntry'):
+		"""
+		replace the entry of a cache the policy already holds, after it
+		was synced or resized. this is not a use of the cache.
+		"""
+
+		self.insert(entry)
+
+	@abstractmethod
+	def remove(self, hash: str, evicted: bool = False) -> Optional['CacheEntry']:
+		"""
+		stop ordering a cache
+
+		Args:
+			hash: the cache's hash
+			evicted: True if the cache is being evicted, False if it is
+			being untracked or has changes to sync
+
+		Returns: the cache's entry, or None if the policy didn't hold it
+		"""
+
+	@abstractmethod
+	def victim(self, keep: Optional[str] = None) -> Optional['CacheEntry']:
+		"""
+		get the cache that should be evicted next, without removing it
+
+		Args:
+			keep: the hash of a cache that must not be picked
+		"""
+
+
+class LRUPolicy(EvictionPolicy):
+	"""This interface evicts the least recently used cache first.
+
+	Entries live in an ordered dictionary with the least recently used
+	entry first, so every operation is O(1).
+	"""
+
+	name = "lru"
+
+	def __init__(self):
+		self._entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def __contains__(self, hash: str) -> bool:
+		return hash in self._entries
+
+	def __iter__(self) -> Iterator['CacheEntry']:
+		return iter(list(self._entries.values()))
+
+	def insert(self, entry: 'CacheEntry'):
+		self._entries[entry.hash] = entry
+		self._entries.move_to_end(entry.hash)
+
+	def touch(self, entry: 'CacheEntry'):
+		self.insert(entry)
+
+	def remove(self, hash: str, evicted: bool = False) -> Optional['CacheEntry']:
+		return self._entries.pop(hash, None)
+
+	def victim(self, keep: Optional[str] = None) -> Optional['CacheEntry']:
+		for hash, entry in self._entries.items():
+			if hash != keep:
+				return entry
+		return None
+
+
+class LFUPolicy(EvictionPolicy):
+	"""This interface evicts the least frequently used cache first.
+
+	An entry's priority is the number of times it was used plus the age
+	of the policy, which is the priority of the last entry evicted
+	(LFU with dynamic aging). Caches that were popular long ago therefore
+	age out instead of staying forever. Ties go to the least recently
+	used entry.
+
+	Priorities live in a heap; entries whose priority changed are left in
+	it and skipped when they come up.
+	"""
+
+	name = "lfu"
+
+	def __init__(self):
+		self.age = 0.0
+		self._entries: Dict[str, 'CacheEntry'] = {}
+		self._priority: Dict[str, float] = {}
+		self._heap: List[Tuple[float, float, int, str]] = []
+		self._seq = itertools.count()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def __contains__(self, hash: str) -> bool:
+		return hash in self._entries
+
+	def __iter__(self) -> Iterator['CacheEntry']:
+		return iter(list(self._entries.values()))
+
+	def _push(self, entry: 'CacheEntry'):
+		priority = self.age + max(entry.hits, 1)
+		self._priority[entry.hash] = priority
+		heapq.heappush(
+			self._heap, (priority, entry.accessed, next(self._seq), entry.hash))
+		if len(self._heap) > 2 * len(self._entries) + 64:
+			self._heap = [
+				(self._priority[e.hash], e.accessed, next(self._seq), e.hash)
+				for e in self._entries.values()
+			]
+			heapq.heapify(self._heap)
+
+	def insert(self, entry: 'CacheEntry'):
+		self._entries[entry.hash] = entry
+		self._push(entry)
+
+	def touch(self, entry: 'CacheEntry'):
+		self.insert(entry)
+
+	def remove(self, hash: str, evicted: bool = False) -> Optional['CacheEntry']:
+		entry = self._entries.pop(hash, None)
+		priority = self._priority.pop(hash, None)
+		if evicted and priority is not None:
+			self.age = max(self.age, priority)
+		return entry
+
+	def _valid(self, item: Tuple[float, float, int, str]) -> bool:
+		priority, accessed, _, hash = item
+		entry = self._entries.get(hash)
+		return (entry is not None and self._priority[hash] == priority
+			and entry.accessed == accessed)
+
+	def victim(self, keep: Optional[str] = None) -> Optional['CacheEntry']:
+		skipped = victim = None
+		while self._heap:
+			item = self._heap[0]
+			if not self._valid(item):
+				heapq.heappop(self._heap)
+			elif item[3] == keep:
+				skipped = heapq.heappop(self._heap)
+			else:
+				victim = self._entries[item[3]]
+				break
+		if skipped is not None:
+			heapq.heappush(self._heap, skipped)
+		return victim
+
+
+class ARCPolicy(EvictionPolicy):
+	"""This interface is an adaptive replacement cache.
+
+	Caches used at most once live in `recent` and caches used more than
+	once in `frequent`, both in least recently used order. The hashes of caches
+	evicted from either list are remembered in a ghost list; using one of
+	them again moves the target size of `recent` towards the list it was
+	evicted from. A scan only fills `recent`, so `frequent`, the working
+	set, survives it.
+
+	ARC is defined for a cache of a fixed number of entries, but the
+	manager's budget is in bytes, so the capacity is taken to be the number
+	of entries the policy holds.
+	"""
+
+	name = "arc"
+
+	def __init__(self):
+		self.target = 0.0
+		self.recent: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+		self.frequent: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+		self._recent_ghosts: 'OrderedDict[str, None]' = OrderedDict()
+		self._frequent_ghosts: 'OrderedDict[str, None]' = OrderedDict()
+
+	def __len__(self) -> int:
+		return len(self.recent) + len(self.frequent)
+
+	def __contains__(self, hash: str) -> bool:
+		return hash in self.recent or hash in self.frequent
+
+	def __iter__(self) -> Iterator['CacheEntry']:
+		return iter(list(self.recent.values()) + list(self.frequent.values()))
+
+	@property
+	def capacity(self) -> int:
+		return max(len(self), 1)
+
+	def insert(self, entry: 'CacheEntry'):
+		hash = entry.hash
+		if hash in self._recent_ghosts:
+			del self._recent_ghosts[hash]
+			ratio = len(self._frequent_ghosts) / (len(self._recent_ghosts) + 1)
+			self.target = min(self.target + max(ratio, 1), self.capacity)
+			self.frequent[hash] = entry
+		elif hash in self._frequent_ghosts:
+			del self._frequent_ghosts[hash]
+			ratio = len(self._recent_ghosts) / (len(self._frequent_ghosts) + 1)
+			self.target = max(self.target - max(ratio, 1), 0)
+			self.frequent[hash] = entry
+		elif entry.hits > 1:
+			self.frequent[hash] = entry
+		else:
+			self.recent[hash] = entry
+
+	def touch(self, entry: 'CacheEntry'):
+		if entry.hits > 1 or entry.hash in self.frequent:
+			self.recent.pop(entry.hash, None)
+			self.frequent[entry.hash] = entry
+			self.frequent.move_to_end(entry.hash)
+		else:
+			self.refresh(entry)
+
+	def refresh(self, entry: 'CacheEntry'):
+		entries = self.frequent if entry.hash in self.frequent else self.recent
+		entries[entry.hash] = entry
+		entries.move_to_end(entry.hash)
+
+	def remove(self, hash: str, evicted: bool = False) -> Optional['CacheEntry']:
+		entry = self.recent.pop(hash, None)
+		ghosts = self._recent_ghosts
+		if entry is None:
+			entry = self.frequent.pop(hash, None)
+			ghosts = self._frequent_ghosts
+		if entry is not None and evicted:
+			ghosts[hash] = None
+			self._trim()
+		return entry
+
+	def _trim(self):
+		capacity = self.capacity
+		for ghosts in (self._recent_ghosts, self._frequent_ghosts):
+			while len(ghosts) > capacity:
+				ghosts.popitem(last=False)
+		self.target = min(self.target, capacity)
+
+	def victim(self, keep: Optional[str] = None) -> Optional['CacheEntry']:
+		lists = [self.recent, self.frequent]
+		if not self.recent or len(self.recent) <= self.target:
+			lists.reverse()
+		for entries in lists:
+			for hash, entry in entries.items():
+				if hash != keep:
+					return entry
+		return None
+
+
+POLICIES: Dict[str, Type[EvictionPolicy]] = {
+	policy.name: policy for policy in (LRUPolicy, LFUPolicy, ARCPolicy)
+}
+"every policy by name"
+
+
+def get_policy(sandbox: Optional[str]) -> EvictionPolicy:
+	"""
+	create the eviction policy configured for a sandbox
+
+	Args:
+		sandbox: the name of the sandbox, or None for local files
+
+	Raises:
+		ValueError: if the configured policy doesn't exist
+	"""
+
+	name = config.CACHE_POLICIES.get(sandbox or "", config.CACHE_POLICY)
+	try:
+		return POLICIES[name.lower()]()
+	except KeyError:
+		raise ValueError(
+			f"unknown eviction policy '{name}', expected one of "
+			+ ", ".join(POLICIES))
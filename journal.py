@@ -0,0 +1,414 @@
+"""
+This module contains the offline write-ahead journal.
+
+Changes to caches of files on a sandbox are recorded in an append-only
+journal before they are accepted, and a record marking them done is
+appended once they reach the sandbox. Changes that never reached it,
+because the sandbox could not be reached or the application crashed,
+are still pending the next time the journal is read, and are replayed
+when a connection to the sandbox is opened again.
+
+Records don't hold file contents; the cache file always holds the latest
+contents. So changes to the same file coalesce into one pending record
+and only the last state of each file is pushed.
+
+Every change, coalesced or not, gives the pending record a new sequence
+number. A push commits the pending record only up to the sequence number
+it started from (see `Journal.watermark`), so a change made while it was
+pushing stays pending.
+
+RECORD FORMAT
+=============
+
+one record per line: the crc32 of the json payload as 8 hex digits, a
+space, then the payload. a line that is cut short or fails its checksum
+ends the journal; it was being written when the application crashed.
+
+CLASSES DECLARED
+================
+
+Journal:
+	records pending changes and replays them
+
+OBJECTS DECLARED
+================
+
+journal:
+	the application wide journal
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import zlib
+from typing import IO, TYPE_CHECKING, Dict, List, Optional
+
+from . import config
+from .connection import pool
+from .logger import logger
+from .mapping import partial_path
+from .metrics import metrics
+from .network import monitor
+
+if TYPE_CHECKING:
+	from .connection import Key
+
+WRITE = "write"
+APPEND = "append"
+DELETE = "delete"
+DONE = "done"
+
+
+def encode_record(record: dict) -> bytes:
+	payload = json.dumps(record, separators=(",", ":")).encode("utf-8")
+	return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+
+def decode_record(line: bytes) -> Optional[dict]:
+	"""
+	Returns: the record held by a journal line, or None if the line is
+	torn or corrupt
+	"""
+
+	if len(line) < 10 or not line.endswith(b"\n") or line[8:9] != b" ":
+		return None
+	payload = line[9:-1]
+	try:
+		if int(line[:8], 16) != zlib.crc32(payload):
+			return None
+		return json.loads(payload)
+	except ValueError:
+		return None
+
+
+class Journal:
+	"""This interface keeps the changes that have not reached a sandbox.
+
+	The pending change of every cache is kept in memory. A change to a
+	cache that already has a pending write is not recorded again, so a
+	burst of writes to a file costs one journal record. It only moves the
+	pending record to a new sequence number in memory, which keeps a
+	commit from a push that began before it from taking the record away.
+	"""
+
+	def __init__(
+		self,
+		path: Optional[str] = None,
+		fsync: bool = config.JOURNAL_FSYNC,
+		compact_after: int = config.JOURNAL_COMPACT_AFTER,
+	):
+		self._path = path
+		self.fsync = fsync
+		self.compact_after = compact_after
+		self.replayed = 0
+		self._pending: Dict[str, dict] = {}
+		self._records = 0
+		self._seq = 0
+		self._file: Optional[IO[bytes]] = None
+		self._loaded = False
+		self._lock = threading.RLock()
+		self._replaying = threading.Lock()
+
+	@property
+	def path(self) -> str:
+		return self._path or config.JOURNAL_FILE
+
+	def __len__(self) -> int:
+		self.load()
+		return len(self._pending)
+
+	def __contains__(self, hash: str) -> bool:
+		self.load()
+		return hash in self._pending
+
+	def _apply(self, record: dict):
+		"""
+		fold a record into the pending changes
+		"""
+
+		hash, op = record["hash"], record["op"]
+		pending = self._pending.get(hash)
+		if op == DONE:
+			if pending is not None and pending["seq"] <= record["upto"]:
+				del self._pending[hash]
+		elif op == DELETE or pending is None or pending["op"] == DELETE:
+			self._pending[hash] = record
+		elif op == WRITE:
+			pending["op"] = WRITE
+		self._seq = max(self._seq, record["seq"] + 1)
+
+	def load(self):
+		"""
+		read the journal from disk. a torn record at the end of the
+		journal is cut off.
+		"""
+
+		if self._loaded:
+			return
+		with self._lock:
+			if self._loaded:
+				return
+			self._loaded = True
+			if not os.path.isfile(self.path):
+				return
+			good = 0
+			with open(self.path, "rb") as f:
+				for line in f:
+					record = decode_record(line)
+					if record is None:
+						break
+					self._apply(record)
+					self._records += 1
+					good += len(line)
+			if good < os.path.getsize(self.path):
+				logger.warning("discarding a torn record at the end of the journal")
+				with open(self.path, "r+b") as f:
+					f.truncate(good)
+			logger.debug("journal has %d pending changes", len(self._pending))
+
+	def _append(self, records: List[dict]):
+		if self._file is None:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			self._file = open(self.path, "ab")
+		self._file.write(b"".join(encode_record(record) for record in records))
+		self._file.flush()
+		if self.fsync:
+			os.fsync(self._file.fileno())
+		self._records += len(records)
+
+	def record(self, op: str, hash: str, sandbox: str, origin: str) -> bool:
+		"""
+		record a change to a cache before it is accepted
+
+		Args:
+			op: WRITE, APPEND or DELETE
+			hash: the cache's hash
+			sandbox: the name of the sandbox the original lives on
+			origin: the path of the original on the sandbox
+
+		Returns: True if a new record was written, False if the change
+		coalesced into one that is already pending
+		"""
+
+		self.load()
+		with self._lock:
+			pending = self._pending.get(hash)
+			if op != DELETE and pending is not None and pending["op"] != DELETE:
+				if op == WRITE:
+					pending["op"] = WRITE
+				pending["seq"] = self._seq
+				self._seq += 1
+				return False
+			record = dict(seq=self._seq, op=op, hash=hash, sandbox=sandbox,
+				origin=origin, time=time.time())
+			self._append([record])
+			self._apply(record)
+			return True
+
+	def watermark(self) -> int:
+		"""
+		Returns: a sequence number that every change recorded from now on
+		is above. taken before a push, it is the `upto` of its commit.
+		"""
+
+		self.load()
+		with self._lock:
+			return self._seq - 1
+
+	def commit(self, *hashes: str, upto: Optional[int] = None) -> int:
+		"""
+		record that the pending changes of caches have reached the sandbox
+
+		Args:
+			hashes: the hashes of the caches that were pushed
+			upto: the last sequence number the push included. a change with
+				a higher number was made during the push and stays pending.
+				None commits every pending change.
+
+		Returns: the number of changes committed
+		"""
+
+		self.load()
+		with self._lock:
+			records = []
+			for hash in hashes:
+				pending = self._pending.get(hash)
+				if pending is None or (upto is not None and pending["seq"] > upto):
+					# changed again after the push began; it stays pending
+					continue
+				records.append(dict(
+					seq=self._seq, op=DONE, hash=hash, upto=pending["seq"]))
+				self._seq += 1
+			if not records:
+				return 0
+			self._append(records)
+			for record in records:
+				self._apply(record)
+			if self._records > self.compact_after:
+				self.compact()
+			return len(records)
+
+	def pending(self, sandbox: Optional[str] = None) -> List[dict]:
+		"""
+		get the pending change of every cache, oldest first
+
+		Args:
+			sandbox: only get the changes to files on this sandbox
+		"""
+
+		self.load()
+		with self._lock:
+			records = [dict(record) for record in self._pending.values()
+				if sandbox is None or record["sandbox"] == sandbox]
+		return sorted(records, key=lambda record: record["seq"])
+
+	def compact(self):
+		"""
+		rewrite the journal so it only holds the pending changes
+		"""
+
+		self.load()
+		with self._lock:
+			records = sorted(self._pending.values(), key=lambda r: r["seq"])
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			partial = partial_path(self.path)
+			try:
+				with open(partial, "wb") as f:
+					f.write(b"".join(encode_record(record) for record in records))
+					f.flush()
+					os.fsync(f.fileno())
+			except BaseException:
+				os.remove(partial)
+				raise
+			self.close()
+			os.replace(partial, self.path)
+			self._records = len(records)
+		logger.debug("compacted the journal to %d records", len(records))
+
+	def replay(
+		self, sandbox: Optional[str] = None, hashes: Optional[List[str]] = None
+	) -> int:
+		"""
+		push the pending changes to their sandboxes, over a single pooled
+		sftp channel per sandbox. changes that still can't be pushed stay
+		pending.
+
+		Args:
+			sandbox: only replay the changes to files on this sandbox
+			hashes: only replay the changes to these caches
+
+		Returns: the number of changes pushed
+		"""
+
+		from .registry import registry
+
+		by_sandbox: Dict[str, List[dict]] = {}
+		for record in self.pending(sandbox):
+			if hashes is not None and record["hash"] not in hashes:
+				continue
+			by_sandbox.setdefault(record["sandbox"], []).append(record)
+		pushed = 0
+		with self._replaying:
+			for name, records in by_sandbox.items():
+				row = registry.get(name)
+				if row is None:
+					logger.warning("can't replay changes to unknown sandbox '%s'", name)
+					continue
+				pushed += self._replay(row, records)
+		self.replayed += pushed
+		return pushed
+
+	def _replay(self, sandbox, records: List[dict]) -> int:
+		from .cache import Cache, cache_exists
+		from .directory import directories
+		from .remote import RemoteFile
+
+		done: List[dict] = []
+		dropped: List[dict] = []
+		try:
+			with metrics.span("journal.replay", sandbox=sandbox.name):
+				with pool.sftp(sandbox) as sftp:
+					for record in records:
+						hash, origin = record["hash"], record["origin"]
+						try:
+							if record["op"] == DELETE:
+								try:
+									sftp.remove(origin)
+								except FileNotFoundError:
+									pass
+							elif not cache_exists(hash):
+								# building a Cache would create an empty one
+								# and push it over the original
+								raise FileNotFoundError(
+									f"the cache of '{origin}' is gone")
+							else:
+								cache = Cache(RemoteFile(sandbox, origin))
+								cache._syncing = True  # not a use of the file
+								with sftp.open(origin, "wb") as dst:
+									dst.set_pipelined(True)
+									for chunk in cache.iter_bytes():
+										dst.write(chunk)
+										metrics.inc("bytes.up", len(chunk))
+							directories.invalidate_file(sandbox, origin)
+							done.append(record)
+						except FileNotFoundError as err:
+							# the cache file is gone; there is nothing to push
+							logger.warning("can't replay '%s': %s", origin, err)
+							dropped.append(record)
+						except OSError as err:
+							if not pool.get(sandbox).alive:
+								raise
+							logger.error("can't replay '%s': %s", origin, err)
+		except Exception as err:
+			logger.warning("sandbox '%s' is unreachable: %s", sandbox.name, err)
+		for record in done:
+			# a change made while replaying has a higher seq and stays pending
+			if record["op"] != DELETE:
+				Cache(RemoteFile(sandbox, record["origin"])).mark_synced(
+					record["seq"])
+			else:
+				self.commit(record["hash"], upto=record["seq"])
+		for record in dropped:
+			self.commit(record["hash"], upto=record["seq"])
+		if done:
+			logger.info("replayed %d changes to '%s'", len(done), sandbox.name)
+		return len(done)
+
+	def on_connect(self, key: 'Key'):
+		"""
+		replay the changes to a sandbox once a connection to it is opened
+		"""
+
+		host, username = key
+		self._replay_host(host, username)
+
+	def on_online(self, host: str, online: bool):
+		"""
+		replay the changes to the sandboxes on a host once it can be
+		reached again
+		"""
+
+		if online:
+			self._replay_host(host)
+
+	def _replay_host(self, host: str, username: Optional[str] = None):
+		from .registry import registry
+
+		if not len(self):
+			return
+		for row in registry.on_host(host, username):
+			if self.pending(row.name):
+				self.replay(row.name)
+
+	def close(self):
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+
+journal = Journal()
+pool.add_listener(journal.on_connect)
+monitor.subscribe(journal.on_online)
+atexit.register(journal.close)
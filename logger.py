@@ -1,8 +1,27 @@
 import logging
 from .config import DEBUG_MODE_ON, LOG_FORMAT, LOG_LEVEL
-from rich.logging import RichHandler
 
-handler = RichHandler(
+
+class LazyRichHandler(logging.Handler):
+	"""This handler creates a rich handler the first time a record is
+	emitted, so importing the logger doesn't import rich.
+	"""
+
+	def __init__(self, **options):
+		super().__init__()
+		self._options = options
+		self._handler = None
+
+	def emit(self, record: logging.LogRecord):
+		if self._handler is None:
+			from rich.logging import RichHandler
+
+			self._handler = RichHandler(**self._options)
+			self._handler.setFormatter(self.formatter)
+		self._handler.emit(record)
+
+
+handler = LazyRichHandler(
 	show_time=False,
 	show_level=DEBUG_MODE_ON,
 	show_path=DEBUG_MODE_ON,
@@ -17,4 +36,4 @@ logging.basicConfig(
 	handlers=[handler]
 )
 logger = logging.getLogger("alexis")
-logger.setLevel(LOG_LEVEL)
\ No newline at end of file
+logger.setLevel(LOG_LEVEL)
@@ -1,16 +1,166 @@
-from cache import CacheFile as cache
+"""
+This module contains the one-time setup of the application.
+
+Setup creates the application's directories and database tables, then
+writes `config.SETUP_MARKER`. Once the marker is present, startup only
+checks that it exists.
+
+FUNCTIONS DECLARED
+==================
+
+namespace_caches():
+	moves caches made before sandboxes had namespaces into them
+
+is_setup():
+	checks whether setup has been done
+
+setup(force):
+	creates the application's directories and database tables
+"""
+import errno
 import os
-from config import CACHE_DIR, CHECKPOINT_DIR, METADATA_DIR
-from logger import logger
-
-
-def setup():
-	if not os.path.exists(CACHE_DIR):
-		logger.debug("creating cache directory")
-		os.mkdir(CACHE_DIR)
-	if not os.path.exists(METADATA_DIR):
-		logger.debug("creating metadata directory")
-		os.mkdir(METADATA_DIR)
-	if not os.path.exists(CHECKPOINT_DIR):
-		logger.debug("creating checkpoint directory")
-		os.mkdir(CHECKPOINT_DIR)
\ No newline at end of file
+
+from . import config
+from .logger import logger
+
+SETUP_VERSION = 4
+"bump this whenever setup() changes, so that it runs again"
+
+
+def make_directory(path: str, name: str):
+	"""
+	create a directory the application needs, exiting if it can't be
+	created
+
+	Args:
+		path: the path of the directory
+		name: what the directory is for, used in messages
+	"""
+
+	if os.path.isdir(path):
+		logger.debug("%s exists", path)
+		return
+	if os.path.exists(path):
+		logger.critical(
+			"%s directory path %s already exists but is not a directory.",
+			name, path
+		)
+		exit(errno.EEXIST)
+	try:
+		os.makedirs(path)
+	except PermissionError:
+		logger.critical("not enough permissons to create %s directory %s",
+			name, path)
+		exit(errno.EACCES)
+	logger.debug("created %s directory", name)
+
+
+def namespace_caches() -> int:
+	"""
+	move caches whose hash was made from the path of the original alone
+	to the hash of their sandbox's namespace, along with their metadata
+	and snapshots. if a cache already exists under the new hash, e.g.
+	after an earlier run was interrupted, the one modified last is kept
+	and the snapshots of both are. running it again changes nothing.
+
+	Returns: the number of caches moved
+	"""
+
+	from peewee import fn
+
+	from .cache import get_cache_hash, get_cache_location
+	from .compression import get_compressed_location
+	from .database import DB, CacheMetadata, Snapshot
+
+	def remove(hash: str):
+		for locate in (get_cache_location, get_compressed_location):
+			try:
+				os.remove(locate(hash))
+			except FileNotFoundError:
+				pass
+
+	moved = 0
+	query = (CacheMetadata
+		.select(CacheMetadata.hash, CacheMetadata.origin, CacheMetadata.sandbox,
+			CacheMetadata.modified_at)
+		.where(CacheMetadata.sandbox.is_null(False))
+		.tuples())
+	with DB.atomic():
+		for old, origin, sandbox, modified_at in list(query):
+			new = get_cache_hash(origin, sandbox)
+			if new == old:
+				continue
+			existing = CacheMetadata.get_or_none(CacheMetadata.hash == new)
+			if existing is not None and existing.modified_at >= modified_at:
+				# the cache under the new hash is newer; drop the old one
+				CacheMetadata.delete().where(CacheMetadata.hash == old).execute()
+				remove(old)
+			else:
+				if existing is not None:
+					CacheMetadata.delete().where(CacheMetadata.hash == new).execute()
+					remove(new)
+				CacheMetadata.update(hash=new).where(
+					CacheMetadata.hash == old).execute()
+				for locate in (get_cache_location, get_compressed_location):
+					try:
+						os.replace(locate(old), locate(new))
+					except FileNotFoundError:
+						pass
+			# versions of the old hash go after those of the new one
+			offset = (Snapshot.select(fn.MAX(Snapshot.version))
+				.where(Snapshot.cache == new).scalar() or 0)
+			Snapshot.update(cache=new, version=Snapshot.version + offset).where(
+				Snapshot.cache == old).execute()
+			moved += 1
+	if moved:
+		logger.info("moved %d caches into their sandbox's namespace", moved)
+	return moved
+
+
+def is_setup() -> bool:
+	"""
+	Returns: True if setup has been done by this version of the
+	application
+	"""
+
+	try:
+		with open(config.SETUP_MARKER, "r") as marker:
+			return marker.read().strip() == str(SETUP_VERSION)
+	except OSError:
+		return False
+
+
+def setup(force: bool = False):
+	"""
+	create the application's directories and database tables, unless
+	that has been done already
+
+	Args:
+		force: run setup even if the marker is present
+	"""
+
+	if not force and is_setup():
+		return
+	from .database import DB, MODELS
+
+	make_directory(config.CACHE_DIR, "cache")
+	make_directory(config.METADATA_DIR, "metadata")
+	make_directory(config.DATA_DIR, "data")
+	make_directory(config.CHECKPOINT_DIR, "checkpoint")
+	if os.path.exists(config.DATABASE) and not os.path.isfile(config.DATABASE):
+		logger.critical(
+			"database %s already exists but is not a file.", config.DATABASE)
+		exit(errno.EEXIST)
+	try:
+		logger.debug("creating database tables...")
+		DB.connect(reuse_if_open=True)
+		DB.create_tables(MODELS, safe=True)
+		namespace_caches()
+		DB.close()
+		with open(config.SETUP_MARKER, "w") as marker:
+			marker.write(str(SETUP_VERSION))
+	except PermissionError:
+		logger.critical("not enough permissons to create database %s",
+			config.DATABASE)
+		exit(errno.EACCES)
+	logger.debug("setup done")
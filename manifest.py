@@ -0,0 +1,216 @@
+"""
+This module contains the batched freshness check.
+
+Instead of one sftp stat per cache, the originals of every cache on a
+sandbox are stat'ed by a single remote command. The command's output is
+parsed into a manifest: a map of path to (size, mtime, mode), which then
+drives the usual modified_at/last_sync comparison of each cache.
+
+FUNCTIONS DECLARED
+==================
+
+batch_stat(sandbox, paths):
+	stat many files on a sandbox with a single command
+
+sync_caches(caches):
+	sync many caches with one freshness check per sandbox
+
+sync_tree(sandbox, root):
+	sync the caches of the files that changed under a directory
+"""
+import stat
+import posixpath
+from typing import (
+	TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Sequence
+)
+
+from .connection import pool
+from .logger import logger
+from .metrics import metrics
+
+if TYPE_CHECKING:
+	from .cache import Cache
+	from .database import Sandbox
+
+# size, mtime, ctime, permissions, type and path of every file, separated
+# by NUL so that any path can be parsed back
+FIND_FORMAT = r"%s %T@ %C@ %m %y %p\0"
+
+STAT_COMMAND = (
+	"xargs -0 sh -c 'exec find \"$@\" -maxdepth 0 -printf \"{}\"' sh"
+	.format(FIND_FORMAT)
+)
+
+FILE_TYPES = {
+	"f": stat.S_IFREG,
+	"d": stat.S_IFDIR,
+	"l": stat.S_IFLNK,
+}
+
+
+class RemoteStat(NamedTuple):
+	"""the stat of a file on a sandbox, as listed in a manifest"""
+
+	st_size: int
+	st_mtime: float
+	st_mode: int
+	st_ctime: float
+
+
+Manifest = Dict[str, RemoteStat]
+
+
+def parse_manifest(output: bytes) -> Manifest:
+	"""
+	parse the output of `STAT_COMMAND`
+
+	Returns: a map of path to stat
+	"""
+
+	manifest: Manifest = {}
+	for record in output.split(b"\0"):
+		if not record:
+			continue
+		try:
+			size, mtime, ctime, mode, kind, path = record.split(b" ", 5)
+			manifest[path.decode("utf-8", "surrogateescape")] = RemoteStat(
+				int(size), float(mtime),
+				int(mode, 8) | FILE_TYPES.get(kind.decode(), 0), float(ctime),
+			)
+		except ValueError:
+			logger.debug("could not parse manifest record %r", record)
+	return manifest
+
+
+def batch_stat(sandbox: 'Sandbox', paths: Iterable[str]) -> Manifest:
+	"""
+	stat many files on a sandbox with a single remote command
+
+	Args:
+		sandbox: an instance of database.Sandbox
+		paths: absolute paths of files on the sandbox
+
+	Returns: a map of path to stat. paths that don't exist are left out.
+	"""
+
+	paths = list(paths)
+	if not paths:
+		return {}
+	stdin = b"\0".join(
+		path.encode("utf-8", "surrogateescape") for path in paths) + b"\0"
+	with metrics.span("manifest.batch_stat", paths=len(paths)):
+		status, out, err = pool.exec_command(sandbox, STAT_COMMAND, stdin=stdin)
+	if status != 0:
+		# find exits with an error when some paths are missing, but it
+		# still lists every path it could stat
+		logger.debug("stat command exited with %d: %s", status, err)
+	manifest = parse_manifest(out)
+	logger.debug("stat'ed %d of %d files in one round-trip",
+		len(manifest), len(paths))
+	return manifest
+
+
+def sync_caches(caches: Sequence['Cache']) -> List['Cache']:
+	"""
+	sync many caches with their originals, stat'ing the originals on each
+	sandbox with a single command. caches whose original is missing are
+	left alone.
+
+	Returns: the caches that were synced
+	"""
+
+	synced = []
+	by_sandbox: Dict[str, List['Cache']] = {}
+	sandboxes: Dict[str, 'Sandbox'] = {}
+	for cache in caches:
+		sandbox = getattr(cache.file, "sandbox", None)
+		if sandbox is None:
+			cache.open()
+			synced.append(cache)
+			continue
+		sandboxes[sandbox.name] = sandbox
+		by_sandbox.setdefault(sandbox.name, []).append(cache)
+
+	for name, group in by_sandbox.items():
+		manifest = batch_stat(sandboxes[name], (c.file.path for c in group))
+		for cache in group:
+			file_stat = manifest.get(cache.file.path)
+			if file_stat is None:
+				logger.warning("original of '%s' is missing", cache.file.path)
+				continue
+			if cache.needs_sync(file_stat):
+				cache.open(file_stat)
+				synced.append(cache)
+	return synced
+
+
+def sync_tree(sandbox: 'Sandbox', root: str) -> List['Cache']:
+	"""
+	sync the caches of files under a directory on a sandbox, with a single
+	run of the tree helper (see `merkle`) instead of a stat per file.
+	every cache is compared with its original's stat in the tree, so
+	caches with local changes are pushed and changed originals are
+	pulled. caches whose original was deleted are evicted, or recreate
+	the original if they have changes of their own. if the tree helper
+	can't run, the caches are checked with `sync_caches` instead.
+
+	The tree is committed only if every cache could be synced.
+
+	Returns: the caches that were synced
+	"""
+
+	from .cache import Cache, CacheState, get_cache_hash
+	from .caching import manager
+	from .directory import directories
+	from .merkle import trees
+	from .metastore import store
+	from .remote import RemoteFile
+
+	root = posixpath.normpath(root)
+	prefix = root.rstrip("/") + "/"
+	rows = [
+		row for row in store.query(sandbox=sandbox.name)
+		if row["origin"].startswith(prefix)
+	]
+	try:
+		tree, _ = trees.refresh(sandbox, root)
+	except OSError as err:
+		logger.warning("could not build the tree of %s: %s", root, err)
+		return sync_caches(
+			[Cache(RemoteFile(sandbox, row["origin"])) for row in rows])
+
+	synced = []
+	failed = 0
+	for row in rows:
+		path = row["origin"]
+		file_stat = tree.stat(path)
+		dirty = row["state"] != CacheState.SYNCED.value
+		if file_stat is None and not dirty:
+			manager.evict(get_cache_hash(path, sandbox.name))
+			continue
+		if file_stat is not None and not (dirty
+			or file_stat.st_mtime > row["last_sync"]
+		):
+			continue
+		cache = Cache(RemoteFile(sandbox, path))
+		try:
+			if file_stat is None:
+				# the tree leaves out files the helper couldn't stat
+				try:
+					file_stat = cache.file.stat()
+				except FileNotFoundError:
+					cache.recreate_original()
+					synced.append(cache)
+					continue
+			cache.open(file_stat)
+		except Exception as err:
+			logger.error("could not sync '%s': %s", path, err)
+			failed += 1
+			continue
+		synced.append(cache)
+	directories.apply_tree(sandbox, tree)
+	if not failed:
+		trees.commit(sandbox, tree)
+	logger.debug("synced %d of %d cached files under %s",
+		len(synced), len(rows), root)
+	return synced
@@ -0,0 +1,148 @@
+"""
+This module contains memory mapped, zero-copy access to cache files.
+
+Mappings are kept open across reads so repeated partial reads of a large
+cache only slice an existing `memoryview`. A mapping is dropped whenever
+its file is rewritten; rewrites go through `write_file`, which replaces
+the file instead of truncating it, so views handed out earlier keep
+seeing the old contents instead of faulting.
+
+CLASSES DECLARED
+================
+
+MappingTable:
+	keeps a bounded number of cache files mapped
+
+FUNCTIONS DECLARED
+==================
+
+partial_path(path):
+	create a temporary file to write the new contents of a file into
+
+write_file(path, data):
+	replace the contents of a file without disturbing its mappings
+
+OBJECTS DECLARED
+================
+
+mappings:
+	the application wide mapping table
+"""
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from . import config
+
+
+class MappingTable:
+	"""This interface keeps cache files memory mapped.
+
+	At most `max_open` files are mapped; the least recently used mapping
+	is dropped to make room for a new one.
+	"""
+
+	def __init__(self, max_open: int = config.MMAP_MAX_OPEN):
+		self.max_open = max_open
+		self._maps: 'OrderedDict[str, mmap.mmap]' = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __contains__(self, path: str) -> bool:
+		return path in self._maps
+
+	def view(self, path: str) -> memoryview:
+		"""
+		get a read-only view over the whole contents of a file, mapping
+		the file if it isn't mapped already
+		"""
+
+		with self._lock:
+			mapped = self._maps.get(path)
+			if mapped is None:
+				if os.path.getsize(path) == 0:
+					# empty files can't be mapped
+					return memoryview(b"")
+				with open(path, "rb") as f:
+					mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				self._maps[path] = mapped
+				while len(self._maps) > self.max_open:
+					_, old = self._maps.popitem(last=False)
+					_close(old)
+			else:
+				self._maps.move_to_end(path)
+			return memoryview(mapped)
+
+	def invalidate(self, path: str):
+		"""
+		drop the mapping of a file. views handed out earlier stay valid.
+		"""
+
+		with self._lock:
+			mapped = self._maps.pop(path, None)
+		if mapped is not None:
+			_close(mapped)
+
+	def clear(self):
+		"""
+		drop every mapping
+		"""
+
+		with self._lock:
+			maps, self._maps = self._maps, OrderedDict()
+		for mapped in maps.values():
+			_close(mapped)
+
+
+def _close(mapped: mmap.mmap):
+	try:
+		mapped.close()
+	except BufferError:
+		# views are still exported; the mapping is released with them
+		pass
+
+
+def partial_path(path: str) -> str:
+	"""
+	create an empty temporary file in the directory of `path`, to be
+	written and then moved over it. every call gets a name of its own, so
+	writers of the same file never share one. the name ends in ".part",
+	which directory scans skip.
+
+	Returns: the path of the temporary file
+	"""
+
+	fd, partial = tempfile.mkstemp(
+		prefix=os.path.basename(path) + ".", suffix=".part",
+		dir=os.path.dirname(path) or ".")
+	try:
+		os.fchmod(fd, 0o644)
+	finally:
+		os.close(fd)
+	return partial
+
+
+def write_file(path: str, data: bytes):
+	"""
+	replace the contents of a file. the new contents are written to a
+	temporary file (see `partial_path`) which then replaces the original,
+	so existing mappings of the file are never truncated under their
+	readers.
+	"""
+
+	partial = partial_path(path)
+	try:
+		with open(partial, "wb") as f:
+			f.write(data)
+		os.replace(partial, path)
+	except BaseException:
+		try:
+			os.remove(partial)
+		except FileNotFoundError:
+			pass
+		raise
+	mappings.invalidate(path)
+
+
+mappings = MappingTable()
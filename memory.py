@@ -0,0 +1,303 @@
+"""
+This module contains the in-memory cache tier.
+
+Caches that are read or written often are promoted into memory so that
+reads and writes don't touch the disk. Writes to a promoted cache only
+mark it dirty; dirty caches are written back to disk by a background
+flusher every `config.MEMORY_FLUSH_INTERVAL` seconds, when the tier runs
+out of memory, or when the cache is synced.
+
+CLASSES DECLARED
+================
+
+MemoryEntry:
+	the contents of a single cache held in memory
+
+MemoryTier:
+	holds promoted caches within a memory budget
+
+OBJECTS DECLARED
+================
+
+tier:
+	the application wide memory tier
+"""
+import atexit
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from . import config
+from .logger import logger
+from .mapping import write_file
+
+
+class MemoryEntry:
+	"""This interface represents a cache held in memory.
+	"""
+
+	__slots__ = ("path", "data", "dirty")
+
+	path: str
+	"absolute path to location where the cache lives on disk"
+
+	data: bytes
+	"the contents of the cache"
+
+	dirty: bool
+	"True if the contents have not been written back to disk"
+
+	def __init__(self, path: str, data: bytes, dirty: bool = False):
+		self.path = path
+		self.data = data
+		self.dirty = dirty
+
+	@property
+	def size(self) -> int:
+		return len(self.data)
+
+
+class MemoryTier:
+	"""This interface keeps frequently used caches in memory.
+
+	A cache is promoted once it has been read or written `promote_after`
+	times and is no larger than `max_file_size`. When the tier is full the
+	least recently used entries are demoted, and written back first if
+	they are dirty.
+	"""
+
+	max_bytes: int
+	"the number of bytes the tier may hold"
+
+	size: int
+	"the number of bytes the tier currently holds"
+
+	def __init__(
+		self,
+		max_bytes: int = config.MEMORY_MAX_BYTES,
+		max_file_size: int = config.MEMORY_MAX_FILE_SIZE,
+		promote_after: int = config.MEMORY_PROMOTE_AFTER,
+		flush_interval: float = config.MEMORY_FLUSH_INTERVAL,
+	):
+		self.max_bytes = max_bytes
+		self.max_file_size = max_file_size
+		self.promote_after = promote_after
+		self.flush_interval = flush_interval
+		self.size = 0
+		self.hits = {"memory": 0, "disk": 0}
+		self.flushes = 0
+		self._entries: 'OrderedDict[str, MemoryEntry]' = OrderedDict()
+		self._counts: Dict[str, int] = {}
+		self._lock = threading.RLock()
+		self._flusher: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+
+	def __contains__(self, hash: str) -> bool:
+		return hash in self._entries
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def get(self, hash: str) -> Optional[bytes]:
+		"""
+		get the contents of a cache if it is held in memory.
+		every call is counted towards the tier's hit rate.
+		"""
+
+		with self._lock:
+			entry = self._entries.get(hash)
+			if entry is None:
+				self.hits["disk"] += 1
+				return None
+			self._entries.move_to_end(hash)
+			self.hits["memory"] += 1
+			return entry.data
+
+	def is_dirty(self, hash: str) -> bool:
+		"""
+		Returns: True if the cache has changes that are only in memory
+		"""
+
+		entry = self._entries.get(hash)
+		return entry is not None and entry.dirty
+
+	def record(self, hash: str) -> bool:
+		"""
+		count a read or write of a cache that is not in memory.
+
+		Returns: True if the cache should now be promoted
+		"""
+
+		with self._lock:
+			if len(self._counts) > 4096:
+				# forget old counts so one-off accesses don't pile up
+				self._counts.clear()
+			count = self._counts.get(hash, 0) + 1
+			self._counts[hash] = count
+			return count >= self.promote_after
+
+	def promote(
+		self, hash: str, path: str, data: bytes, dirty: bool = False
+	) -> bool:
+		"""
+		hold the contents of a cache in memory
+
+		Args:
+			hash: the cache's hash
+			path: absolute path to location where the cache lives on disk
+			data: the contents of the cache
+			dirty: True if `data` has not been written to disk yet
+
+		Returns: True if the cache was promoted
+		"""
+
+		if len(data) > self.max_file_size:
+			return False
+		with self._lock:
+			self._counts.pop(hash, None)
+			self._store(hash, MemoryEntry(path, data, dirty))
+		logger.debug("promoted cache '%s' into memory", hash)
+		self._start_flusher()
+		return True
+
+	def _store(self, hash: str, entry: MemoryEntry):
+		old = self._entries.pop(hash, None)
+		if old is not None:
+			self.size -= old.size
+		self._entries[hash] = entry
+		self.size += entry.size
+		while self.size > self.max_bytes and len(self._entries) > 1:
+			victim = next(iter(self._entries))
+			self.demote(victim)
+
+	def write(self, hash: str, data: bytes) -> bool:
+		"""
+		overwrite the in-memory contents of a cache
+
+		Returns: False if the cache is not held in memory
+		"""
+
+		with self._lock:
+			entry = self._entries.get(hash)
+			if entry is None:
+				self.hits["disk"] += 1
+				return False
+			if len(data) > self.max_file_size:
+				self.demote(hash)
+				return False
+			self._store(hash, MemoryEntry(entry.path, data, dirty=True))
+			self.hits["memory"] += 1
+			return True
+
+	def append(self, hash: str, data: bytes) -> bool:
+		"""
+		add bytes to the in-memory contents of a cache
+
+		Returns: False if the cache is not held in memory
+		"""
+
+		with self._lock:
+			entry = self._entries.get(hash)
+			if entry is None:
+				self.hits["disk"] += 1
+				return False
+			return self.write(hash, entry.data + data)
+
+	def flush(self, hash: Optional[str] = None) -> int:
+		"""
+		write dirty caches back to disk
+
+		Args:
+			hash: the hash of a single cache to flush. every dirty cache is
+			flushed if it is not supplied
+
+		Returns: the number of caches written back
+		"""
+
+		with self._lock:
+			if hash is not None:
+				entry = self._entries.get(hash)
+				entries = [entry] if entry is not None else []
+			else:
+				entries = list(self._entries.values())
+			flushed = 0
+			for entry in entries:
+				if not entry.dirty:
+					continue
+				write_file(entry.path, entry.data)
+				entry.dirty = False
+				flushed += 1
+			self.flushes += flushed
+		if flushed:
+			logger.debug("flushed %d in-memory caches to disk", flushed)
+		return flushed
+
+	def demote(self, hash: str):
+		"""
+		drop a cache from memory, writing it back first if it is dirty
+		"""
+
+		with self._lock:
+			if hash not in self._entries:
+				return
+			self.flush(hash)
+			entry = self._entries.pop(hash)
+			self.size -= entry.size
+		logger.debug("demoted cache '%s' from memory", hash)
+
+	def discard(self, hash: str):
+		"""
+		drop a cache from memory without writing it back
+		"""
+
+		with self._lock:
+			entry = self._entries.pop(hash, None)
+			self._counts.pop(hash, None)
+			if entry is not None:
+				self.size -= entry.size
+
+	def stats(self) -> dict:
+		"""
+		Returns: the tier's size and the hit rate of each tier
+		"""
+
+		total = sum(self.hits.values())
+		return dict(
+			entries=len(self._entries),
+			size=self.size,
+			max_bytes=self.max_bytes,
+			memory_hits=self.hits["memory"],
+			disk_hits=self.hits["disk"],
+			memory_hit_rate=self.hits["memory"] / total if total else 0.0,
+			disk_hit_rate=self.hits["disk"] / total if total else 0.0,
+			flushes=self.flushes,
+		)
+
+	def _start_flusher(self):
+		if not self.flush_interval:
+			return
+		if self._flusher is not None and self._flusher.is_alive():
+			return
+		self._flusher = threading.Thread(
+			target=self._flush_loop, name="alexis-memory-flusher", daemon=True
+		)
+		self._flusher.start()
+
+	def _flush_loop(self):
+		while not self._stopped.wait(self.flush_interval):
+			try:
+				self.flush()
+			except OSError as err:
+				logger.error("could not flush in-memory caches: %s", err)
+
+	def shutdown(self):
+		"""
+		stop the flusher and write every dirty cache back to disk
+		"""
+
+		self._stopped.set()
+		self.flush()
+
+
+tier = MemoryTier()
+atexit.register(tier.shutdown)
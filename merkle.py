@@ -0,0 +1,503 @@
+"""
+This module contains the hierarchical hash manifest (merkle tree) of
+directories on a sandbox.
+
+Every directory is a node listing its children as (name, mode, size,
+mtime, digest); the digest of a directory is the md5 of its children's
+records, so it changes whenever anything under it changes. Files have an
+empty digest; their size and mtime identify their contents, as they do
+everywhere else in the application.
+
+Trees are built on the sandbox by a small helper that runs over an exec
+channel. The helper also keeps the trees it built in
+`config.TREE_STATE_DIR` on the sandbox, keyed by root digest. Given the
+root digest of the tree we hold, it walks the new tree top-down against
+the old one and only sends the directories whose digest changed, skipping
+unchanged subtrees. A sandbox with 50k files and a handful of changes
+therefore sends a handful of nodes. If it doesn't have our tree any more,
+it sends every node.
+
+A refreshed tree is a copy; it replaces the stored tree only once the
+caller commits it, after acting on it. A sync that fails leaves the old
+tree in place, so its changes are found again by the next refresh.
+Trees are stored next to the cache metadata in `config.METADATA_DIR`.
+
+FORMATS
+=======
+
+update (zlib compressed json):
+	{"full": bool, "root": digest, "nodes": {relative path: [digest, children]}}
+
+stored tree (zlib compressed json):
+	{"root": path, "nodes": {relative path: [digest, children]}}
+
+CLASSES DECLARED
+================
+
+TreeDiff:
+	what changed between two versions of a tree
+
+MerkleTree:
+	the tree of a directory on a sandbox
+
+TreeStore:
+	loads, refreshes and saves trees
+
+OBJECTS DECLARED
+================
+
+trees:
+	the application wide tree store
+"""
+import hashlib
+import inspect
+import json
+import os
+import posixpath
+import shlex
+import stat
+import threading
+import zlib
+from dataclasses import dataclass, field
+from typing import (
+	TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+)
+
+from . import config
+from .connection import pool
+from .logger import logger
+from .mapping import write_file
+from .manifest import RemoteStat
+from .metrics import metrics
+
+if TYPE_CHECKING:
+	from .database import Sandbox
+	from .directory import DirectoryState
+
+Child = Tuple[str, int, int, float, str]
+"the name, mode, size, mtime and digest of a child of a directory"
+
+Node = Tuple[str, List[Child]]
+"the digest and children of a directory"
+
+
+def node_digest(children: List[Child]) -> str:
+	"""
+	compute the digest of a directory from its children, sorted by name
+	"""
+
+	md5 = hashlib.md5()
+	for name, mode, size, mtime, digest in children:
+		md5.update(("%s\0%o\0%d\0%r\0%s\n" % (
+			name, mode, size, mtime, digest)).encode("utf-8", "surrogateescape"))
+	return md5.hexdigest()
+
+
+def scan(root: str, skip: Optional[str] = None) -> Dict[str, Node]:
+	"""
+	build the tree of a local directory
+
+	Args:
+		root: the directory
+		skip: a directory to leave out, e.g. where the trees are kept
+
+	Returns: every directory's node by path relative to `root`
+	"""
+
+	import os
+	import stat
+
+	nodes: Dict[str, Node] = {}
+	try:
+		info = os.stat(skip) if skip else None
+		skipped = (info.st_dev, info.st_ino) if info else None
+	except OSError:
+		skipped = None
+
+	def visit(relative: str, path: str) -> str:
+		children = []
+		try:
+			with os.scandir(path) as it:
+				entries = list(it)
+		except OSError:
+			entries = []
+		for entry in entries:
+			try:
+				info = entry.stat(follow_symlinks=False)
+			except OSError:
+				continue
+			digest = ""
+			if stat.S_ISDIR(info.st_mode):
+				if (info.st_dev, info.st_ino) == skipped:
+					continue
+				digest = visit(
+					relative + "/" + entry.name if relative else entry.name,
+					entry.path)
+			children.append(
+				(entry.name, info.st_mode, info.st_size, info.st_mtime, digest))
+		children.sort()
+		digest = node_digest(children)
+		nodes[relative] = (digest, children)
+		return digest
+
+	visit("", root)
+	return nodes
+
+
+def changed_nodes(
+	previous: Dict[str, Node], nodes: Dict[str, Node]
+) -> Dict[str, Node]:
+	"""
+	walk a tree top-down against an older version of it
+
+	Returns: the nodes whose digest changed. unchanged subtrees are not
+	walked.
+	"""
+
+	import stat
+
+	changed = {}
+	pending = [""]
+	while pending:
+		relative = pending.pop()
+		node = nodes[relative]
+		old = previous.get(relative)
+		if old is not None and old[0] == node[0]:
+			continue
+		changed[relative] = node
+		for name, mode, _, _, _ in node[1]:
+			if stat.S_ISDIR(mode):
+				pending.append(relative + "/" + name if relative else name)
+	return changed
+
+
+def _helper_main():
+	import json
+	import os
+	import sys
+	import zlib
+
+	root, known = sys.argv[1], sys.argv[2]
+	states, keep = os.path.expanduser(sys.argv[3]), int(sys.argv[4])
+	os.makedirs(states, exist_ok=True)
+	nodes = scan(root, skip=states)
+	digest = nodes[""][0]
+
+	previous = None
+	try:
+		with open(os.path.join(states, known), "rb") as f:
+			previous = json.loads(zlib.decompress(f.read()))
+	except (OSError, ValueError, zlib.error):
+		pass
+	update = dict(
+		full=previous is None, root=digest,
+		nodes=nodes if previous is None else changed_nodes(previous, nodes))
+	sys.stdout.buffer.write(zlib.compress(json.dumps(update).encode(), 6))
+
+	location = os.path.join(states, digest)
+	if not os.path.exists(location):
+		tmp = location + ".tmp"
+		with open(tmp, "wb") as f:
+			f.write(zlib.compress(json.dumps(nodes).encode(), 6))
+		os.replace(tmp, location)
+	names = sorted(
+		(entry for entry in os.scandir(states) if len(entry.name) == 32),
+		key=lambda entry: entry.stat().st_mtime, reverse=True)
+	for entry in names[keep:]:
+		os.remove(entry.path)
+
+
+_helper: Optional[str] = None
+
+
+def remote_command(root: str, known: str) -> str:
+	"""
+	build the shell command that runs the tree helper on a sandbox
+
+	Args:
+		root: the directory to build the tree of
+		known: the root digest of the tree we hold, or "-"
+	"""
+
+	global _helper
+	if _helper is None:
+		functions = (node_digest, scan, changed_nodes, _helper_main)
+		_helper = "\n".join(
+			["import hashlib", "from typing import Dict, List, Optional, Tuple",
+				"Child = Node = None"]
+			+ [inspect.getsource(f) for f in functions]
+			+ ["_helper_main()"]
+		)
+	argv = " ".join(shlex.quote(str(arg)) for arg in (
+		root, known, config.TREE_STATE_DIR, config.TREE_STATES))
+	return f"python3 -c {shlex.quote(_helper)} {argv}"
+
+
+def get_tree_location(sandbox: 'Sandbox', root: str) -> str:
+	"""
+	get the path of the file a tree is stored in
+	"""
+
+	key = f"{sandbox.name}:{root}".encode("utf-8")
+	return os.path.join(
+		config.METADATA_DIR, hashlib.sha1(key).hexdigest() + ".tree")
+
+
+@dataclass
+class TreeDiff:
+	"""what changed between two versions of a tree. paths are absolute."""
+
+	changed: List[str] = field(default_factory=list)
+	"files that were added or whose size, mtime or mode changed"
+
+	removed: List[str] = field(default_factory=list)
+	"files that are gone"
+
+	directories: List[str] = field(default_factory=list)
+	"directories whose listing changed, including new ones"
+
+	removed_directories: List[str] = field(default_factory=list)
+	"directories that are gone"
+
+	def __bool__(self) -> bool:
+		return bool(self.changed or self.removed or self.directories
+			or self.removed_directories)
+
+
+class MerkleTree:
+	"""This interface represents the tree of a directory on a sandbox.
+	"""
+
+	def __init__(
+		self, root: str, nodes: Optional[Dict[str, Node]] = None,
+		location: Optional[str] = None
+	):
+		self.root = posixpath.normpath(root)
+		self.nodes: Dict[str, Node] = nodes or {}
+		self.location = location
+
+	@property
+	def digest(self) -> Optional[str]:
+		"""the digest of the root, or None if the tree was never built"""
+
+		node = self.nodes.get("")
+		return node[0] if node is not None else None
+
+	def copy(self) -> 'MerkleTree':
+		# nodes are replaced, never changed in place, so sharing them is safe
+		return MerkleTree(self.root, dict(self.nodes), self.location)
+
+	def absolute(self, relative: str) -> str:
+		return posixpath.join(self.root, relative) if relative else self.root
+
+	def relative(self, path: str) -> str:
+		path = posixpath.relpath(posixpath.normpath(path), self.root)
+		return "" if path == "." else path
+
+	def files(self) -> Iterator[Tuple[str, RemoteStat]]:
+		"""
+		Returns: an iterator of the absolute path and stat of every regular
+		file in the tree
+		"""
+
+		for relative, (_, children) in self.nodes.items():
+			for name, mode, size, mtime, _ in children:
+				if stat.S_ISREG(mode):
+					yield (posixpath.join(self.absolute(relative), name),
+						RemoteStat(size, mtime, mode, mtime))
+
+	def stat(self, path: str) -> Optional[RemoteStat]:
+		"""
+		Returns: the stat of a file or directory in the tree, or None if
+		the tree doesn't hold it
+		"""
+
+		relative = self.relative(path)
+		node = self.nodes.get(posixpath.dirname(relative))
+		if node is None or relative.startswith(".."):
+			return None
+		name = posixpath.basename(relative)
+		for child, mode, size, mtime, _ in node[1]:
+			if child == name:
+				return RemoteStat(size, mtime, mode, mtime)
+		return None
+
+	def listing(self, path: str) -> Optional['DirectoryState']:
+		"""
+		Returns: the state of a directory in the tree, or None if the tree
+		doesn't hold it
+		"""
+
+		from .directory import DirEntry, DirectoryState, get_entry_type
+
+		node = self.nodes.get(self.relative(path))
+		if node is None:
+			return None
+		return DirectoryState(self.absolute(self.relative(path)), (
+			DirEntry(name, get_entry_type(mode), size, mtime)
+			for name, mode, size, mtime, _ in node[1]))
+
+	def _removed(self, relative: str, diff: TreeDiff):
+		"""
+		record a directory and everything under it as removed
+		"""
+
+		pending = [relative]
+		while pending:
+			relative = pending.pop()
+			node = self.nodes.pop(relative, None)
+			diff.removed_directories.append(self.absolute(relative))
+			if node is None:
+				continue
+			for name, mode, _, _, _ in node[1]:
+				child = relative + "/" + name if relative else name
+				if stat.S_ISDIR(mode):
+					pending.append(child)
+				else:
+					diff.removed.append(self.absolute(child))
+
+	def apply(self, update: dict) -> TreeDiff:
+		"""
+		bring the tree up to date with an update sent by the helper
+
+		Returns: what changed
+		"""
+
+		diff = TreeDiff()
+		nodes: Dict[str, Node] = {
+			relative: (digest, [tuple(child) for child in children])
+			for relative, (digest, children) in update["nodes"].items()
+		}
+		for relative in sorted(nodes):
+			digest, children = nodes[relative]
+			old = self.nodes.get(relative)
+			if old is not None and old[0] == digest:
+				continue
+			diff.directories.append(self.absolute(relative))
+			before = {child[0]: child for child in (old[1] if old else ())}
+			for child in children:
+				name, mode = child[0], child[1]
+				path = relative + "/" + name if relative else name
+				previous = before.pop(name, None)
+				if previous is not None and stat.S_ISDIR(previous[1]) \
+						and not stat.S_ISDIR(mode):
+					self._removed(path, diff)
+					previous = None
+				if not stat.S_ISDIR(mode) and (
+					previous is None or previous[1:4] != child[1:4]
+				):
+					diff.changed.append(self.absolute(path))
+			for name, child in before.items():
+				path = relative + "/" + name if relative else name
+				if stat.S_ISDIR(child[1]):
+					self._removed(path, diff)
+				else:
+					diff.removed.append(self.absolute(path))
+			self.nodes[relative] = (digest, children)
+		if update.get("full"):
+			# nodes the helper didn't send are gone
+			for relative in [r for r in self.nodes if r not in nodes]:
+				if relative in self.nodes:
+					self._removed(relative, diff)
+		return diff
+
+	def load(self) -> bool:
+		"""
+		read the tree from where it is stored
+
+		Returns: True if there was a tree to read
+		"""
+
+		try:
+			with open(self.location, "rb") as f:
+				data = json.loads(zlib.decompress(f.read()))
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError, zlib.error) as err:
+			logger.warning("ignoring unreadable tree %s: %s", self.location, err)
+			return False
+		self.nodes = {
+			relative: (digest, [tuple(child) for child in children])
+			for relative, (digest, children) in data["nodes"].items()
+		}
+		return True
+
+	def save(self):
+		"""
+		store the tree, next to the cache metadata
+		"""
+
+		os.makedirs(os.path.dirname(self.location), exist_ok=True)
+		data = json.dumps(dict(root=self.root, nodes=self.nodes)).encode()
+		write_file(self.location, zlib.compress(data, 6))
+
+
+class TreeStore:
+	"""This interface keeps the trees of sandbox directories in memory,
+	loading them from disk the first time they are used.
+	"""
+
+	def __init__(self):
+		self._trees: Dict[Tuple[str, str], MerkleTree] = {}
+		self._lock = threading.Lock()
+
+	def get(self, sandbox: 'Sandbox', root: str) -> MerkleTree:
+		"""
+		get the tree of a directory on a sandbox as it was last refreshed.
+		the tree is empty if it was never built.
+		"""
+
+		root = posixpath.normpath(root)
+		key = (sandbox.name, root)
+		with self._lock:
+			tree = self._trees.get(key)
+			if tree is None:
+				tree = MerkleTree(root, location=get_tree_location(sandbox, root))
+				tree.load()
+				self._trees[key] = tree
+		return tree
+
+	def refresh(
+		self, sandbox: 'Sandbox', root: str
+	) -> Tuple[MerkleTree, TreeDiff]:
+		"""
+		get an up to date copy of the tree of a directory on a sandbox,
+		with a single run of the tree helper. the stored tree is left
+		alone until the copy is committed.
+
+		Returns: the up to date tree and how it differs from the stored one
+
+		Raises:
+			OSError: if the helper failed
+		"""
+
+		stored = self.get(sandbox, root)
+		tree = stored.copy()
+		with metrics.span("merkle.refresh", root=tree.root):
+			status, out, err = pool.exec_command(
+				sandbox, remote_command(tree.root, stored.digest or "-"))
+		if status != 0 or not out:
+			raise OSError(f"tree helper failed ({status}): {err!r}")
+		update = json.loads(zlib.decompress(out))
+		diff = tree.apply(update)
+		metrics.inc("merkle.nodes", len(update["nodes"]))
+		logger.debug("refreshed the tree of %s: %d nodes sent, %d files changed",
+			tree.root, len(update["nodes"]), len(diff.changed))
+		return tree, diff
+
+	def commit(self, sandbox: 'Sandbox', tree: MerkleTree):
+		"""
+		make a refreshed tree the stored one, once the changes in it were
+		acted on
+		"""
+
+		key = (sandbox.name, tree.root)
+		with self._lock:
+			stored = self._trees.get(key)
+			if stored is not None and stored.digest == tree.digest:
+				return
+			self._trees[key] = tree
+		tree.save()
+
+
+trees = TreeStore()
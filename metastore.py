@@ -0,0 +1,282 @@
+"""
+This module contains the metadata store.
+
+Cache metadata lives in the `CacheMetadata` table of the application
+database. Updates are buffered in memory and written in batches by a
+background flusher, so updating the metadata of a cache never waits on
+the database. Reads see buffered updates before they are written.
+
+CLASSES DECLARED
+================
+
+MetadataStore:
+	buffers metadata updates and answers queries over all metadata
+
+OBJECTS DECLARED
+================
+
+store:
+	the application wide metadata store
+"""
+import atexit
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from . import config
+from .database import DB, CacheMetadata
+from .logger import logger
+from .metrics import metrics
+
+FIELDS = (
+	"hash", "origin", "name", "sandbox",
+	"created_at", "last_sync", "modified_at", "state", "codec",
+)
+
+
+class MetadataStore:
+	"""This interface reads and writes cache metadata.
+
+	`save` and `delete` only queue the change; changes are written in a
+	single transaction every `flush_interval` seconds, once `batch_size`
+	changes are pending, or when `flush` is called.
+	"""
+
+	def __init__(
+		self,
+		flush_interval: float = config.METADATA_FLUSH_INTERVAL,
+		batch_size: int = config.METADATA_BATCH_SIZE,
+	):
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		self._pending: Dict[str, Optional[dict]] = {}
+		self._writing: Dict[str, Optional[dict]] = {}
+		self._ready = False
+		self._lock = threading.RLock()
+		self._flush_lock = threading.Lock()
+		self._flusher: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+
+	def _ensure_table(self):
+		if self._ready:
+			return
+		with self._lock:
+			if not self._ready:
+				DB.create_tables([CacheMetadata], safe=True)
+				self._add_columns()
+				self._ready = True
+				self.migrate()
+
+	def _add_columns(self):
+		"""
+		add columns that are missing from a table created by an older
+		version of the application
+		"""
+
+		from playhouse.migrate import SqliteMigrator, migrate
+
+		table = CacheMetadata._meta.table_name
+		existing = {column.name for column in DB.get_columns(table)}
+		missing = [
+			field for field in CacheMetadata._meta.sorted_fields
+			if field.column_name not in existing
+		]
+		if missing:
+			migrator = SqliteMigrator(DB)
+			migrate(*(migrator.add_column(table, field.column_name, field)
+				for field in missing))
+			logger.info("added %d columns to the metadata table", len(missing))
+
+	def load(self, hash: str) -> Optional[dict]:
+		"""
+		get the metadata of a cache
+
+		Args:
+			hash: the cache's hash
+
+		Returns: the metadata as a dictionary, or None if there is none
+		"""
+
+		with self._lock:
+			for pending in (self._pending, self._writing):
+				if hash in pending:
+					row = pending[hash]
+					return dict(row) if row is not None else None
+		self._ensure_table()
+		row = (CacheMetadata.select()
+			.where(CacheMetadata.hash == hash).dicts().first())
+		return row
+
+	def save(self, row: dict):
+		"""
+		queue the metadata of a cache to be written
+		"""
+
+		with self._lock:
+			self._pending[row["hash"]] = {
+				field: row.get(field, 0) for field in FIELDS}
+			full = len(self._pending) >= self.batch_size
+		if full:
+			self.flush()
+		else:
+			self._start_flusher()
+
+	def delete(self, hash: str):
+		"""
+		queue the metadata of a cache to be deleted
+		"""
+
+		with self._lock:
+			self._pending[hash] = None
+		self._start_flusher()
+
+	def flush(self) -> int:
+		"""
+		write every queued change to the database in one transaction
+
+		Returns: the number of changes written
+		"""
+
+		with self._flush_lock:
+			with self._lock:
+				if not self._pending:
+					return 0
+				pending, self._pending = self._pending, {}
+				# keep the batch visible to `load` until it is committed
+				self._writing = pending
+			rows = [row for row in pending.values() if row is not None]
+			deleted = [hash for hash, row in pending.items() if row is None]
+			try:
+				self._ensure_table()
+				with metrics.timer("metastore.flush"), DB.atomic():
+					for batch in _chunks(rows, 100):
+						CacheMetadata.insert_many(batch).on_conflict_replace().execute()
+					for batch in _chunks(deleted, 500):
+						CacheMetadata.delete().where(
+							CacheMetadata.hash.in_(batch)).execute()
+			except Exception:
+				with self._lock:
+					# keep changes made while we were writing
+					pending.update(self._pending)
+					self._pending = pending
+				raise
+			finally:
+				with self._lock:
+					self._writing = {}
+		metrics.observe("metastore.batch", len(pending))
+		logger.debug("wrote %d metadata changes", len(pending))
+		return len(pending)
+
+	def query(
+		self, state: Optional[int] = None, sandbox: Optional[str] = None
+	) -> List[dict]:
+		"""
+		get the metadata of every cache, optionally filtered by state and
+		sandbox. queued changes are written first.
+
+		Args:
+			state: the value of a cache.CacheState
+			sandbox: the name of a sandbox
+		"""
+
+		self.flush()
+		self._ensure_table()
+		query = CacheMetadata.select()
+		if state is not None:
+			query = query.where(CacheMetadata.state == state)
+		if sandbox is not None:
+			query = query.where(CacheMetadata.sandbox == sandbox)
+		return list(query.dicts())
+
+	def index(self) -> Dict[str, Tuple[int, Optional[str]]]:
+		"""
+		Returns: a map of every cache hash to the value of its state and
+		the name of its sandbox
+		"""
+
+		self.flush()
+		self._ensure_table()
+		query = CacheMetadata.select(
+			CacheMetadata.hash, CacheMetadata.state, CacheMetadata.sandbox)
+		return {hash: (state, sandbox) for hash, state, sandbox in query.tuples()}
+
+	def migrate(self) -> int:
+		"""
+		move metadata kept in json files under `config.METADATA_DIR` into
+		the database. migrated files are removed.
+
+		Returns: the number of files migrated
+		"""
+
+		from .cache import CacheState
+
+		if not os.path.isdir(config.METADATA_DIR):
+			return 0
+		rows, files = [], []
+		with os.scandir(config.METADATA_DIR) as it:
+			for entry in it:
+				if not entry.name.endswith(".json"):
+					continue
+				try:
+					with open(entry.path, "r") as f:
+						data = json.load(f)
+				except (OSError, ValueError) as err:
+					logger.warning("skipping metadata file %s: %s", entry.path, err)
+					continue
+				modified_at = data.get("modified_at", 0.0)
+				last_sync = data.get("last_sync", 0.0)
+				rows.append(dict(
+					hash=data.get("hash", entry.name[:-5]),
+					origin=data.get("origin", ""),
+					name=data.get("name", ""),
+					sandbox=data.get("sandbox"),
+					created_at=data.get("created_at", 0.0),
+					last_sync=last_sync,
+					modified_at=modified_at,
+					state=(CacheState.STAGED if modified_at > last_sync
+						else CacheState.SYNCED).value,
+					codec=0,
+				))
+				files.append(entry.path)
+		if not rows:
+			return 0
+		with DB.atomic():
+			for batch in _chunks(rows, 100):
+				CacheMetadata.insert_many(batch).on_conflict_ignore().execute()
+		for path in files:
+			os.remove(path)
+		logger.info("migrated %d metadata files into the database", len(rows))
+		return len(rows)
+
+	def _start_flusher(self):
+		if self._flusher is not None and self._flusher.is_alive():
+			return
+		self._flusher = threading.Thread(
+			target=self._flush_loop, name="alexis-metadata-flusher", daemon=True
+		)
+		self._flusher.start()
+
+	def _flush_loop(self):
+		while not self._stopped.wait(self.flush_interval):
+			try:
+				self.flush()
+			except Exception as err:
+				logger.error("could not write metadata: %s", err)
+
+	def shutdown(self):
+		"""
+		stop the flusher and write every queued change
+		"""
+
+		self._stopped.set()
+		self.flush()
+
+
+def _chunks(items: list, size: int):
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+
+store = MetadataStore()
+atexit.register(store.shutdown)
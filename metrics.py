@@ -0,0 +1,393 @@
+"""
+This module contains the metrics registry.
+
+Hot paths count events, record sizes and time operations through the
+registry; remote operations are also traced as spans, which keep their
+parent span so a slow sync can be broken down. When metrics are
+disabled every call returns after a single attribute check.
+
+Metrics are kept in memory and added to `config.METRICS_FILE` when the
+application exits, so `alexis stats` shows totals across runs.
+
+CLASSES DECLARED
+================
+
+Counter:
+	a number that only goes up
+
+Gauge:
+	a number that goes up and down, and the highest it has been
+
+Histogram:
+	a distribution of values in power of two buckets
+
+Span:
+	a single traced operation
+
+Registry:
+	holds every metric and the most recent spans
+
+OBJECTS DECLARED
+================
+
+metrics:
+	the application wide registry
+"""
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Deque, Dict, Iterator, List, Optional
+
+from . import config
+from .logger import logger
+from .mapping import write_file
+
+
+class Counter:
+	"""This interface represents a number that only goes up.
+	"""
+
+	__slots__ = ("value",)
+
+	def __init__(self, value: int = 0):
+		self.value = value
+
+	def inc(self, amount: int = 1):
+		self.value += amount
+
+	def json(self):
+		return self.value
+
+	def merge(self, value):
+		self.value += value
+
+
+class Gauge:
+	"""This interface represents a number that goes up and down.
+	"""
+
+	__slots__ = ("value", "max")
+
+	def __init__(self):
+		self.value = 0
+		self.max = 0
+
+	def set(self, value: float):
+		self.value = value
+		if value > self.max:
+			self.max = value
+
+	def json(self):
+		return dict(value=self.value, max=self.max)
+
+	def merge(self, value):
+		self.max = max(self.max, value["max"])
+
+
+class Histogram:
+	"""This interface represents a distribution of values. Values are
+	counted in power of two buckets, so recording one is O(1) and the
+	percentiles it reports are upper bounds within a factor of two.
+	"""
+
+	__slots__ = ("count", "sum", "min", "max", "buckets")
+
+	def __init__(self):
+		self.count = 0
+		self.sum = 0.0
+		self.min = math.inf
+		self.max = 0.0
+		self.buckets: Dict[int, int] = {}
+
+	def observe(self, value: float):
+		self.count += 1
+		self.sum += value
+		if value < self.min:
+			self.min = value
+		if value > self.max:
+			self.max = value
+		bucket = math.frexp(value)[1] if value > 0 else -1074
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+	def percentile(self, p: float) -> float:
+		"""
+		Returns: an upper bound of the `p`th percentile (0 to 100)
+		"""
+
+		if not self.count:
+			return 0.0
+		rank = p / 100 * self.count
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank:
+				return min(math.ldexp(1.0, bucket), self.max)
+		return self.max
+
+	@property
+	def mean(self) -> float:
+		return self.sum / self.count if self.count else 0.0
+
+	def json(self):
+		return dict(
+			count=self.count, sum=self.sum,
+			min=self.min if self.count else 0.0, max=self.max,
+			buckets={str(bucket): n for bucket, n in self.buckets.items()},
+		)
+
+	def merge(self, value):
+		if not value["count"]:
+			return
+		self.count += value["count"]
+		self.sum += value["sum"]
+		self.min = min(self.min, value["min"])
+		self.max = max(self.max, value["max"])
+		for bucket, n in value["buckets"].items():
+			self.buckets[int(bucket)] = self.buckets.get(int(bucket), 0) + n
+
+
+class Span:
+	"""This interface represents a traced operation.
+	"""
+
+	__slots__ = ("name", "parent", "start", "duration", "attrs", "error")
+
+	def __init__(self, name: str, parent: Optional[str], attrs: dict):
+		self.name = name
+		self.parent = parent
+		self.start = time.time()
+		self.duration = 0.0
+		self.attrs = attrs
+		self.error: Optional[str] = None
+
+	def json(self):
+		return dict(name=self.name, parent=self.parent, start=self.start,
+			duration=self.duration, attrs=self.attrs, error=self.error)
+
+
+class _Noop:
+	"""stands in for every metric while metrics are disabled"""
+
+	def inc(self, amount: int = 1):
+		pass
+
+	def set(self, value: float):
+		pass
+
+	def observe(self, value: float):
+		pass
+
+
+_noop = _Noop()
+_nullcontext = nullcontext()
+
+
+class Registry:
+	"""This interface holds every metric.
+
+	Metrics are created the first time they are used. Updates are not
+	locked, so concurrent updates may rarely be lost; that is the price of
+	keeping them cheap.
+	"""
+
+	def __init__(
+		self,
+		enabled: bool = config.METRICS_ENABLED,
+		trace_buffer: int = config.TRACE_BUFFER,
+	):
+		self.enabled = enabled
+		self.counters: Dict[str, Counter] = {}
+		self.gauges: Dict[str, Gauge] = {}
+		self.histograms: Dict[str, Histogram] = {}
+		self.spans: Deque[Span] = deque(maxlen=trace_buffer)
+		self._local = threading.local()
+		self._lock = threading.Lock()
+
+	def counter(self, name: str) -> Counter:
+		if not self.enabled:
+			return _noop  # type: ignore
+		metric = self.counters.get(name)
+		if metric is None:
+			with self._lock:
+				metric = self.counters.setdefault(name, Counter())
+		return metric
+
+	def gauge(self, name: str) -> Gauge:
+		if not self.enabled:
+			return _noop  # type: ignore
+		metric = self.gauges.get(name)
+		if metric is None:
+			with self._lock:
+				metric = self.gauges.setdefault(name, Gauge())
+		return metric
+
+	def histogram(self, name: str) -> Histogram:
+		if not self.enabled:
+			return _noop  # type: ignore
+		metric = self.histograms.get(name)
+		if metric is None:
+			with self._lock:
+				metric = self.histograms.setdefault(name, Histogram())
+		return metric
+
+	def inc(self, name: str, amount: int = 1):
+		"""
+		add to a counter
+		"""
+
+		if self.enabled:
+			self.counter(name).inc(amount)
+
+	def observe(self, name: str, value: float):
+		"""
+		record a value in a histogram
+		"""
+
+		if self.enabled:
+			self.histogram(name).observe(value)
+
+	def timer(self, name: str) -> ContextManager[None]:
+		"""
+		time a block, recording its duration in seconds in the histogram
+		`name`
+		"""
+
+		if not self.enabled:
+			return _nullcontext
+		return self._timer(name)
+
+	@contextmanager
+	def _timer(self, name: str) -> Iterator[None]:
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.histogram(name).observe(time.perf_counter() - start)
+
+	def span(self, name: str, **attrs) -> ContextManager[Optional[Span]]:
+		"""
+		trace an operation. the span's duration is also recorded in the
+		histogram `<name>.seconds` and failures in the counter
+		`<name>.errors`.
+
+		Args:
+			name: the operation, e.g. "sftp.read"
+			attrs: details worth keeping, e.g. the path of a file
+		"""
+
+		if not self.enabled:
+			return _nullcontext
+		return self._span(name, attrs)
+
+	@contextmanager
+	def _span(self, name: str, attrs: dict) -> Iterator[Span]:
+		stack: List[Span] = getattr(self._local, "stack", None) or []
+		self._local.stack = stack
+		span = Span(name, stack[-1].name if stack else None, attrs)
+		stack.append(span)
+		start = time.perf_counter()
+		try:
+			yield span
+		except BaseException as err:
+			span.error = type(err).__name__
+			self.inc(name + ".errors")
+			raise
+		finally:
+			span.duration = time.perf_counter() - start
+			if stack and stack[-1] is span:
+				stack.pop()
+			elif span in stack:
+				stack.remove(span)
+			self.histogram(name + ".seconds").observe(span.duration)
+			self.spans.append(span)
+
+	def json(self) -> dict:
+		"""
+		Returns: every metric and the most recent spans, ready to be dumped
+		as json
+		"""
+
+		return dict(
+			counters={name: m.json() for name, m in sorted(self.counters.items())},
+			gauges={name: m.json() for name, m in sorted(self.gauges.items())},
+			histograms={
+				name: m.json() for name, m in sorted(self.histograms.items())},
+			spans=[span.json() for span in self.spans],
+		)
+
+	def merge(self, data: dict):
+		"""
+		add metrics dumped by an earlier run to this registry
+		"""
+
+		for kind, make in (
+			("counters", self.counter), ("gauges", self.gauge),
+			("histograms", self.histogram)
+		):
+			for name, value in data.get(kind, {}).items():
+				make(name).merge(value)
+		spans = data.get("spans", [])[-(self.spans.maxlen or 0):]
+		for item in reversed(spans):
+			span = Span(item["name"], item["parent"], item["attrs"])
+			span.start, span.duration = item["start"], item["duration"]
+			span.error = item["error"]
+			self.spans.appendleft(span)
+
+	def load(self, path: Optional[str] = None):
+		"""
+		merge the metrics saved in `path` into this registry
+		"""
+
+		path = path or config.METRICS_FILE
+		try:
+			with open(path, "r") as f:
+				self.merge(json.load(f))
+		except FileNotFoundError:
+			pass
+		except ValueError as err:
+			logger.warning("ignoring unreadable metrics file %s: %s", path, err)
+
+	def save(self, path: Optional[str] = None):
+		"""
+		add this run's metrics to the totals saved in `path`
+		"""
+
+		if not self.enabled or not (self.counters or self.histograms):
+			return
+		path = path or config.METRICS_FILE
+		totals = Registry(trace_buffer=self.spans.maxlen or 0)
+		totals.load(path)
+		totals.merge(self.json())
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# runs that end at the same time each write a file of their own
+		write_file(path, json.dumps(totals.json()).encode("utf-8"))
+
+	def reset(self, path: Optional[str] = None):
+		"""
+		forget every metric, including the totals saved in `path`
+		"""
+
+		self.counters.clear()
+		self.gauges.clear()
+		self.histograms.clear()
+		self.spans.clear()
+		try:
+			os.remove(path or config.METRICS_FILE)
+		except FileNotFoundError:
+			pass
+
+
+def _save_at_exit():
+	try:
+		metrics.save()
+	except Exception as err:
+		logger.error("could not save metrics: %s", err)
+
+
+metrics = Registry()
+atexit.register(_save_at_exit)
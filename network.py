@@ -0,0 +1,221 @@
+"""
+This module contains the connectivity monitor.
+
+The monitor knows whether each sandbox host can be reached. It finds out
+with a tcp connect to the host's ssh port, which is cheap and, unlike
+probing a well known website, says whether the sandbox itself can be
+reached. Results are cached for `config.NETWORK_STATE_TTL` seconds, and
+hosts that can't be reached are probed again with exponential backoff.
+Anything that connects to a host can report the outcome, so most of the
+time no probe is needed at all.
+
+Subscribers are told whenever a host goes online or offline.
+
+CLASSES DECLARED
+================
+
+HostState:
+	what the monitor knows about a single host
+
+ConnectivityMonitor:
+	tracks the reachability of sandbox hosts
+
+OBJECTS DECLARED
+================
+
+monitor:
+	the application wide connectivity monitor
+"""
+import atexit
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from . import config
+from .logger import logger
+
+Listener = Callable[[str, bool], None]
+
+
+class HostState:
+	"""This interface represents what the monitor knows about a host.
+	"""
+
+	__slots__ = ("online", "checked_at", "failures", "next_probe")
+
+	online: Optional[bool]
+	"True if the host could be reached when it was last checked"
+
+	checked_at: float
+	"a monotonic timestamp showing when the host was last checked"
+
+	failures: int
+	"the number of failed checks in a row"
+
+	next_probe: float
+	"a monotonic timestamp before which the host is not probed again"
+
+	def __init__(self):
+		self.online = None
+		self.checked_at = 0.0
+		self.failures = 0
+		self.next_probe = 0.0
+
+
+class ConnectivityMonitor:
+	"""This interface tracks whether sandbox hosts can be reached.
+
+	Hosts being watched are probed by a background thread until they are
+	reachable again, so listeners hear about a host coming back without
+	anyone waiting on it.
+	"""
+
+	def __init__(
+		self,
+		port: int = config.SSH_PORT,
+		timeout: float = config.NETWORK_PROBE_TIMEOUT,
+		ttl: float = config.NETWORK_STATE_TTL,
+		backoff: float = config.NETWORK_BACKOFF,
+		backoff_max: float = config.NETWORK_BACKOFF_MAX,
+	):
+		self.port = port
+		self.timeout = timeout
+		self.ttl = ttl
+		self.backoff = backoff
+		self.backoff_max = backoff_max
+		self.probes = 0
+		self._hosts: Dict[str, HostState] = {}
+		self._watched: Set[str] = set()
+		self._listeners: List[Listener] = []
+		self._lock = threading.Lock()
+		self._wakeup = threading.Condition(self._lock)
+		self._watcher: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+
+	def subscribe(self, listener: Listener):
+		"""
+		call `listener` with a host and its new state whenever a host goes
+		online or offline
+		"""
+
+		self._listeners.append(listener)
+
+	def state(self, host: str) -> Optional[bool]:
+		"""
+		get the cached reachability of a host, without probing it
+
+		Returns: True or False, or None if it isn't known or has expired
+		"""
+
+		entry = self._hosts.get(host)
+		if entry is None or entry.online is None:
+			return None
+		if entry.online and time.monotonic() - entry.checked_at > self.ttl:
+			return None
+		if not entry.online and time.monotonic() >= entry.next_probe:
+			return None
+		return entry.online
+
+	def probe(self, host: str) -> bool:
+		"""
+		check whether a host accepts tcp connections on the ssh port, and
+		record the result
+
+		Returns: True if the host could be reached
+		"""
+
+		self.probes += 1
+		try:
+			with socket.create_connection((host, self.port), self.timeout):
+				online = True
+		except OSError as err:
+			logger.debug("probe of %s failed: %s", host, err)
+			online = False
+		self.report(host, online)
+		return online
+
+	def is_online(self, host: str) -> bool:
+		"""
+		check whether a host can be reached, probing it only if its cached
+		state has expired. a host that keeps failing is only probed again
+		once its backoff is over.
+		"""
+
+		online = self.state(host)
+		if online is None:
+			online = self.probe(host)
+		return online
+
+	def report(self, host: str, online: bool):
+		"""
+		record the outcome of a connection to a host and tell listeners
+		if the host went online or offline
+		"""
+
+		now = time.monotonic()
+		with self._lock:
+			entry = self._hosts.setdefault(host, HostState())
+			changed = entry.online is not None and entry.online != online
+			entry.online = online
+			entry.checked_at = now
+			if online:
+				entry.failures = 0
+				entry.next_probe = now
+				self._watched.discard(host)
+			else:
+				entry.failures += 1
+				entry.next_probe = now + min(
+					self.backoff_max, self.backoff * 2 ** (entry.failures - 1))
+		if changed:
+			logger.info("%s is %s", host, "online" if online else "offline")
+			for listener in self._listeners:
+				try:
+					listener(host, online)
+				except Exception as err:
+					logger.error("connectivity listener failed: %s", err)
+
+	def watch(self, host: str):
+		"""
+		probe a host in the background until it can be reached
+		"""
+
+		with self._lock:
+			self._watched.add(host)
+			self._wakeup.notify()
+		self._start_watcher()
+
+	def _start_watcher(self):
+		if self._watcher is not None and self._watcher.is_alive():
+			return
+		self._stopped.clear()
+		self._watcher = threading.Thread(
+			target=self._watch, name="alexis-network-watcher", daemon=True
+		)
+		self._watcher.start()
+
+	def _watch(self):
+		while not self._stopped.is_set():
+			with self._lock:
+				if not self._watched:
+					return
+				now = time.monotonic()
+				due = [host for host in self._watched
+					if self._hosts.get(host, HostState()).next_probe <= now]
+				if not due:
+					self._wakeup.wait(min(
+						self._hosts[host].next_probe for host in self._watched
+						if host in self._hosts) - now)
+					continue
+			for host in due:
+				self.probe(host)
+
+	def shutdown(self):
+		with self._lock:
+			self._stopped.set()
+			self._watched.clear()
+			self._wakeup.notify()
+
+
+monitor = ConnectivityMonitor()
+atexit.register(monitor.shutdown)
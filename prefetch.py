@@ -0,0 +1,335 @@
+"""
+This module contains functions used to warm the cache with the files in
+a directory on a sandbox.
+
+The files in the directory are listed from its tree (see `merkle`),
+which a single remote command brings up to date, or by walking the
+directory through the directory cache (see `directory`) if that command
+can't run. Matching files are then
+downloaded straight into `config.CACHE_DIR` by a bounded pool of
+workers, each holding its own pooled sftp channel. Files whose cache is
+already up to date are skipped, and every completed download is recorded
+in a progress file, along with the size and mtime it was downloaded at,
+so that an interrupted run picks up where it stopped. A file that
+changed since it was recorded is downloaded again.
+
+FUNCTIONS DECLARED
+==================
+
+walk(sandbox, root, include, exclude):
+	list the files under a remote directory that match the filters
+
+list_files(sandbox, root, include, exclude):
+	list the files under a remote directory and refresh its tree
+
+prefetch(sandbox, root, include, exclude, workers, resume, progress):
+	download the files under a remote directory into the cache
+"""
+import fnmatch
+import hashlib
+import os
+import posixpath
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import (
+	TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+)
+
+from . import config, transfer
+from .cache import Cache, CacheState
+from .compression import compressor
+from .connection import pool
+from .directory import DIRECTORY, FILE, directories
+from .logger import logger
+from .mapping import mappings, partial_path
+from .memory import tier
+from .metastore import store
+from .remote import RemoteFile
+from .typedef import StatType
+
+if TYPE_CHECKING:
+	from paramiko import SFTPClient
+
+	from .database import Sandbox
+	from .directory import DirEntry
+	from .merkle import MerkleTree
+
+ProgressCallback = Callable[[str, int, int], None]
+
+
+@dataclass
+class PrefetchResult:
+	"""the outcome of a prefetch run"""
+
+	downloaded: List[str] = field(default_factory=list)
+	"files that were downloaded"
+
+	skipped: List[str] = field(default_factory=list)
+	"files that were already up to date"
+
+	failed: List[Tuple[str, str]] = field(default_factory=list)
+	"files that could not be downloaded, with the reason"
+
+	bytes: int = 0
+	"the number of bytes downloaded"
+
+
+def matches(
+	path: str, include: Sequence[str], exclude: Sequence[str] = ()
+) -> bool:
+	"""
+	check a path, relative to the prefetch root, against glob filters
+
+	Returns: True if the path matches an include pattern and no exclude
+	pattern
+	"""
+
+	if any(fnmatch.fnmatchcase(path, pattern) for pattern in exclude):
+		return False
+	return any(fnmatch.fnmatchcase(path, pattern) for pattern in include)
+
+
+def walk(
+	sandbox: 'Sandbox', root: str,
+	include: Sequence[str] = ("*",), exclude: Sequence[str] = ()
+) -> Iterator[Tuple[str, 'DirEntry']]:
+	"""
+	list the regular files under a remote directory that match the
+	filters. fresh directory states are served from the directory cache.
+
+	Args:
+		sandbox: an instance of database.Sandbox
+		root: absolute path of the directory on the sandbox
+		include: glob patterns, relative to `root`, of files to list
+		exclude: glob patterns, relative to `root`, of files to leave out
+
+	Returns: an iterator of (absolute path, entry)
+	"""
+
+	pending = [root]
+	while pending:
+		directory = pending.pop()
+		for entry in directories.get(sandbox, directory, stale=False):
+			path = posixpath.join(directory, entry.name)
+			if entry.type == DIRECTORY:
+				pending.append(path)
+			elif entry.type == FILE:
+				if matches(posixpath.relpath(path, root), include, exclude):
+					yield path, entry
+
+
+def list_files(
+	sandbox: 'Sandbox', root: str,
+	include: Sequence[str] = ("*",), exclude: Sequence[str] = ()
+) -> Tuple[List[Tuple[str, StatType]], Optional['MerkleTree']]:
+	"""
+	list the regular files under a remote directory that match the
+	filters, from an up to date copy of the directory's tree. the
+	directory is walked over sftp if the tree can't be built.
+
+	Returns: a list of (absolute path, stat), and the tree to commit once
+	the files are downloaded, or None if the directory was walked
+	"""
+
+	from .merkle import trees
+
+	try:
+		tree, _ = trees.refresh(sandbox, root)
+	except OSError as err:
+		logger.debug("could not build the tree of %s, walking it: %s", root, err)
+		return list(walk(sandbox, root, include, exclude)), None
+	return [
+		(path, file_stat) for path, file_stat in tree.files()
+		if matches(posixpath.relpath(path, root), include, exclude)
+	], tree
+
+
+def get_progress_location(sandbox: 'Sandbox', root: str) -> str:
+	"""
+	get the path of the file that records the progress of a prefetch run
+	"""
+
+	key = f"{sandbox.name}:{root}".encode("utf-8")
+	return os.path.join(
+		config.DATA_DIR, "prefetch-" + hashlib.sha1(key).hexdigest())
+
+
+def _signature(attrs: StatType) -> Tuple[int, float]:
+	return attrs.st_size or 0, attrs.st_mtime or 0.0
+
+
+def _load_progress(location: str) -> Dict[str, Tuple[int, float]]:
+	"""
+	Returns: the size and mtime every completed file was downloaded at
+	"""
+
+	done = {}
+	try:
+		with open(location, "r") as f:
+			for line in f:
+				if not line.endswith("\n"):
+					# cut short by the interruption
+					continue
+				try:
+					size, mtime, path = line[:-1].split("\t", 2)
+					done[path] = (int(size), float(mtime))
+				except ValueError:
+					continue
+	except FileNotFoundError:
+		pass
+	return done
+
+
+def _download(
+	sftp: 'SFTPClient', sandbox: 'Sandbox', path: str, attrs: StatType
+) -> Optional[int]:
+	"""
+	download a single file into its cache
+
+	Returns: the number of bytes downloaded, or None if the cache was
+	already up to date or holds changes of its own
+	"""
+
+	cache = Cache(RemoteFile(sandbox, path))
+	if cache.state is not CacheState.SYNCED:
+		logger.debug("'%s' has local changes, not prefetching", path)
+		return None
+	if cache.meta.last_sync and cache.meta.last_sync >= (attrs.st_mtime or 0):
+		return None
+	partial = partial_path(cache.path)
+	try:
+		if (attrs.st_size or 0) >= config.RANGE_MIN_SIZE:
+			transfer.download(cache.file, partial, attrs.st_size)
+		else:
+			sftp.get(path, partial)
+	except BaseException:
+		os.remove(partial)
+		raise
+	tier.discard(cache.hash)
+	with compressor.lock:
+		os.replace(partial, cache.path)
+		compressor.discard(cache.hash)
+	mappings.invalidate(cache.path)
+	cache.mark_synced()
+	return attrs.st_size or 0
+
+
+def prefetch(
+	sandbox: 'Sandbox',
+	root: str,
+	include: Sequence[str] = ("*",),
+	exclude: Sequence[str] = (),
+	workers: int = config.PREFETCH_WORKERS,
+	resume: bool = True,
+	progress: Optional[ProgressCallback] = None,
+) -> PrefetchResult:
+	"""
+	download the files under a directory on a sandbox into the cache
+
+	Args:
+		sandbox: an instance of database.Sandbox
+		root: absolute path of the directory on the sandbox
+		include: glob patterns, relative to `root`, of files to download
+		exclude: glob patterns, relative to `root`, of files to leave out
+		workers: the number of files downloaded at the same time
+		resume: skip files completed by an earlier, interrupted run
+		progress: called with (path, files done, total files) after each file
+
+	Returns: what was downloaded, skipped and failed
+	"""
+
+	root = posixpath.normpath(root)
+	location = get_progress_location(sandbox, root)
+	done = _load_progress(location) if resume else {}
+	if done:
+		logger.info("resuming prefetch of %s, %d files done", root, len(done))
+
+	files, tree = list_files(sandbox, root, include, exclude)
+	logger.debug("found %d files to prefetch under %s", len(files), root)
+	# answer most "already cached" checks without loading every cache
+	synced = {
+		row["origin"]: row["last_sync"]
+		for row in store.query(sandbox=sandbox.name)
+		if row["state"] == CacheState.SYNCED.value
+	}
+
+	result = PrefetchResult()
+	jobs: 'queue.Queue[Tuple[str, StatType]]' = queue.Queue()
+	for path, attrs in files:
+		if (done.get(path) == _signature(attrs)
+				or synced.get(path, 0.0) >= (attrs.st_mtime or 0)):
+			result.skipped.append(path)
+		else:
+			jobs.put((path, attrs))
+	total = len(files)
+	lock = threading.Lock()
+	os.makedirs(config.DATA_DIR, exist_ok=True)
+	record = open(location, "a")
+
+	def report(path: str, attrs: StatType, completed: bool):
+		with lock:
+			if completed:
+				size, mtime = _signature(attrs)
+				record.write(f"{size}\t{mtime!r}\t{path}\n")
+				record.flush()
+			if progress is not None:
+				count = (len(result.downloaded) + len(result.skipped)
+					+ len(result.failed))
+				progress(path, count, total)
+
+	errors: List[Exception] = []
+
+	def work():
+		try:
+			with pool.sftp(sandbox) as sftp:
+				drain(sftp)
+		except Exception as err:
+			# the jobs left in the queue are failed once every worker is done
+			logger.error("prefetch worker could not connect: %s", err)
+			with lock:
+				errors.append(err)
+
+	def drain(sftp: 'SFTPClient'):
+		while True:
+			try:
+				path, attrs = jobs.get_nowait()
+			except queue.Empty:
+				return
+			try:
+				size = _download(sftp, sandbox, path, attrs)
+			except Exception as err:
+				logger.debug("could not prefetch %s: %s", path, err)
+				with lock:
+					result.failed.append((path, str(err)))
+				report(path, attrs, completed=False)
+				continue
+			with lock:
+				if size is None:
+					result.skipped.append(path)
+				else:
+					result.downloaded.append(path)
+					result.bytes += size
+			report(path, attrs, completed=True)
+
+	threads = [
+		threading.Thread(target=work, name=f"alexis-prefetch-{i}", daemon=True)
+		for i in range(min(max(1, workers), jobs.qsize()))
+	]
+	try:
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	finally:
+		record.close()
+	while not jobs.empty():
+		path, attrs = jobs.get_nowait()
+		result.failed.append((path, str(errors[-1]) if errors else "not started"))
+	if not result.failed:
+		os.remove(location)
+		if tree is not None:
+			from .merkle import trees
+
+			trees.commit(sandbox, tree)
+	return result
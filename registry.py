@@ -0,0 +1,135 @@
+"""
+This module contains the sandbox registry.
+
+Resolving the active sandbox is on the path of every cache operation, so
+the registry keeps every `Sandbox` row in memory, indexed by name and by
+host, along with the name in `config.ACTIVE_SANDBOX_FILE`. Rows are
+loaded again only when the database changed: sqlite's `data_version`
+changes when another connection commits and `total_changes` when this
+one does. The active sandbox file is read again only when its mtime,
+inode or size changed.
+
+CLASSES DECLARED
+================
+
+SandboxRegistry:
+	memoizes the sandboxes and the active sandbox
+
+OBJECTS DECLARED
+================
+
+registry:
+	the application wide sandbox registry
+"""
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import config
+from .database import DB, Sandbox
+from .logger import logger
+
+
+class SandboxRegistry:
+	"""This interface answers sandbox lookups from memory.
+	"""
+
+	def __init__(self):
+		self._by_name: Dict[str, Sandbox] = {}
+		self._by_host: Dict[str, List[Sandbox]] = {}
+		self._version: Optional[Tuple[int, int, int]] = None
+		self._active: Optional[str] = None
+		self._active_stat: Optional[Tuple[int, int, int]] = None
+		self._lock = threading.Lock()
+
+	def _db_version(self) -> Tuple[int, int, int]:
+		connection = DB.connection()
+		data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+		# every thread has a connection of its own
+		return id(connection), data_version, connection.total_changes
+
+	def _refresh(self):
+		version = self._db_version()
+		if version == self._version:
+			return
+		with self._lock:
+			if version == self._version:
+				return
+			by_name: Dict[str, Sandbox] = {}
+			by_host: Dict[str, List[Sandbox]] = {}
+			for sandbox in Sandbox.select():
+				by_name[sandbox.name] = sandbox
+				by_host.setdefault(sandbox.host, []).append(sandbox)
+			self._by_name, self._by_host = by_name, by_host
+			# loading doesn't change the version, so it can't be stale
+			self._version = version
+		logger.debug("loaded %d sandboxes", len(by_name))
+
+	def __len__(self) -> int:
+		self._refresh()
+		return len(self._by_name)
+
+	def __iter__(self) -> Iterator[Sandbox]:
+		self._refresh()
+		return iter(list(self._by_name.values()))
+
+	def __contains__(self, name: str) -> bool:
+		return self.get(name) is not None
+
+	def get(self, name: str) -> Optional[Sandbox]:
+		"""
+		get a sandbox by name
+
+		Returns: the sandbox, or None if there is none by that name
+		"""
+
+		self._refresh()
+		return self._by_name.get(name)
+
+	def on_host(self, host: str, username: Optional[str] = None) -> List[Sandbox]:
+		"""
+		get the sandboxes on a host, optionally only the one with a
+		username
+		"""
+
+		self._refresh()
+		sandboxes = self._by_host.get(host, [])
+		if username is not None:
+			sandboxes = [s for s in sandboxes if s.username == username]
+		return list(sandboxes)
+
+	def active_name(self) -> Optional[str]:
+		"""
+		get the name written in the active sandbox file
+
+		Returns: the name, which is empty if the file is, or None if there
+		is no file
+		"""
+
+		try:
+			stat = os.stat(config.ACTIVE_SANDBOX_FILE)
+		except FileNotFoundError:
+			self._active_stat = self._active = None
+			return None
+		key = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+		if key != self._active_stat:
+			try:
+				with open(config.ACTIVE_SANDBOX_FILE, "r") as sb:
+					self._active = sb.readline().strip()
+			except FileNotFoundError:
+				self._active_stat = self._active = None
+				return None
+			self._active_stat = key
+		return self._active
+
+	def invalidate(self):
+		"""
+		forget everything, so the next lookup loads it again
+		"""
+
+		with self._lock:
+			self._version = None
+			self._active_stat = None
+
+
+registry = SandboxRegistry()
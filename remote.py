@@ -0,0 +1,128 @@
+"""
+This module contains the FileType implementation for files that live
+on a sandbox. All I/O goes through the connection pool.
+"""
+import posixpath
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional
+
+from . import config
+from .connection import pool
+from .directory import directories
+from .metrics import metrics
+from .typedef import FileType, StatType
+
+if TYPE_CHECKING:
+	from paramiko import SFTPClient, SFTPFile
+
+	from .database import Sandbox
+
+
+class RemoteFile(FileType):
+	"""This interface represents a file on a sandbox.
+	"""
+
+	sandbox: 'Sandbox'
+	"the sandbox the file lives on"
+
+	def __init__(self, sandbox: 'Sandbox', path: str):
+		"""
+		Args:
+			sandbox: an instance of database.Sandbox
+			path: the absolute path of the file on the sandbox
+		"""
+		self.sandbox = sandbox
+		self._path = posixpath.normpath(path)
+		self._sftp: Optional['SFTPClient'] = None
+		self._handle: Optional['SFTPFile'] = None
+
+	def __repr__(self) -> str:
+		return f"RemoteFile({self.sandbox.name!r}, {self._path!r})"
+
+	@property
+	def name(self) -> str:
+		return posixpath.basename(self._path)
+
+	@property
+	def path(self) -> str:
+		return self._path
+
+	def __enter__(self):
+		self.open()
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def open(self, mode: str = "r+b"):
+		"""
+		open the file for I/O operations on a pooled sftp channel
+		"""
+
+		if self._handle is not None:
+			return
+		conn = pool.get(self.sandbox)
+		self._sftp = conn.checkout_sftp()
+		self._handle = self._sftp.open(self._path, mode)
+
+	def close(self):
+		"""
+		close the file and return its channel to the pool
+		"""
+
+		if self._handle is not None:
+			self._handle.close()
+			self._handle = None
+		if self._sftp is not None:
+			pool.get(self.sandbox).checkin_sftp(self._sftp)
+			self._sftp = None
+
+	def stat(self) -> StatType:
+		with metrics.span("sftp.stat"), pool.sftp(self.sandbox) as sftp:
+			return sftp.stat(self._path)  # type: ignore
+
+	def readable(self) -> bool:
+		return True
+
+	def writable(self) -> bool:
+		return True
+
+	def read(self, size: int = -1) -> str:
+		if self._handle is not None:
+			data = self._handle.read(size)
+		else:
+			with metrics.span("sftp.read"), pool.sftp(self.sandbox) as sftp:
+				with sftp.open(self._path, "rb") as f:
+					data = f.read(size)
+		metrics.inc("bytes.down", len(data))
+		return data.decode("utf-8")
+
+	def write(self, data: 'str | bytes'):
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		if self._handle is not None:
+			self._handle.write(data)
+		else:
+			with metrics.span("sftp.write"), pool.sftp(self.sandbox) as sftp:
+				with sftp.open(self._path, "wb") as f:
+					f.write(data)
+		metrics.inc("bytes.up", len(data))
+		directories.invalidate_file(self.sandbox, self._path)
+
+	def iter_bytes(self, chunk_size: int = config.IO_CHUNK_SIZE) -> Iterator[bytes]:
+		with pool.sftp(self.sandbox) as sftp:
+			with sftp.open(self._path, "rb") as f:
+				while True:
+					chunk = f.read(chunk_size)
+					if not chunk:
+						break
+					metrics.inc("bytes.down", len(chunk))
+					yield chunk
+
+	def write_stream(self, chunks: Iterable[bytes]):
+		with metrics.span("sftp.write"), pool.sftp(self.sandbox) as sftp:
+			with sftp.open(self._path, "wb") as f:
+				f.set_pipelined(True)
+				for chunk in chunks:
+					f.write(chunk)
+					metrics.inc("bytes.up", len(chunk))
+		directories.invalidate_file(self.sandbox, self._path)
@@ -0,0 +1,198 @@
+"""
+This module contains the remote command runner.
+
+Running a command on a sandbox works on the originals, so the caches
+and the originals are brought together around it:
+
+1. caches with unsynced changes, and only those, are pushed in parallel
+2. the originals of every cache on the sandbox are stat'ed with a single
+   command (see `manifest.batch_stat`)
+3. the command runs over a pooled connection, its output streamed back as
+   it is produced
+4. the originals are stat'ed again, and only the files whose stat changed
+   are pulled, in parallel. caches whose original was deleted are evicted.
+
+FUNCTIONS DECLARED
+==================
+
+diff_manifests(before, after):
+	find the files that changed between two manifests
+
+run(sandbox, command, cwd, stdout, stderr, workers):
+	run a command on a sandbox with its caches synced around it
+"""
+import queue
+import shlex
+import threading
+from dataclasses import dataclass, field
+from typing import (
+	TYPE_CHECKING, Callable, List, Optional, Sequence, Tuple
+)
+
+from . import config
+from .cache import Cache, CacheState
+from .caching import manager
+from .connection import pool
+from .journal import journal
+from .logger import logger
+from .manifest import Manifest, batch_stat
+from .metastore import store
+from .metrics import metrics
+from .remote import RemoteFile
+
+if TYPE_CHECKING:
+	from .database import Sandbox
+
+Output = Callable[[bytes], None]
+
+
+@dataclass
+class RunResult:
+	"""the outcome of a command run on a sandbox"""
+
+	status: int = 0
+	"the exit status of the command"
+
+	pushed: List[str] = field(default_factory=list)
+	"files whose changes were pushed before the command ran"
+
+	pulled: List[str] = field(default_factory=list)
+	"files the command changed, which were pulled after it ran"
+
+	removed: List[str] = field(default_factory=list)
+	"files the command deleted, whose caches were evicted"
+
+	failed: List[Tuple[str, str]] = field(default_factory=list)
+	"files that could not be synced, with the reason"
+
+
+def diff_manifests(before: Manifest, after: Manifest) -> Tuple[List[str], List[str]]:
+	"""
+	Returns: the paths whose stat differs between the manifests, and the
+	paths that are missing from `after`
+	"""
+
+	changed = [path for path, stat in after.items() if before.get(path) != stat]
+	removed = [path for path in before if path not in after]
+	return changed, removed
+
+
+def _parallel(
+	name: str, sync: Callable[[str], None], paths: Sequence[str], workers: int,
+	result: RunResult
+) -> List[str]:
+	"""
+	call `sync` with every path from a bounded pool of workers
+
+	Returns: the paths that were synced
+	"""
+
+	jobs: 'queue.Queue[str]' = queue.Queue()
+	for path in paths:
+		jobs.put(path)
+	done: List[str] = []
+	lock = threading.Lock()
+
+	def work():
+		while True:
+			try:
+				path = jobs.get_nowait()
+			except queue.Empty:
+				return
+			try:
+				sync(path)
+			except Exception as err:
+				logger.error("could not sync '%s': %s", path, err)
+				with lock:
+					result.failed.append((path, str(err)))
+			else:
+				with lock:
+					done.append(path)
+
+	threads = [
+		threading.Thread(target=work, name=f"alexis-{name}-{i}", daemon=True)
+		for i in range(max(1, min(workers, len(paths))))
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return done
+
+
+def run(
+	sandbox: 'Sandbox',
+	command: str,
+	cwd: Optional[str] = None,
+	stdout: Optional[Output] = None,
+	stderr: Optional[Output] = None,
+	workers: int = config.RUN_WORKERS,
+) -> RunResult:
+	"""
+	run a command on a sandbox. cached files with unsynced changes are
+	pushed before it runs, and cached files it changed are pulled after.
+
+	Args:
+		sandbox: an instance of database.Sandbox
+		command: the shell command to run
+		cwd: the directory on the sandbox to run the command in
+		stdout: called with every chunk of the command's standard output
+		stderr: called with every chunk of the command's standard error
+		workers: the number of files synced at the same time
+
+	Returns: the exit status of the command and the files that were synced
+	"""
+
+	result = RunResult()
+	rows = store.query(sandbox=sandbox.name)
+	origins = [row["origin"] for row in rows]
+	dirty = [
+		row["origin"] for row in rows
+		if row["state"] != CacheState.SYNCED.value
+	]
+
+	if dirty:
+		stats = batch_stat(sandbox, dirty)
+
+		def push(path: str):
+			cache = Cache(RemoteFile(sandbox, path))
+			stat = stats.get(path)
+			if stat is None:
+				# the batch leaves out files it couldn't stat, which isn't
+				# the same as files that are gone
+				try:
+					stat = cache.file.stat()
+				except FileNotFoundError:
+					cache.recreate_original()
+					return
+			cache.open(stat)
+
+		with metrics.span("run.push", files=len(dirty)):
+			result.pushed = _parallel("push", push, dirty, workers, result)
+	# deletions don't leave a cache behind to push
+	journal.replay(sandbox.name)
+
+	before = batch_stat(sandbox, origins)
+	if cwd:
+		command = f"cd {shlex.quote(cwd)} && {command}"
+	logger.debug("running %r on '%s'", command, sandbox.name)
+	with metrics.span("run.command", sandbox=sandbox.name):
+		result.status = pool.stream_command(
+			sandbox, command, stdout or (lambda data: None),
+			stderr or (lambda data: None))
+	after = batch_stat(sandbox, origins)
+	changed, removed = diff_manifests(before, after)
+
+	def pull(path: str):
+		Cache(RemoteFile(sandbox, path)).open(after[path])
+
+	if changed:
+		with metrics.span("run.pull", files=len(changed)):
+			result.pulled = _parallel("pull", pull, changed, workers, result)
+	for path in removed:
+		cache = Cache(RemoteFile(sandbox, path))
+		if manager.evict(cache.hash):
+			result.removed.append(path)
+	logger.debug("pushed %d, pulled %d and evicted %d caches around %r",
+		len(result.pushed), len(result.pulled), len(result.removed), command)
+	return result
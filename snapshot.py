@@ -0,0 +1,382 @@
+"""
+This module contains the snapshot store that keeps earlier versions of
+cached files in `config.CHECKPOINT_DIR`.
+
+Snapshots are content addressed: the contents of a version are stored
+once, under their sha256 digest, no matter how many versions or files
+share them. Each object is compressed and, when it is smaller, stored as
+a delta against the previous version of the same file. The versions of
+each cache form a chain in the `Snapshot` table.
+
+Hashing, compressing and diffing a version is slow, so syncs only hand
+the contents to a background writer (see `SnapshotStore.schedule`). A
+cache synced again before the writer gets to it is snapshotted once, with
+its latest contents. The writer also applies the retention policy every
+`config.SNAPSHOT_PRUNE_INTERVAL` seconds.
+
+OBJECT FORMAT
+=============
+
+">cBB32s" header: kind (b"f" full or b"d" delta), codec, delta chain
+depth and the raw digest of the delta base (zeros for full objects),
+followed by the compressed contents or delta.
+
+CLASSES DECLARED
+================
+
+SnapshotStore:
+	takes, restores and prunes snapshots, in the background or on the
+	caller's thread
+
+OBJECTS DECLARED
+================
+
+snapshots:
+	the application wide snapshot store
+"""
+import atexit
+import hashlib
+import lzma
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from . import config, delta
+from .database import DB, Snapshot
+from .logger import logger
+from .mapping import write_file
+
+if TYPE_CHECKING:
+	from .cache import Cache
+
+HEADER = struct.Struct(">cBB32s")
+
+CODECS = {"none": 0, "zlib": 1, "lzma": 2}
+
+
+def compress(data: bytes, codec: int) -> bytes:
+	if codec == CODECS["zlib"]:
+		return zlib.compress(data, 6)
+	if codec == CODECS["lzma"]:
+		return lzma.compress(data)
+	return data
+
+
+def decompress(data: bytes, codec: int) -> bytes:
+	if codec == CODECS["zlib"]:
+		return zlib.decompress(data)
+	if codec == CODECS["lzma"]:
+		return lzma.decompress(data)
+	return data
+
+
+class SnapshotStore:
+	"""This interface keeps versions of cached files.
+	"""
+
+	def __init__(
+		self,
+		root: Optional[str] = None,
+		codec: str = config.SNAPSHOT_CODEC,
+		use_delta: bool = config.SNAPSHOT_DELTA,
+		max_chain: int = config.SNAPSHOT_MAX_CHAIN,
+	):
+		self._root = root
+		self.codec = CODECS[codec]
+		self.use_delta = use_delta
+		self.max_chain = max_chain
+		self._ready = False
+		self._lock = threading.RLock()
+		self._queued: Dict[str, Tuple[str, bytes]] = {}
+		self._queue_lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._writer: Optional[threading.Thread] = None
+		self._stopped = threading.Event()
+
+	@property
+	def root(self) -> str:
+		return self._root or os.path.join(config.CHECKPOINT_DIR, "objects")
+
+	def _ensure_table(self):
+		if not self._ready:
+			DB.create_tables([Snapshot], safe=True)
+			self._ready = True
+
+	def get_object_location(self, digest: str) -> str:
+		"""
+		get the path where the object with `digest` is stored
+		"""
+
+		return os.path.join(self.root, digest[:2], digest[2:])
+
+	def has_object(self, digest: str) -> bool:
+		return os.path.isfile(self.get_object_location(digest))
+
+	def _read_header(self, digest: str) -> Tuple[bytes, int, int, str]:
+		with open(self.get_object_location(digest), "rb") as f:
+			kind, codec, depth, base = HEADER.unpack(f.read(HEADER.size))
+		return kind, codec, depth, base.hex()
+
+	def _write_object(
+		self, digest: str, kind: bytes, depth: int, base: str, payload: bytes
+	):
+		location = self.get_object_location(digest)
+		os.makedirs(os.path.dirname(location), exist_ok=True)
+		header = HEADER.pack(
+			kind, self.codec, depth, bytes.fromhex(base) if base else bytes(32))
+		write_file(location, header + compress(payload, self.codec))
+
+	def load(self, digest: str) -> bytes:
+		"""
+		get the contents stored under a digest, following delta bases
+
+		Raises:
+			ValueError: if the restored contents don't match the digest
+		"""
+
+		with open(self.get_object_location(digest), "rb") as f:
+			kind, codec, _, base = HEADER.unpack(f.read(HEADER.size))
+			payload = decompress(f.read(), codec)
+		base = base.hex()
+		if kind == b"d":
+			payload = delta.apply_delta(self.load(base), payload)
+		if hashlib.sha256(payload).hexdigest() != digest:
+			raise ValueError(f"snapshot object {digest} is corrupt")
+		return payload
+
+	def store(self, data: bytes, previous: Optional[str] = None) -> str:
+		"""
+		store contents, unless an object with the same contents exists
+
+		Args:
+			data: the contents to store
+			previous: the digest of the previous version of the file, used
+			as the delta base
+
+		Returns: the digest of the contents
+		"""
+
+		digest = hashlib.sha256(data).hexdigest()
+		with self._lock:
+			if self.has_object(digest):
+				return digest
+			if (self.use_delta and previous and self.has_object(previous)
+					and delta.worth_diffing(len(data))):
+				depth = self._read_header(previous)[2] + 1
+				if depth <= self.max_chain:
+					basis = self.load(previous)
+					patch = delta.make_delta(
+						delta.signature(basis, config.DELTA_BLOCK_SIZE), data,
+						len(data) // 2)
+					if patch is not None and len(patch) < len(data) // 2:
+						self._write_object(digest, b"d", depth, previous, patch)
+						return digest
+			self._write_object(digest, b"f", 0, "", data)
+		return digest
+
+	def versions(self, hash: str) -> List[Snapshot]:
+		"""
+		get the versions of a cache, oldest first
+		"""
+
+		self._ensure_table()
+		return list(Snapshot.select()
+			.where(Snapshot.cache == hash).order_by(Snapshot.version))
+
+	def latest(self, hash: str) -> Optional[Snapshot]:
+		self._ensure_table()
+		return (Snapshot.select().where(Snapshot.cache == hash)
+			.order_by(Snapshot.version.desc()).first())
+
+	def take(self, cache: 'Cache') -> Optional[Snapshot]:
+		"""
+		snapshot the current contents of a cache. nothing new is recorded
+		if the contents are the same as the latest version.
+
+		Returns: the latest version of the cache, or None if the cache is
+		too large to snapshot
+		"""
+
+		data = self._contents(cache)
+		if data is None:
+			return None
+		return self._take(cache.hash, cache.name, data)
+
+	def schedule(self, cache: 'Cache'):
+		"""
+		snapshot the current contents of a cache on the writer thread
+		"""
+
+		data = self._contents(cache)
+		if data is None:
+			return
+		with self._queue_lock:
+			self._queued[cache.hash] = (cache.name, data)
+		self._wakeup.set()
+		if self._writer is None:
+			self._start_writer()
+
+	def _contents(self, cache: 'Cache') -> Optional[bytes]:
+		view = cache.view()
+		if len(view) > config.SNAPSHOT_MAX_SIZE:
+			logger.debug("'%s' is too large to snapshot", cache.name)
+			return None
+		return bytes(view)
+
+	def _take(self, hash: str, name: str, data: bytes) -> Snapshot:
+		latest = self.latest(hash)
+		digest = self.store(data, latest.digest if latest else None)
+		if latest is not None and latest.digest == digest:
+			return latest
+		with DB.atomic():
+			version = Snapshot.create(
+				cache=hash,
+				version=latest.version + 1 if latest else 1,
+				digest=digest, size=len(data), created_at=time.time(),
+			)
+		logger.debug("took snapshot %d of '%s'", version.version, name)
+		return version
+
+	def flush(self) -> int:
+		"""
+		take the scheduled snapshots
+
+		Returns: the number of caches snapshotted
+		"""
+
+		with self._flush_lock:
+			with self._queue_lock:
+				queued, self._queued = self._queued, {}
+			for hash, (name, data) in queued.items():
+				try:
+					self._take(hash, name, data)
+				except Exception as err:
+					logger.error("could not snapshot '%s': %s", name, err)
+			return len(queued)
+
+	def restore(self, hash: str, version: int) -> bytes:
+		"""
+		get the contents of a version of a cache
+
+		Raises:
+			KeyError: if the version doesn't exist
+		"""
+
+		self._ensure_table()
+		row = (Snapshot.select()
+			.where(Snapshot.cache == hash, Snapshot.version == version).first())
+		if row is None:
+			raise KeyError(f"no version {version} of cache {hash}")
+		return self.load(row.digest)
+
+	def rollback(self, cache: 'Cache', version: int):
+		"""
+		overwrite a cache with one of its earlier versions. the cache is
+		then staged like any other change.
+		"""
+
+		cache.write(self.restore(cache.hash, version))
+		logger.info("rolled '%s' back to version %d", cache.name, version)
+
+	def prune(
+		self,
+		keep: int = config.SNAPSHOT_KEEP,
+		max_age: float = config.SNAPSHOT_MAX_AGE,
+	) -> int:
+		"""
+		apply the retention policy: keep the latest `keep` versions of each
+		cache, drop versions older than `max_age` seconds (the latest
+		version is always kept), then delete objects nothing refers to.
+
+		Returns: the number of objects deleted
+		"""
+
+		self._ensure_table()
+		cutoff = time.time() - max_age
+		doomed = []
+		current, count = None, 0
+		query = Snapshot.select().order_by(
+			Snapshot.cache, Snapshot.version.desc())
+		for row in query:
+			if row.cache != current:
+				current, count = row.cache, 0
+			count += 1
+			if count > 1 and (count > keep or row.created_at < cutoff):
+				doomed.append(row.id)
+		with DB.atomic():
+			for i in range(0, len(doomed), 500):
+				Snapshot.delete().where(
+					Snapshot.id.in_(doomed[i:i + 500])).execute()
+		return self.collect()
+
+	def collect(self) -> int:
+		"""
+		delete objects that no version refers to, directly or as a delta
+		base
+
+		Returns: the number of objects deleted
+		"""
+
+		self._ensure_table()
+		with self._lock:
+			live: Set[str] = set()
+			pending = [row.digest for row in Snapshot.select(Snapshot.digest)]
+			while pending:
+				digest = pending.pop()
+				if digest in live or not self.has_object(digest):
+					continue
+				live.add(digest)
+				kind, _, _, base = self._read_header(digest)
+				if kind == b"d":
+					pending.append(base)
+			deleted = 0
+			if not os.path.isdir(self.root):
+				return 0
+			for prefix in os.listdir(self.root):
+				directory = os.path.join(self.root, prefix)
+				for name in os.listdir(directory):
+					if prefix + name not in live and not name.endswith(".part"):
+						os.remove(os.path.join(directory, name))
+						deleted += 1
+		logger.debug("deleted %d unreferenced snapshot objects", deleted)
+		return deleted
+
+	def _start_writer(self):
+		with self._queue_lock:
+			if self._writer is not None:
+				return
+			self._writer = threading.Thread(
+				target=self._write_loop, name="alexis-snapshot-writer",
+				daemon=True
+			)
+			self._writer.start()
+
+	def _write_loop(self):
+		pruned = 0.0
+		while not self._stopped.is_set():
+			self._wakeup.wait(config.SNAPSHOT_PRUNE_INTERVAL)
+			self._wakeup.clear()
+			self.flush()
+			if time.time() - pruned > config.SNAPSHOT_PRUNE_INTERVAL:
+				pruned = time.time()
+				try:
+					self.prune()
+				except Exception as err:
+					logger.error("could not prune snapshots: %s", err)
+
+	def shutdown(self):
+		"""
+		stop the writer and take the scheduled snapshots
+		"""
+
+		self._stopped.set()
+		self._wakeup.set()
+		self.flush()
+
+
+snapshots = SnapshotStore()
+atexit.register(snapshots.shutdown)
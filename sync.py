@@ -0,0 +1,292 @@
+"""
+This module contains the background sync engine.
+
+Writes to a cache schedule it to be synced `config.SYNC_DEBOUNCE`
+seconds later; writes that arrive before then push the sync back, so a
+burst of saves becomes a single upload. Due caches are synced by at most
+`config.SYNC_WORKERS` workers, interactive requests first.
+Caches of files on a sandbox the connectivity monitor knows to be
+unreachable are not synced; their changes wait in the journal.
+
+CLASSES DECLARED
+================
+
+SyncEngine:
+	owns the queue of caches waiting to be synced
+
+OBJECTS DECLARED
+================
+
+engine:
+	the application wide sync engine
+"""
+import atexit
+import heapq
+import itertools
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from . import config
+from .logger import logger
+from .metrics import metrics
+from .network import monitor
+
+if TYPE_CHECKING:
+	from .cache import Cache
+
+INTERACTIVE = 0
+"priority of syncs a user is waiting on"
+
+BULK = 10
+"priority of background syncs"
+
+
+def get_host(cache: 'Cache') -> Optional[str]:
+	"""
+	Returns: the host of the sandbox the original of a cache lives on,
+	or None if it isn't on a sandbox
+	"""
+
+	return getattr(getattr(cache.file, "sandbox", None), "host", None)
+
+
+def is_offline(host: Optional[str]) -> bool:
+	"""
+	check the cached state of a host without probing it. hosts that are
+	known to be unreachable are watched until they come back.
+	"""
+
+	if host is None or monitor.state(host) is not False:
+		return False
+	monitor.watch(host)
+	return True
+
+
+class SyncJob:
+	"""This interface represents a cache waiting to be synced.
+	"""
+
+	__slots__ = ("cache", "priority", "due", "done", "synced")
+
+	def __init__(self, cache: 'Cache', priority: int, due: float):
+		self.cache = cache
+		self.priority = priority
+		self.due = due
+		self.done = threading.Event()
+		self.synced = False
+		"True once the cache was synced, False if it failed or was deferred"
+
+
+class SyncEngine:
+	"""This interface syncs caches in the background.
+
+	Jobs wait in a timer heap ordered by due time until their debounce
+	delay is over, then move to a ready heap ordered by priority. A cache
+	has at most one queued job; scheduling it again only moves the due
+	time and raises the priority.
+	"""
+
+	def __init__(
+		self,
+		debounce: float = config.SYNC_DEBOUNCE,
+		workers: int = config.SYNC_WORKERS,
+	):
+		self.debounce = debounce
+		self.workers = workers
+		self.synced = 0
+		self.failed = 0
+		self.deferred = 0
+		self._jobs: Dict[str, SyncJob] = {}
+		self._timers: List[Tuple[float, int, str]] = []
+		self._ready: List[Tuple[int, int, str]] = []
+		self._running: Set[str] = set()
+		self._seq = itertools.count()
+		self._cond = threading.Condition()
+		self._threads: List[threading.Thread] = []
+		self._stopped = threading.Event()
+
+	@property
+	def running(self) -> bool:
+		return bool(self._threads) and not self._stopped.is_set()
+
+	@property
+	def depth(self) -> int:
+		"""
+		the number of caches waiting to be synced
+		"""
+
+		return len(self._jobs)
+
+	def start(self):
+		"""
+		start the workers. the engine starts itself the first time a cache
+		is scheduled, unless it was stopped.
+		"""
+
+		if self.running:
+			return
+		self._stopped.clear()
+		self._threads = [
+			threading.Thread(
+				target=self._work, name=f"alexis-sync-{i}", daemon=True)
+			for i in range(max(1, self.workers))
+		]
+		for thread in self._threads:
+			thread.start()
+		logger.debug("sync engine started with %d workers", len(self._threads))
+
+	def schedule(
+		self, cache: 'Cache', priority: int = BULK,
+		delay: Optional[float] = None
+	) -> threading.Event:
+		"""
+		queue a cache to be synced
+
+		Args:
+			cache: the cache to sync
+			priority: INTERACTIVE or BULK. lower values are synced first
+			delay: seconds to wait before syncing. defaults to the debounce
+			delay
+
+		Returns: an event that is set once the cache has been synced
+		"""
+
+		return self._enqueue(cache, priority, delay).done
+
+	def _enqueue(
+		self, cache: 'Cache', priority: int, delay: Optional[float]
+	) -> SyncJob:
+		if not self._threads and not self._stopped.is_set():
+			self.start()
+		delay = self.debounce if delay is None else delay
+		due = time.monotonic() + delay
+		with self._cond:
+			job = self._jobs.get(cache.hash)
+			if job is None:
+				job = self._jobs[cache.hash] = SyncJob(cache, priority, due)
+			else:
+				job.cache = cache
+				job.priority = min(job.priority, priority)
+				job.due = due if priority > INTERACTIVE else min(job.due, due)
+			heapq.heappush(self._timers, (job.due, next(self._seq), cache.hash))
+			metrics.gauge("sync.queue").set(len(self._jobs))
+			self._cond.notify()
+			return job
+
+	def sync(self, cache: 'Cache', timeout: Optional[float] = None) -> bool:
+		"""
+		sync a cache ahead of background work and wait for it
+
+		Returns: True if the cache was synced within `timeout` seconds,
+		False if it wasn't, the sync failed or its sandbox is known to be
+		unreachable
+		"""
+
+		if is_offline(get_host(cache)):
+			return False
+		if self._stopped.is_set():
+			# the engine was stopped; nothing would pick the job up
+			try:
+				cache.sync()
+			except Exception as err:
+				logger.error("could not sync '%s': %s", cache.file.path, err)
+				return False
+			return True
+		job = self._enqueue(cache, INTERACTIVE, 0)
+		return job.done.wait(timeout) and job.synced
+
+	def _next(self) -> Optional[SyncJob]:
+		"""
+		wait for a job that is due and not already being synced
+		"""
+
+		with self._cond:
+			while not self._stopped.is_set():
+				now = time.monotonic()
+				while self._timers and self._timers[0][0] <= now:
+					due, _, hash = heapq.heappop(self._timers)
+					job = self._jobs.get(hash)
+					# skip timers left behind when a job was rescheduled
+					if job is not None and job.due == due:
+						heapq.heappush(
+							self._ready, (job.priority, next(self._seq), hash))
+				while self._ready:
+					_, _, hash = heapq.heappop(self._ready)
+					job = self._jobs.get(hash)
+					if job is None:
+						continue
+					if hash in self._running:
+						# another worker is syncing it; try again later
+						job.due = now + self.debounce
+						heapq.heappush(
+							self._timers, (job.due, next(self._seq), hash))
+						continue
+					del self._jobs[hash]
+					self._running.add(hash)
+					metrics.gauge("sync.queue").set(len(self._jobs))
+					return job
+				timeout = self._timers[0][0] - now if self._timers else None
+				self._cond.wait(timeout)
+		return None
+
+	def _work(self):
+		while True:
+			job = self._next()
+			if job is None:
+				return
+			host = get_host(job.cache)
+			try:
+				if is_offline(host):
+					# the journal keeps the changes until the host is back
+					self.deferred += 1
+					continue
+				job.cache.sync()
+				job.synced = True
+				self.synced += 1
+			except Exception as err:
+				self.failed += 1
+				logger.error("could not sync '%s': %s", job.cache.file.path, err)
+				if host is not None and isinstance(err, (OSError, EOFError)):
+					monitor.report(host, False)
+					monitor.watch(host)
+			finally:
+				with self._cond:
+					self._running.discard(job.cache.hash)
+					self._cond.notify_all()
+				job.done.set()
+
+	def drain(self, timeout: Optional[float] = None) -> bool:
+		"""
+		sync every queued cache now and wait for the queue to empty
+
+		Returns: True if the queue emptied within `timeout` seconds
+		"""
+
+		with self._cond:
+			for job in self._jobs.values():
+				job.due = 0.0
+				heapq.heappush(self._timers, (0.0, next(self._seq), job.cache.hash))
+			self._cond.notify_all()
+			return self._cond.wait_for(
+				lambda: not self._jobs and not self._running, timeout)
+
+	def stop(self, drain: bool = True):
+		"""
+		stop the workers, syncing queued caches first if `drain` is True
+		"""
+
+		if not self.running:
+			return
+		if drain:
+			self.drain()
+		with self._cond:
+			self._stopped.set()
+			self._cond.notify_all()
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+
+engine = SyncEngine()
+atexit.register(engine.stop)
@@ -0,0 +1,13 @@
+import pytest
+
+from ..benchmarks.sync import Environment
+
+
+@pytest.fixture(scope="session")
+def env():
+	"""a temporary home and a stand-in sandbox, shared by the whole run
+	since the application keeps global state
+	"""
+
+	with Environment() as env:
+		yield env
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import pytest
+from click.testing import CliRunner
+
+from .. import runner
+from ..cli import main
+from ..registry import registry
+
+
+@pytest.fixture
+def commands(monkeypatch):
+	"""the commands `run` would have run, with the sandbox and directory"""
+
+	calls = []
+	sandbox = SimpleNamespace(name="first")
+
+	def run(sandbox, command, cwd, stdout, stderr, workers):
+		calls.append((sandbox.name, command, cwd))
+		stdout(b"out\n")
+		return SimpleNamespace(pushed=[], pulled=[], failed=[], status=3)
+
+	monkeypatch.setattr(registry, "get", lambda name: sandbox)
+	monkeypatch.setattr(runner, "run", run)
+	return calls
+
+
+@pytest.mark.parametrize("args, command, cwd", [
+	(["grep", "-n", "foo", "f.c"], "grep -n foo f.c", None),
+	(["wc", "-w", "x"], "wc -w x", None),
+	(["make", "-C", "sub"], "make -C sub", None),
+	(["-C", "src", "make", "-n", "all"], "make -n all", "src"),
+	(["--", "ls", "--name", "x"], "ls --name x", None),
+])
+def test_run_passes_options_through(commands, args, command, cwd):
+	result = CliRunner().invoke(main, ["run", "-n", "first", *args])
+	assert result.exit_code == 3, result.output
+	assert commands == [("first", command, cwd)]
+	assert result.stdout_bytes == b"out\n"
+
+
+def test_run_needs_a_command(commands):
+	result = CliRunner().invoke(main, ["run", "-n", "first"])
+	assert result.exit_code != 0
+	assert commands == []
@@ -0,0 +1,77 @@
+import os
+import random
+
+import pytest
+
+from ..delta import apply_delta, make_delta, signature, weak_checksum
+
+BLOCK = 64
+
+
+def rolled(data: bytes, block_size: int):
+	"""the checksum of every window of `data`, rolled along one byte at a time"""
+
+	a, b = weak_checksum(data[:block_size])
+	yield a, b
+	for i in range(len(data) - block_size):
+		old, new = data[i], data[i + block_size]
+		a = (a - old + new) & 0xFFFF
+		b = (b - block_size * old + a) & 0xFFFF
+		yield a, b
+
+
+def test_rolling_checksum_matches_weak_checksum():
+	data = os.urandom(BLOCK * 4)
+	for i, rolling in enumerate(rolled(data, BLOCK)):
+		assert rolling == weak_checksum(data[i:i + BLOCK])
+
+
+@pytest.mark.parametrize("change", [
+	lambda data: data,
+	lambda data: data[:100] + b"inserted" + data[100:],
+	lambda data: data[:1000] + data[1300:],
+	lambda data: data + os.urandom(10),
+	lambda data: data[:BLOCK * 3 + 5],
+	lambda data: b"",
+	lambda data: os.urandom(len(data)),
+])
+def test_round_trip(change):
+	basis = os.urandom(BLOCK * 40 + 17)
+	data = change(basis)
+	delta = make_delta(signature(basis, BLOCK), data)
+	assert apply_delta(basis, delta) == data
+
+
+def test_round_trip_with_empty_basis():
+	data = os.urandom(1000)
+	delta = make_delta(signature(b"", BLOCK), data)
+	assert apply_delta(b"", delta) == data
+
+
+def test_small_change_sends_little():
+	basis = os.urandom(BLOCK * 100)
+	data = bytearray(basis)
+	data[BLOCK * 50 + 3] ^= 0xFF
+	delta = make_delta(signature(basis, BLOCK), bytes(data))
+	assert len(delta) < BLOCK * 3
+
+
+def test_gives_up_past_max_literal():
+	basis = os.urandom(BLOCK * 100)
+	data = os.urandom(len(basis))
+	sig = signature(basis, BLOCK)
+	assert make_delta(sig, data, max_literal=len(data) // 2) is None
+	edited = basis[:BLOCK * 10] + data[:BLOCK] + basis[BLOCK * 11:]
+	delta = make_delta(sig, edited, max_literal=len(edited) // 2)
+	assert apply_delta(basis, delta) == edited
+
+
+def test_corrupt_delta_is_refused():
+	basis = bytes(random.Random(0).getrandbits(8) for _ in range(BLOCK * 10))
+	data = basis[:BLOCK * 5] + b"changed" + basis[BLOCK * 5:]
+	delta = bytearray(make_delta(signature(basis, BLOCK), data))
+	delta[-1] ^= 0xFF
+	with pytest.raises(ValueError):
+		apply_delta(basis, bytes(delta))
+	with pytest.raises(ValueError):
+		apply_delta(basis, b"\0\0\0\x40X")
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from ..journal import APPEND, DELETE, WRITE, Journal, journal
+
+
+@pytest.fixture
+def local(tmp_path):
+	return Journal(str(tmp_path / "journal"), fsync=False)
+
+
+def test_changes_coalesce(local):
+	assert local.record(WRITE, "a", "first", "/a")
+	assert not local.record(APPEND, "a", "first", "/a")
+	assert local.record(WRITE, "b", "first", "/b")
+	assert [r["hash"] for r in local.pending()] == ["a", "b"]
+	assert local.record(DELETE, "a", "first", "/a")
+	assert local.pending("first")[-1]["op"] == DELETE
+	assert local.pending("second") == []
+
+
+def test_commit_keeps_changes_made_during_a_push(local):
+	local.record(WRITE, "a", "first", "/a")
+	upto = local.watermark()
+	local.record(APPEND, "a", "first", "/a")
+	assert local.commit("a", upto=upto) == 0
+	assert "a" in local
+	assert local.commit("a", upto=local.watermark()) == 1
+	assert "a" not in local
+
+
+def test_reload(local):
+	local.record(WRITE, "a", "first", "/a")
+	local.record(WRITE, "b", "first", "/b")
+	local.commit("a")
+	local.close()
+	reloaded = Journal(local.path)
+	assert [r["hash"] for r in reloaded.pending()] == ["b"]
+	reloaded.record(WRITE, "c", "first", "/c")
+	assert reloaded.watermark() > reloaded.pending()[0]["seq"]
+
+
+def test_torn_record_is_cut_off(local):
+	local.record(WRITE, "a", "first", "/a")
+	local.close()
+	size = os.path.getsize(local.path)
+	with open(local.path, "ab") as f:
+		f.write(b"0badc0de {\"seq\": 1")
+	reloaded = Journal(local.path)
+	assert [r["hash"] for r in reloaded.pending()] == ["a"]
+	assert os.path.getsize(local.path) == size
+
+
+def test_compact(local):
+	for name in "abcd":
+		local.record(WRITE, name, "first", "/" + name)
+	local.commit("a", "b", "c")
+	local.compact()
+	with open(local.path, "rb") as f:
+		assert len(f.readlines()) == 1
+	assert [r["hash"] for r in Journal(local.path).pending()] == ["d"]
+
+
+@pytest.fixture
+def offline_writes(monkeypatch):
+	"""keep the sync engine from pushing writes, as if the sandbox was
+	unreachable when they were made
+	"""
+
+	from ..sync import engine
+
+	monkeypatch.setattr(engine, "schedule", lambda *args, **kwargs: None)
+
+
+def test_replay_pushes_pending_writes(env, offline_writes):
+	cache = env.cached(1000)
+	sandbox = env.sandboxes[0]
+	cache.write(b"written offline")
+	assert cache.hash in journal
+	assert journal.replay(sandbox.name) == 1
+	assert cache.hash not in journal
+	with open(cache.file.path, "rb") as f:
+		assert f.read() == b"written offline"
+
+
+def test_replay_drops_changes_to_evicted_caches(env, offline_writes):
+	sandbox = env.sandboxes[0]
+	original = env.remote(1000)
+	with open(original.path, "rb") as f:
+		contents = f.read()
+	journal.record(WRITE, "0" * 32, sandbox.name, original.path)
+	assert journal.replay(sandbox.name) == 0
+	assert "0" * 32 not in journal
+	with open(original.path, "rb") as f:
+		assert f.read() == contents
@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import zlib
+
+import pytest
+
+from .. import config
+from ..merkle import MerkleTree, changed_nodes, remote_command, scan
+
+
+def write(path, data: bytes):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "wb") as f:
+		f.write(data)
+
+
+@pytest.fixture
+def root(tmp_path):
+	root = str(tmp_path / "root")
+	write(os.path.join(root, "a.txt"), b"a")
+	write(os.path.join(root, "src", "main.c"), b"int main;")
+	write(os.path.join(root, "src", "lib", "lib.c"), b"int lib;")
+	write(os.path.join(root, "docs", "readme"), b"read me")
+	return root
+
+
+@pytest.fixture
+def helper(tmp_path, monkeypatch):
+	"""run the tree helper locally, as it runs on a sandbox"""
+
+	monkeypatch.setattr(config, "TREE_STATE_DIR", str(tmp_path / "states"))
+
+	def run(root: str, known: str) -> dict:
+		out = subprocess.run(
+			remote_command(root, known), shell=True, check=True,
+			stdout=subprocess.PIPE).stdout
+		return json.loads(zlib.decompress(out))
+	return run
+
+
+def test_changed_nodes_skips_unchanged_subtrees(root):
+	before = scan(root)
+	write(os.path.join(root, "src", "lib", "lib.c"), b"int lib = 1;")
+	after = scan(root)
+	assert after[""][0] != before[""][0]
+	assert after["docs"] == before["docs"]
+	assert set(changed_nodes(before, after)) == {"", "src", "src/lib"}
+	assert changed_nodes(after, after) == {}
+
+
+def test_helper_round_trip(root, helper):
+	tree = MerkleTree(root)
+	update = helper(root, "-")
+	assert update["full"]
+	diff = tree.apply(update)
+	assert tree.digest == update["root"] == scan(root)[""][0]
+	files = {path for path, _ in tree.files()}
+	assert files == {os.path.join(root, name) for name in (
+		"a.txt", "src/main.c", "src/lib/lib.c", "docs/readme")}
+	assert sorted(diff.changed) == sorted(files)
+	assert tree.stat(os.path.join(root, "src", "main.c")).st_size == 9
+
+	write(os.path.join(root, "src", "main.c"), b"int main(void);")
+	write(os.path.join(root, "src", "new.c"), b"")
+	os.remove(os.path.join(root, "docs", "readme"))
+	os.rmdir(os.path.join(root, "docs"))
+	update = helper(root, tree.digest)
+	assert not update["full"]
+	assert set(update["nodes"]) == {"", "src"}
+	diff = tree.apply(update)
+	assert sorted(diff.changed) == [
+		os.path.join(root, "src", "main.c"), os.path.join(root, "src", "new.c")]
+	assert diff.removed == [os.path.join(root, "docs", "readme")]
+	assert diff.removed_directories == [os.path.join(root, "docs")]
+	assert tree.digest == scan(root)[""][0]
+	assert tree.stat(os.path.join(root, "docs")) is None
+
+	assert not tree.apply(helper(root, tree.digest))
+
+
+def test_helper_sends_everything_for_an_unknown_tree(root, helper):
+	update = helper(root, "0" * 32)
+	assert update["full"]
+	assert set(update["nodes"]) == set(scan(root))
+
+
+def test_save_and_load(root, helper, tmp_path):
+	location = str(tmp_path / "metadata" / "root.tree")
+	tree = MerkleTree(root, location=location)
+	tree.apply(helper(root, "-"))
+	tree.save()
+	loaded = MerkleTree(root, location=location)
+	assert loaded.load()
+	assert loaded.nodes == tree.nodes
+	assert loaded.digest == tree.digest
+	assert not MerkleTree(root, location=location + ".missing").load()
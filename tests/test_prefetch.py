@@ -0,0 +1,72 @@
+import contextlib
+import os
+
+import pytest
+
+from ..cache import Cache
+from ..connection import pool
+from ..prefetch import get_progress_location, prefetch
+from ..remote import RemoteFile
+
+
+@pytest.fixture
+def tree(env, request):
+	"""a directory of files on the second sandbox, named after the test"""
+
+	sandbox = env.sandboxes[1]
+	root = env.server.path(sandbox.name, request.node.name)
+	os.makedirs(os.path.join(root, "src"))
+	for name in ("a.c", "b.c", "src/c.c", "src/d.o"):
+		with open(os.path.join(root, name), "wb") as f:
+			f.write(os.urandom(100))
+	return sandbox, root
+
+
+def cached(sandbox, path) -> bytes:
+	with open(Cache(RemoteFile(sandbox, path)).path, "rb") as f:
+		return f.read()
+
+
+def test_prefetch_and_skip(tree):
+	sandbox, root = tree
+	result = prefetch(sandbox, root, exclude=["*.o"])
+	assert sorted(result.downloaded) == [
+		os.path.join(root, name) for name in ("a.c", "b.c", "src/c.c")]
+	assert not result.failed
+	with open(os.path.join(root, "a.c"), "rb") as f:
+		assert cached(sandbox, os.path.join(root, "a.c")) == f.read()
+	assert not os.path.exists(get_progress_location(sandbox, root))
+
+	result = prefetch(sandbox, root, exclude=["*.o"])
+	assert result.downloaded == []
+	assert len(result.skipped) == 3
+
+
+def test_connect_failure_fails_every_file(tree, monkeypatch):
+	sandbox, root = tree
+
+	@contextlib.contextmanager
+	def refused(sandbox):
+		raise ConnectionRefusedError("refused")
+		yield
+
+	monkeypatch.setattr(pool, "sftp", refused)
+	result = prefetch(sandbox, root, workers=2)
+	assert result.downloaded == []
+	assert len(result.failed) == 4
+	assert all("refused" in reason for _, reason in result.failed)
+	assert os.path.exists(get_progress_location(sandbox, root))
+
+
+def test_resume_downloads_files_changed_since(tree):
+	sandbox, root = tree
+	path = os.path.join(root, "a.c")
+	location = get_progress_location(sandbox, root)
+	os.makedirs(os.path.dirname(location), exist_ok=True)
+	with open(location, "w") as f:
+		# completed by an interrupted run, before the file changed
+		f.write(f"1\t0.0\t{path}\n")
+	result = prefetch(sandbox, root, include=["a.c"])
+	assert result.downloaded == [path]
+	with open(path, "rb") as f:
+		assert cached(sandbox, path) == f.read()
@@ -0,0 +1,310 @@
+"""
+This module contains the transfer of files from a sandbox into the cache.
+
+Reading a file with blocking sftp reads waits a round-trip for every
+request, so throughput is capped at the request size over the latency
+of the link. Files are instead read with pipelined requests (paramiko's
+`readv`), and files of at least `config.RANGE_MIN_SIZE` bytes are split
+into `config.RANGE_SIZE` byte ranges that several pooled sftp channels
+fetch at the same time. Every range is written straight to its offset in
+a preallocated file.
+
+While a split file is downloading, a helper computes the md5 of every
+range on the sandbox. Workers don't wait for it: a range whose channel
+failed is fetched again on a new channel straight away, and the ranges
+are checked against the digests once they are written. A range whose md5
+doesn't match is fetched again, up to `config.RANGE_RETRIES` times. If
+the helper can't run, the whole file is checked against `md5sum` instead.
+
+FUNCTIONS DECLARED
+==================
+
+get_ranges(size, range_size):
+	split a file into byte ranges
+
+range_digests(sandbox, path, range_size):
+	compute the md5 of every range of a file on a sandbox
+
+file_digest(sandbox, path):
+	compute the md5 of a whole file on a sandbox
+
+download(file, destination, size, workers):
+	download a file from a sandbox into a local file
+"""
+import hashlib
+import inspect
+import os
+import queue
+import shlex
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from . import config
+from .connection import pool
+from .logger import logger
+from .metrics import metrics
+
+if TYPE_CHECKING:
+	from paramiko import SFTPFile
+
+	from .database import Sandbox
+	from .remote import RemoteFile
+
+Range = Tuple[int, int]
+"the offset and length of a part of a file"
+
+
+def get_ranges(size: int, range_size: int) -> List[Range]:
+	"""
+	split a file of `size` bytes into ranges of at most `range_size` bytes
+	"""
+
+	return [
+		(offset, min(range_size, size - offset))
+		for offset in range(0, size, range_size)
+	] or [(0, 0)]
+
+
+def _digest_main():
+	import hashlib
+	import sys
+
+	range_size = int(sys.argv[2])
+	with open(sys.argv[1], "rb") as f:
+		while True:
+			data = f.read(range_size)
+			if not data:
+				break
+			sys.stdout.write(hashlib.md5(data).hexdigest() + "\n")
+
+
+_helper: Optional[str] = None
+
+
+def range_digests(
+	sandbox: 'Sandbox', path: str, range_size: int
+) -> Optional[List[str]]:
+	"""
+	compute the md5 of every range of a file on a sandbox, with a single
+	remote command
+
+	Returns: the hex digests in order, or None if the helper failed
+	"""
+
+	global _helper
+	if _helper is None:
+		_helper = inspect.getsource(_digest_main) + "\n_digest_main()"
+	command = "python3 -c {} {} {}".format(
+		shlex.quote(_helper), shlex.quote(path), range_size)
+	with metrics.span("transfer.digests"):
+		status, out, err = pool.exec_command(sandbox, command)
+	if status != 0:
+		logger.debug("digest helper failed (%d): %s", status, err)
+		return None
+	return out.decode().split()
+
+
+def file_digest(sandbox: 'Sandbox', path: str) -> Optional[str]:
+	"""
+	compute the md5 of a whole file on a sandbox with `md5sum`
+
+	Returns: the hex digest, or None if it could not be computed
+	"""
+
+	with metrics.span("transfer.digests"):
+		status, out, err = pool.exec_command(
+			sandbox, f"md5sum {shlex.quote(path)}")
+	if status != 0 or not out:
+		logger.debug("md5sum failed (%d): %s", status, err)
+		return None
+	return out.split()[0].decode()
+
+
+def _local_digest(path: str) -> str:
+	md5 = hashlib.md5()
+	with open(path, "rb") as f:
+		while True:
+			data = f.read(config.IO_CHUNK_SIZE)
+			if not data:
+				return md5.hexdigest()
+			md5.update(data)
+
+
+def _fetch(handle: 'SFTPFile', fd: int, offset: int, length: int) -> str:
+	"""
+	read a range of a remote file with pipelined requests and write it to
+	the same offset of a local file
+
+	Returns: the md5 of the range
+
+	Raises:
+		OSError: if the file ended before the range did
+	"""
+
+	blocks = [
+		(start, min(config.IO_CHUNK_SIZE, offset + length - start))
+		for start in range(offset, offset + length, config.IO_CHUNK_SIZE)
+	]
+	md5 = hashlib.md5()
+	position = offset
+	for data in handle.readv(blocks):
+		if not data:
+			break
+		os.pwrite(fd, data, position)
+		md5.update(data)
+		position += len(data)
+		metrics.inc("bytes.down", len(data))
+	if position != offset + length:
+		raise OSError(
+			f"read {position - offset} of {length} bytes at offset {offset}")
+	return md5.hexdigest()
+
+
+def _preallocate(fd: int, size: int):
+	try:
+		os.posix_fallocate(fd, 0, size)
+	except (AttributeError, OSError):
+		# not every platform and filesystem can reserve the space
+		os.ftruncate(fd, size)
+
+
+def download(
+	file: 'RemoteFile', destination: str, size: int,
+	workers: int = config.RANGE_WORKERS
+) -> int:
+	"""
+	download a file from a sandbox into a local file, replacing it
+
+	Args:
+		file: the file on the sandbox
+		destination: the path of the local file
+		size: the size of the file on the sandbox
+		workers: the number of channels fetching ranges at the same time
+
+	Returns: the number of bytes downloaded
+
+	Raises:
+		OSError: if a range could not be fetched in `config.RANGE_RETRIES`
+		retries
+	"""
+
+	sandbox = file.sandbox
+	split = size >= config.RANGE_MIN_SIZE
+	ranges = get_ranges(size, config.RANGE_SIZE if split else max(size, 1))
+	digests: List[Optional[List[str]]] = [None]
+	digested = threading.Event()
+
+	def digest():
+		try:
+			digests[0] = range_digests(sandbox, file.path, config.RANGE_SIZE)
+		except Exception as err:
+			logger.debug("could not compute digests of %s: %s", file.path, err)
+		finally:
+			digested.set()
+
+	if split:
+		threading.Thread(
+			target=digest, name="alexis-transfer-digests", daemon=True).start()
+
+	jobs: 'queue.Queue[int]' = queue.Queue()
+	for index in range(len(ranges)):
+		jobs.put(index)
+	md5s: Dict[int, str] = {}
+	attempts: Dict[int, int] = {}
+	failed: List[Tuple[Range, str]] = []
+	lock = threading.Lock()
+
+	def mismatched() -> List[int]:
+		"""
+		Returns: the ranges written since the last check that don't match
+		the file on the sandbox
+		"""
+
+		digested.wait()
+		with lock:
+			written = dict(md5s)
+			md5s.clear()
+		expected = digests[0]
+		if expected is not None and len(expected) == len(ranges):
+			return [i for i, md5 in written.items() if expected[i] != md5]
+		digest = None
+		try:
+			digest = file_digest(sandbox, file.path)
+		except Exception as err:
+			logger.debug("could not compute the digest of %s: %s", file.path, err)
+		if digest is None:
+			logger.warning("could not verify the download of '%s'; only its "
+				"size was checked", file.path)
+			return []
+		if _local_digest(destination) == digest:
+			return []
+		return list(range(len(ranges)))
+
+	def retry(index: int, reason: str):
+		with lock:
+			attempts[index] = attempts.get(index, 0) + 1
+			if attempts[index] > config.RANGE_RETRIES:
+				failed.append((ranges[index], reason))
+				return
+		metrics.inc("transfer.retries")
+		logger.debug("fetching range %d of %s again: %s", index, file.path, reason)
+		jobs.put(index)
+
+	def work():
+		connection = pool.get(sandbox)
+		sftp = handle = None
+		try:
+			while True:
+				try:
+					index = jobs.get_nowait()
+				except queue.Empty:
+					return
+				offset, length = ranges[index]
+				try:
+					if handle is None:
+						sftp = connection.checkout_sftp()
+						handle = sftp.open(file.path, "rb")
+					md5 = _fetch(handle, fd, offset, length)
+				except Exception as err:
+					# the channel may be broken; carry on with a new one
+					if sftp is not None:
+						sftp.close()
+					sftp = handle = None
+					retry(index, str(err) or type(err).__name__)
+					continue
+				with lock:
+					md5s[index] = md5
+		finally:
+			if handle is not None:
+				try:
+					handle.close()
+					connection.checkin_sftp(sftp)
+				except Exception:
+					sftp.close()
+
+	with metrics.span("transfer.download", ranges=len(ranges)):
+		fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			_preallocate(fd, size)
+			while not jobs.empty():
+				threads = [
+					threading.Thread(
+						target=work, name=f"alexis-transfer-{i}", daemon=True)
+					for i in range(max(1, min(workers, jobs.qsize())))
+				]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+				if failed or not split:
+					break
+				for index in mismatched():
+					retry(index, "checksum mismatch")
+		finally:
+			os.close(fd)
+	if failed:
+		(offset, length), reason = failed[0]
+		raise OSError(f"could not download {length} bytes at offset {offset} "
+			f"of '{file.path}': {reason}")
+	logger.debug("downloaded %s in %d ranges", file.path, len(ranges))
+	return size
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod, abstractproperty
+from typing import Iterable, Iterator
 
 TimeStamp = float
 
@@ -13,6 +14,11 @@ class StatType(ABC):
 	def st_mtime(self) -> TimeStamp:
 		"""the time the file was last modified"""
 
+	@property
+	@abstractmethod
+	def st_size(self) -> int:
+		"""the size of the file in bytes"""
+
 class FileType(ABC):
 	@property
 	@abstractmethod
@@ -84,4 +90,19 @@ class FileType(ABC):
 		"""
 		write `data` to the file.
 		"""
-	
\ No newline at end of file
+
+	@abstractmethod
+	def iter_bytes(self, chunk_size: int=...) -> Iterator[bytes]:
+		"""
+		stream the raw contents of the file in chunks of at most
+		`chunk_size` bytes, without decoding them.
+
+		Returns: an iterator of bytes-like objects
+		"""
+
+	@abstractmethod
+	def write_stream(self, chunks: Iterable[bytes]):
+		"""
+		overwrite the file with a stream of bytes-like chunks, without
+		holding the whole contents in memory.
+		"""